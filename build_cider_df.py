@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""Builds a table of the CIDEr document frequencies of the n-grams of the
+reference captions of a dataset.  Giving the table to Cider(df=...), e.g. with
+--cider_df in infer.py and train.py, fixes the IDF weights, so that the score of
+an image no longer depends on the other images scored with it, and shards of a
+large dataset can be scored separately."""
+
+import argparse
+import os
+import sys
+
+from data_loader import get_loader, DatasetParams
+from eval.cider_scorer import CiderReferences, DocumentFrequency
+
+try:
+    from tqdm import tqdm
+except ImportError as e:
+    print('WARNING: tqdm module not found. Install it if you want a fancy progress bar :-)')
+
+    def tqdm(x, disable=False): return x
+
+
+def main(args):
+    if DocumentFrequency.exists(args.output):
+        print('ERROR: {} exists, please remove its files first if you want to replace it.'.
+              format(args.output))
+        sys.exit(1)
+
+    dataset_configs = DatasetParams(args.dataset_config_file)
+    dataset_params = dataset_configs.get_params(args.dataset)
+
+    # We ask it to iterate over images instead of all (image, caption) pairs
+    data_loader, _ = get_loader(dataset_params, vocab=None, transform=None,
+                                batch_size=args.batch_size, shuffle=False,
+                                num_workers=args.num_workers,
+                                ext_feature_sets=None,
+                                skip_images=True,
+                                iter_over_images=True)
+
+    # Reference captions of each image, lowercased like in infer.py
+    gts = {}
+    show_progress = sys.stderr.isatty()
+    for _, ref_captions, _, image_ids, _ in tqdm(data_loader, disable=not show_progress):
+        if ref_captions is None:
+            print('ERROR: dataset {} has no reference captions.'.format(args.dataset))
+            sys.exit(1)
+        for rcs, image_id in zip(ref_captions, image_ids):
+            if type(rcs) is str:
+                rcs = [rcs]
+            gts.setdefault(image_id, []).extend(rc.lower() for rc in rcs)
+
+    refs = CiderReferences.build(list(gts.values()), n=args.n)
+    table = DocumentFrequency.build(refs)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    table.save(args.output)
+    print('Saved document frequencies of {} n-grams in {} images to {}'.format(
+        len(table.df), table.num_images, args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='coco:train2014',
+                        help='dataset the reference captions of which are counted')
+    parser.add_argument('--dataset_config_file', type=str,
+                        default='datasets/datasets.conf',
+                        help='location of dataset configuration file')
+    parser.add_argument('--output', type=str, required=True,
+                        help='path prefix of the .npy files of the table, e.g. '
+                        'data/coco-train-df, which can be used as Cider(df=...)')
+    parser.add_argument('--n', type=int, default=4,
+                        help='maximum length of the n-grams')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, default=2)
+
+    main(parser.parse_args())
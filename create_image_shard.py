@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+import torch
+from torchvision import transforms
+
+from data_loader import get_loader, DatasetParams
+
+try:
+    from tqdm import tqdm
+except ImportError as e:
+    print('WARNING: tqdm module not found. Install it if you want a fancy progress bar :-)')
+
+    def tqdm(x, disable=False): return x
+
+
+def to_uint8_tensor(image):
+    return torch.from_numpy(np.array(image, dtype=np.uint8))
+
+
+def main(args):
+    transform = transforms.Compose([
+        transforms.Resize((args.image_size, args.image_size)),
+        transforms.Lambda(to_uint8_tensor)])
+
+    dataset_configs = DatasetParams(args.dataset_config_file)
+    dataset_params = dataset_configs.get_params(args.dataset)
+    for i in dataset_params:
+        if i.dataset_class not in ('CocoDataset', 'VisualGenomeIM2PDataset'):
+            print('ERROR: image shards are not supported for {}'.format(i.dataset_class))
+            sys.exit(1)
+
+    # We ask it to iterate over images instead of all (image, caption) pairs
+    data_loader, _ = get_loader(dataset_params, vocab=None, transform=transform,
+                                batch_size=args.batch_size, shuffle=False,
+                                num_workers=args.num_workers,
+                                ext_feature_sets=None,
+                                skip_images=False,
+                                iter_over_images=True)
+
+    num_images = len(data_loader.dataset)
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    npy_path = args.output + '.npy'
+    if os.path.exists(npy_path):
+        print('ERROR: {} exists, please remove it first if you want to replace it.'.
+              format(npy_path))
+        sys.exit(1)
+
+    print('Writing {} images of size {}x{} to {}...'.format(num_images, args.image_size,
+                                                           args.image_size, npy_path))
+    shard = np.lib.format.open_memmap(npy_path + '.tmp', mode='w+', dtype=np.uint8,
+                                      shape=(num_images, args.image_size,
+                                             args.image_size, 3))
+
+    # Images are identified by their file names, like the datasets do
+    keys = []
+    seen = set()
+    show_progress = sys.stderr.isatty()
+    for images, _, _, image_ids, _ in tqdm(data_loader, disable=not show_progress):
+        for image, image_id in zip(images, image_ids):
+            key = os.path.basename(str(image_id))
+            if key in seen:
+                continue
+            seen.add(key)
+            shard[len(keys)] = image.numpy()
+            keys.append(key)
+
+    shard.flush()
+    if len(keys) < num_images:
+        # Some images were listed more than once, drop the unused rows
+        final = np.lib.format.open_memmap(npy_path + '.tmp2', mode='w+', dtype=np.uint8,
+                                          shape=(len(keys),) + shard.shape[1:])
+        final[:] = shard[:len(keys)]
+        final.flush()
+        del shard, final
+        os.replace(npy_path + '.tmp2', npy_path + '.tmp')
+    else:
+        del shard
+    os.replace(npy_path + '.tmp', npy_path)
+
+    with open(args.output + '.json', 'w') as f:
+        json.dump({'dataset': args.dataset, 'image_size': args.image_size, 'keys': keys}, f)
+
+    print('Wrote {} images to {}'.format(len(keys), npy_path))
+    print('Add "image_shard = {}" to the dataset configuration to use it.'.format(args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='coco:train2014',
+                        help='dataset whose images are stored in the shard')
+    parser.add_argument('--dataset_config_file', type=str,
+                        default='datasets/datasets.conf',
+                        help='location of dataset configuration file')
+    parser.add_argument('--output', type=str, required=True,
+                        help='path of the shard without extension, the images are '
+                        'saved to OUTPUT.npy and their names to OUTPUT.json')
+    parser.add_argument('--image_size', type=int, default=256,
+                        help='resize images to this size, must be at least the '
+                        '--crop_size used in training')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, default=2)
+
+    args = parser.parse_args()
+    main(args=args)
@@ -1,18 +1,24 @@
+import fnmatch
 import glob
+import hashlib
+import io
 import json
+import multiprocessing
 import nltk
 import os
 import re
 import pickle
+import struct
 import sys
 import zipfile
+import zlib
 
 import numpy as np
 import torch
 import torch.utils.data as data
 
 #from vocabulary import Vocabulary  # (Needed to handle Vocabulary pickle)
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from PIL import Image
 import configparser
 
@@ -175,14 +181,27 @@ class DatasetParams:
 
 
 class ExternalFeature:
-    def __init__(self, filename, base_path):
+    # Default memory budget of the per-process LRU cache of decoded LMDB
+    # features, per feature file
+    lru_bytes = 64 * 1024 * 1024
+
+    def __init__(self, filename, base_path, shared_memory=False, lru_bytes=None):
+        """Open an external feature file.  Numpy .npy files are memory-mapped
+        so that all DataLoader workers share the page cache, or, if
+        shared_memory is set, loaded once into shared memory.  LMDB
+        environments are opened once per process, see open_handles()."""
         if base_path is None:
             base_path = ''
         full_path = os.path.expanduser(os.path.join(base_path, filename))
-        self.lmdb = None
         self.lmdb_path = None
         self.bin = None
-        self.disable_cache = False
+        self.npy_path = None
+        self._shared = None
+        self._env = None
+        self._txn = None
+        self._env_pid = None
+        self._lru = OrderedDict()
+        self._lru_size = 0
 
         if not os.path.exists(full_path):
             raise FileNotFoundError('ERROR: external feature file not found: ' + full_path)
@@ -191,14 +210,11 @@ class ExternalFeature:
             self.f = h5py.File(full_path, 'r')
             self.data = self.f['data']
         elif filename.endswith('.lmdb'):
-            import lmdb
-            self.lmdb = lmdb
             self.lmdb_path = full_path
 
         elif filename.endswith('.bin'):
             from picsom.bin_data import picsom_bin_data
             self.bin = [ picsom_bin_data(full_path) ]
-            self.binx = {}
             print(('PicSOM binary data {:s} contains {:d}' +
                    ' objects of dimensionality {:d}').format(self.bin[0].path(),
                                                              self.bin[0].nobjects(),
@@ -206,7 +222,6 @@ class ExternalFeature:
         elif filename.endswith('.txt'):
             from picsom.bin_data import picsom_bin_data
             self.bin = []
-            self.binx = {}
             m = re.match('^(.*/)?[^/]+', full_path)
             assert m
             with open(full_path) as f:
@@ -221,13 +236,23 @@ class ExternalFeature:
                               format(self.bin[i].path(), self.bin[i].nobjects(),
                                      self.bin[i].vdim()))
         else:
-            self.data = np.load(full_path)
+            self.npy_path = full_path
+            if shared_memory:
+                # The workers receive a handle to the shared memory instead
+                # of a copy of the matrix
+                self._shared = torch.from_numpy(np.load(full_path)).share_memory_()
+                self.data = self._shared.numpy()
+            else:
+                self.data = np.load(full_path, mmap_mode='r')
 
         x1 = None
-        if self.lmdb is not None:
-            # Figure out the dimensions of our features:
-            with self.lmdb.open(self.lmdb_path, max_readers=1, readonly=True, lock=False,
-                                readahead=False, meminit=False) as env:
+        if self.lmdb_path is not None:
+            import lmdb
+            # Figure out the dimensions of our features.  The environment is
+            # closed again so that DataLoader workers don't inherit it, LMDB
+            # handles must not be used across fork():
+            with lmdb.open(self.lmdb_path, max_readers=1, readonly=True, lock=False,
+                           readahead=False, meminit=False) as env:
                 with env.begin(write=False) as txn:
                     c = txn.cursor()
                     assert c.first(), full_path
@@ -240,18 +265,17 @@ class ExternalFeature:
                     else:
                         self._vdim = x1.shape[0]
 
-            # Figure out if our features are too large to cache:
-            if np.prod(self._vdim) > 1e5:
-                # Subsequent feature loading requests will reinitialize LMDB handle to
-                # clear any caches:
-                self.disable_cache = True
-            else:
-                # Caching is on, so we can use the globally defined lmdb handle per featureset:
-                self.f = lmdb.open(full_path, max_readers=1, readonly=True, lock=False,
-                                   readahead=False, meminit=False)
-                self.lmdb = self.f.begin(write=False)
+            # Bound the decoded feature cache by memory, so that large spatial
+            # features (e.g. 2048x7x7) only keep a few hundred entries:
+            if lru_bytes is None:
+                lru_bytes = self.lru_bytes
+            self._lru_size = int(lru_bytes // (4 * np.prod(self._vdim)))
         elif self.bin is not None:
             self._vdim = sum([i.vdim() for i in self.bin])
+            # Map the files already here so that forked DataLoader workers
+            # inherit the mappings instead of creating their own
+            for i in self.bin:
+                i.memmap()
         else:
             x1 = self.data[0]
             self._vdim = self.data.shape[1]
@@ -260,56 +284,155 @@ class ExternalFeature:
 
         print('Loaded feature {} with dim {}.'.format(full_path, self.vdim()))
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.npy_path is not None:
+            # Don't pickle the contents of the matrix, see __setstate__()
+            del state['data']
+        # LMDB handles are per process, they are reopened on first use
+        state['_env'] = state['_txn'] = state['_env_pid'] = None
+        state['_lru'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.npy_path is not None:
+            if self._shared is not None:
+                self.data = self._shared.numpy()
+            else:
+                self.data = np.load(self.npy_path, mmap_mode='r')
+
     def vdim(self):
         return self._vdim
 
     def _lmdb_to_numpy(self, value, dtype=np.float32):
         return np.frombuffer(value, dtype=dtype)
 
+    def open_handles(self):
+        """(Re)opens the read-only LMDB environment of this process and clears
+        the decoded feature cache.  Called from worker_init_fn() in each
+        DataLoader worker, and lazily whenever the process has changed."""
+        if self.lmdb_path is None:
+            return
+        import lmdb
+        if self._env is not None:
+            # Handles inherited from the parent process must not be used, but
+            # closing them only unmaps this process' copy of the environment
+            self._txn.abort()
+            self._env.close()
+        self._env = lmdb.open(self.lmdb_path, max_readers=1, readonly=True, lock=False,
+                              readahead=False, meminit=False)
+        self._txn = self._env.begin(write=False)
+        self._env_pid = os.getpid()
+        self._lru = OrderedDict()
+
+    def _lmdb_txn(self):
+        if self._env_pid != os.getpid():
+            self.open_handles()
+        return self._txn
+
+    def _lru_get(self, key):
+        x = self._lru.get(key)
+        if x is not None:
+            self._lru.move_to_end(key)
+        return x
+
+    def _lru_put(self, key, x):
+        if self._lru_size <= 0:
+            return
+        self._lru[key] = x
+        if len(self._lru) > self._lru_size:
+            self._lru.popitem(last=False)
+
+    def _bin_vector(self, b, idx):
+        # idx is a list of alternative object indices, use the first one
+        # that has data in this file
+        for j in idx:
+            v = b.get_float_view(j)
+            if not np.isnan(v[0]):
+                return v
+        print('ERROR 1', idx)
+        exit(1)
+
     def get_feature(self, idx):
-        if self.lmdb is not None:
-            if self.disable_cache:
-                with self.lmdb.open(self.lmdb_path, max_readers=1, readonly=True, lock=False,
-                                    readahead=False, meminit=False) as env:
-                    with env.begin(write=False) as txn:
-                        x = self._lmdb_to_numpy(txn.get(str(idx).encode('ascii')))
-                        x.reshape(self._vdim)
-            else:
+        if self.lmdb_path is not None:
+            key = str(idx).encode('ascii')
+            x = self._lru_get(key)
+            if x is None:
                 try:
-                    x = self._lmdb_to_numpy(self.lmdb.get(str(idx).encode('ascii')))
+                    x = self._lmdb_to_numpy(self._lmdb_txn().get(key))
                 except:
                     print('No feature data was found with key <{}>'.format(str(idx)))
                     exit(1)
-                x.reshape(self._vdim)
+                self._lru_put(key, x)
         elif self.bin is not None:
-            from picsom.bin_data import picsom_bin_data
-            pid = os.getpid();
-            #print('get_feature()', pid)
-            if not pid in self.binx:
-                self.binx[pid] = []
-                for i in self.bin:
-                    self.binx[pid].append(picsom_bin_data(i.path()))
-            x = []
-            for i in self.binx[pid]:
-                found = False
-                for j in idx:
-                    v = i.get_float(j)
-                    if not np.isnan(v[0]):
-                        found = True
-                        x += v
-                        break
-                if not found:
-                    print('ERROR 1', idx)
-                    exit(1)
-            #if np.isnan(x).any():
-            #    print('ERROR 2', idx, ':', x)
-            #print('QQQ', self.bin.path(), idx, x[0:5])
-            #assert not np.isnan(x).any(), self.bin.path()+' '+str(idx)
+            # The memory-mapped views are shared by all DataLoader workers,
+            # so there is no need to reopen the files per process
+            x = [self._bin_vector(b, idx) for b in self.bin]
+            x = x[0] if len(x) == 1 else np.concatenate(x)
+            return torch.from_numpy(x)
         else:
             x = self.data[idx]
 
         return torch.tensor(x).float()
 
+    def _lmdb_get_batch(self, txn, keys):
+        # Look up each distinct key once, in sorted order so that the cursor
+        # walks the B-tree sequentially
+        ukeys = sorted(set(keys))
+        cursor = txn.cursor()
+        if hasattr(cursor, 'getmulti'):
+            values = dict(cursor.getmulti(ukeys))
+        else:
+            values = {k: cursor.get(k) for k in ukeys if cursor.set_key(k)}
+
+        x = np.empty((len(keys), int(np.prod(self._vdim))), dtype=np.float32)
+        for i, k in enumerate(keys):
+            if values.get(k) is None:
+                print('No feature data was found with key <{}>'.format(k.decode('ascii')))
+                exit(1)
+            x[i] = self._lmdb_to_numpy(values[k])
+        return x
+
+    def get_features(self, idxs):
+        """Batched counterpart of get_feature(), returns a (len(idxs), vdim)
+        tensor with the features of all the given indices"""
+        if self.lmdb_path is not None:
+            keys = [str(idx).encode('ascii') for idx in idxs]
+            x = np.empty((len(keys), int(np.prod(self._vdim))), dtype=np.float32)
+            missing = []
+            for i, k in enumerate(keys):
+                v = self._lru_get(k)
+                if v is None:
+                    missing.append(i)
+                else:
+                    x[i] = v
+            if missing:
+                mkeys = [keys[i] for i in missing]
+                v = self._lmdb_get_batch(self._lmdb_txn(), mkeys)
+                x[missing] = v
+                for k, row in zip(mkeys, v):
+                    self._lru_put(k, row.copy())
+        elif self.bin is not None:
+            x = []
+            for b in self.bin:
+                # Try the first alternative of every index in one sorted
+                # read, and fall back to the other alternatives only for
+                # the rows that had no data
+                v = b.get_float_rows([idx[0] for idx in idxs])
+                for i in np.flatnonzero(np.isnan(v[:, 0])):
+                    v[i] = self._bin_vector(b, idxs[i])
+                x.append(v)
+            x = x[0] if len(x) == 1 else np.concatenate(x, 1)
+        else:
+            # Fancy indexing with sorted unique indices, which also works
+            # for h5py datasets
+            u, inv = np.unique(np.asarray(idxs), return_inverse=True)
+            x = np.asarray(self.data[u], dtype=np.float32)[inv.reshape(-1)]
+            x = x.reshape(len(idxs), -1)
+
+        return torch.from_numpy(x)
+
     @classmethod
     def load_set(cls, feature_loaders, idx):
         if len(feature_loaders) == 0:
@@ -317,6 +440,21 @@ class ExternalFeature:
         else:
             return torch.cat([ef.get_feature(idx) for ef in feature_loaders])
 
+    @classmethod
+    def load_set_batch(cls, feature_loaders, idxs):
+        if len(feature_loaders) == 0:
+            return None
+        else:
+            return torch.cat([ef.get_features(idxs) for ef in feature_loaders], 1)
+
+    @classmethod
+    def load_sets_batch(cls, feature_loader_sets, idxs):
+        """Like load_sets(), but for a whole batch of indices: returns a list
+        with one (batch_size, feature_dim) tensor for each feature set"""
+        if feature_loader_sets is None:
+            return None
+        return [cls.load_set_batch(fls, idxs) for fls in feature_loader_sets]
+
     @classmethod
     def load_sets(cls, feature_loader_sets, idx):
         # We have several sets of features (e.g., initial, persistent, ...)
@@ -329,12 +467,12 @@ class ExternalFeature:
         return [cls.load_set(fls, idx) for fls in feature_loader_sets]
 
     @classmethod
-    def loaders(cls, features, base_path):
+    def loaders(cls, features, base_path, shared_memory=False):
         ef_loaders = []
         feat_dim = 0
 
         for fn in features:
-            ef = cls(fn, base_path)
+            ef = cls(fn, base_path, shared_memory)
             ef_loaders.append(ef)
             # When the number of features is 1 sometimes they come in none 1-d form
             # if statement below takes care of this:
@@ -345,14 +483,9 @@ class ExternalFeature:
         return (ef_loaders, feat_dim)
 
 
-def tokenize_caption(text, vocab, no_tokenize=False, show_tokens=False,
-                     start_token=True):
-    """Tokenize a single sentence / caption, convert tokens to vocabulary indices,
-    and store the vocabulary index array into a torch tensor"""
-
-    if vocab is None:
-        return text
-
+def caption_to_ids(text, vocab, no_tokenize=False, start_token=True):
+    """Tokenize a single sentence / caption and return the list of its vocabulary
+    indices, including the <start> (if start_token is set) and <end> tokens"""
     if no_tokenize:
         tokens = str(text).split()
     else:
@@ -363,6 +496,18 @@ def tokenize_caption(text, vocab, no_tokenize=False, show_tokens=False,
         caption.append(vocab('<start>'))
     caption.extend([vocab(token) for token in tokens])
     caption.append(vocab('<end>'))
+    return caption
+
+
+def tokenize_caption(text, vocab, no_tokenize=False, show_tokens=False,
+                     start_token=True):
+    """Tokenize a single sentence / caption, convert tokens to vocabulary indices,
+    and store the vocabulary index array into a torch tensor"""
+
+    if vocab is None:
+        return text
+
+    caption = caption_to_ids(text, vocab, no_tokenize, start_token)
     target = torch.Tensor(caption)
 
     if show_tokens:
@@ -372,7 +517,285 @@ def tokenize_caption(text, vocab, no_tokenize=False, show_tokens=False,
     return target
 
 
-class CocoDataset(data.Dataset):
+# Arguments of caption_to_ids() in CaptionCache builder processes:
+_cache_worker_args = None
+
+
+def _cache_worker_init(vocab, no_tokenize):
+    global _cache_worker_args
+    _cache_worker_args = (vocab, no_tokenize)
+
+
+def _cache_worker_tokenize(texts):
+    vocab, no_tokenize = _cache_worker_args
+    return [caption_to_ids(text, vocab, no_tokenize) for text in texts]
+
+
+class CaptionCache:
+    """Vocabulary indices of all the captions of a dataset, tokenized only once.
+    The indices are stored in one flat int32 array, caption i being
+    tokens[offsets[i]:offsets[i + 1]].  The arrays are saved in a cache
+    directory under a hash of the vocabulary, the tokenizer settings and the
+    captions, and memory-mapped when the same combination is used again."""
+
+    version = 1
+    chunk_size = 10000
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """Returns the indices of one caption as a tensor, like tokenize_caption()"""
+        return torch.from_numpy(self.tokens[self.offsets[index]:self.offsets[index + 1]].
+                                astype(np.int64))
+
+    def lengths(self):
+        """Returns the lengths of all captions in tokens"""
+        return np.diff(self.offsets)
+
+    @classmethod
+    def cache_key(cls, texts, vocab, no_tokenize):
+        h = hashlib.sha1()
+        h.update('{} {} {} {}\n'.format(cls.version, nltk.__version__, no_tokenize,
+                                         len(texts)).encode('utf-8'))
+        h.update('\n'.join(vocab.get_list()).encode('utf-8'))
+        for text in texts:
+            h.update(b'\0' + str(text).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    @classmethod
+    def build(cls, texts, vocab, no_tokenize, num_workers):
+        chunks = [texts[i:i + cls.chunk_size] for i in range(0, len(texts), cls.chunk_size)]
+        if num_workers > 1 and len(chunks) > 1:
+            with multiprocessing.Pool(num_workers, _cache_worker_init,
+                                      (vocab, no_tokenize)) as pool:
+                results = pool.map(_cache_worker_tokenize, chunks)
+        else:
+            _cache_worker_init(vocab, no_tokenize)
+            results = [_cache_worker_tokenize(chunk) for chunk in chunks]
+        captions = [caption for result in results for caption in result]
+
+        offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(caption) for caption in captions])
+        tokens = np.fromiter((i for caption in captions for i in caption), dtype=np.int32,
+                             count=offsets[-1])
+        return tokens, offsets
+
+    @classmethod
+    def load(cls, name, texts, vocab, cache_dir, no_tokenize=False, num_workers=None):
+        """Load the cached token indices of texts, tokenizing and saving them first if
+        they are not found in cache_dir"""
+        key = cls.cache_key(texts, vocab, no_tokenize)
+        path = os.path.join(cache_dir, 'captions-{}-{}'.format(name, key))
+        tokens_path = path + '.tokens.npy'
+        offsets_path = path + '.offsets.npy'
+
+        if not os.path.exists(offsets_path):
+            if num_workers is None:
+                num_workers = min(8, multiprocessing.cpu_count())
+            print('Tokenizing {} captions of {} with {} processes...'.format(
+                len(texts), name, num_workers))
+            tokens, offsets = cls.build(texts, vocab, no_tokenize, num_workers)
+
+            # Write to temporary files first so that concurrent runs never
+            # see half-written arrays, the offsets file signals completion
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = '.{}.tmp.npy'.format(os.getpid())
+            np.save(tokens_path + tmp, tokens)
+            np.save(offsets_path + tmp, offsets)
+            os.replace(tokens_path + tmp, tokens_path)
+            os.replace(offsets_path + tmp, offsets_path)
+            print('Saved tokenized captions to {}'.format(path))
+
+        cache = cls(np.load(tokens_path, mmap_mode='r'), np.load(offsets_path, mmap_mode='r'))
+        assert len(cache) == len(texts), offsets_path
+        return cache
+
+
+def get_caption_cache(texts, vocab, config_dict, no_tokenize=False):
+    """Returns a CaptionCache of texts if caching has been enabled by setting
+    config_dict['cache_dir'], None otherwise"""
+    if vocab is None or not config_dict or not config_dict.get('cache_dir'):
+        return None
+    return CaptionCache.load(config_dict['dataset_name'], texts, vocab,
+                             config_dict['cache_dir'], no_tokenize)
+
+
+class CocoIndex:
+    """Compact replacement for the pycocotools COCO object of a caption
+    annotation file.  Everything is kept in a few flat numpy arrays, which
+    DataLoader workers can share after fork() without the reference count
+    updates that slowly copy every page of nested Python dicts.  The index
+    is cached in cache_dir keyed by the path, size and mtime of the file."""
+
+    version = 1
+    fields = ['img_ids', 'file_names', 'ann_ids', 'ann_imgs', 'captions',
+              'caption_offsets', 'img_anns', 'img_ann_offsets']
+
+    def __init__(self, arrays):
+        for f in self.fields:
+            setattr(self, f, arrays[f])
+
+    def num_images(self):
+        return len(self.img_ids)
+
+    def num_captions(self):
+        return len(self.ann_ids)
+
+    def image_id(self, i):
+        return int(self.img_ids[i])
+
+    def file_name(self, i):
+        return self.file_names[i].decode('utf-8')
+
+    def caption(self, a):
+        return bytes(self.captions[self.caption_offsets[a]:
+                                   self.caption_offsets[a + 1]]).decode('utf-8')
+
+    def image_captions(self, i):
+        """Returns the indices of the annotations of image i"""
+        return self.img_anns[self.img_ann_offsets[i]:self.img_ann_offsets[i + 1]]
+
+    @classmethod
+    def build(cls, json_file):
+        with open(json_file) as f:
+            dataset = json.load(f)
+        images = dataset['images']
+        anns = dataset['annotations']
+
+        img_ids = np.array([img['id'] for img in images], dtype=np.int64)
+        file_names = np.array([img['file_name'].encode('utf-8') for img in images])
+
+        # Map each annotation to the position of its image in img_ids
+        order = np.argsort(img_ids, kind='stable')
+        ann_img_ids = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+        pos = np.searchsorted(img_ids, ann_img_ids, sorter=order)
+        ann_imgs = order[np.minimum(pos, len(order) - 1)].astype(np.int32)
+        assert (img_ids[ann_imgs] == ann_img_ids).all(), \
+            'annotations refer to missing images in ' + json_file
+
+        captions = [ann['caption'].encode('utf-8') for ann in anns]
+        caption_offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+        caption_offsets[1:] = np.cumsum([len(c) for c in captions])
+
+        # Annotations grouped by image, in file order like COCO.imgToAnns
+        img_anns = np.argsort(ann_imgs, kind='stable').astype(np.int32)
+        img_ann_offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        img_ann_offsets[1:] = np.cumsum(np.bincount(ann_imgs, minlength=len(images)))
+
+        return cls({'img_ids': img_ids,
+                    'file_names': file_names,
+                    'ann_ids': np.array([ann['id'] for ann in anns], dtype=np.int64),
+                    'ann_imgs': ann_imgs,
+                    'captions': np.frombuffer(b''.join(captions), dtype=np.uint8),
+                    'caption_offsets': caption_offsets,
+                    'img_anns': img_anns,
+                    'img_ann_offsets': img_ann_offsets})
+
+    @classmethod
+    def load(cls, json_file, cache_dir=None):
+        """Load the index of json_file from cache_dir, building and saving it
+        there first if needed.  Without cache_dir the index is always built."""
+        if not cache_dir:
+            return cls.build(json_file)
+
+        st = os.stat(json_file)
+        h = hashlib.sha1('{} {} {} {}'.format(cls.version, os.path.abspath(json_file),
+                                              st.st_size, st.st_mtime_ns).encode('utf-8'))
+        path = os.path.join(cache_dir, 'coco-index-{}-{}.npz'.format(
+            os.path.splitext(os.path.basename(json_file))[0], h.hexdigest()[:16]))
+
+        if os.path.exists(path):
+            with np.load(path) as arrays:
+                return cls(arrays)
+
+        index = cls.build(json_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp, **{f: getattr(index, f) for f in cls.fields})
+        os.replace(tmp, path)
+        print('Saved COCO index to {}'.format(path))
+        return index
+
+
+class FeatureBatch(list):
+    """List of samples returned by BatchFeatureDataset.__getitems__(), the
+    external features of which have already been fetched for the whole batch.
+    collate_fn() uses feature_sets as is instead of stacking them."""
+
+    def __init__(self, samples, feature_sets):
+        super(FeatureBatch, self).__init__(samples)
+        self.feature_sets = feature_sets
+
+
+class BatchFeatureDataset(data.Dataset):
+    """Base class for datasets that can fetch the external features of a whole
+    batch at a time.  Subclasses implement _get_sample(index) which returns
+    (image, target, image_id, feature_key) where feature_key is the index
+    passed on to the ExternalFeature loaders."""
+
+    def _get_sample(self, index):
+        raise NotImplementedError
+
+    def _caption_texts(self):
+        raise NotImplementedError('{} has no captions'.format(type(self).__name__))
+
+    def _cached_image(self, image_id):
+        """Returns a zero tensor in place of the image if the features of all
+        the internal features are in the FeatureCache set as feature_cache in
+        config_dict, so that the image needn't be loaded, None otherwise"""
+        config_dict = getattr(self, 'config_dict', None)
+        cache = config_dict.get('feature_cache') if config_dict else None
+        if cache is None or not cache.has(image_id):
+            return None
+        return torch.zeros(cache.image_shape)
+
+    def caption_lengths(self):
+        """Returns the lengths of all captions in tokens, as counted by the
+        caption cache or approximated by whitespace splitting without it"""
+        if getattr(self, 'caption_cache', None) is not None:
+            return self.caption_cache.lengths()
+        # +2 for the <start> and <end> tokens
+        return np.array([len(str(t).split()) + 2 for t in self._caption_texts()])
+
+    def word_counts(self, vocab_size):
+        """Returns the number of occurrences of each vocabulary index in the
+        captions, including <start>, <end> and <unk>"""
+        if getattr(self, 'caption_cache', None) is not None:
+            tokens = self.caption_cache.tokens
+        else:
+            tokens = np.array([i for t in self._caption_texts()
+                               for i in caption_to_ids(t, self.vocab)], dtype=np.int64)
+        return np.bincount(tokens, minlength=vocab_size)
+
+    def __getitem__(self, index):
+        """Returns one training sample as a tuple (image, caption, image_id, features)."""
+        image, target, img_id, feature_key = self._get_sample(index)
+        feature_sets = ExternalFeature.load_sets(self.feature_loaders, feature_key)
+        return image, target, img_id, feature_sets
+
+    def __getitems__(self, indices):
+        """Returns the samples of a whole batch, called by the DataLoader
+        instead of __getitem__() when available."""
+        if self.feature_loaders is None:
+            return [self[i] for i in indices]
+
+        samples = [self._get_sample(i) for i in indices]
+        # Use the same order as collate_fn() will so that it doesn't have to
+        # reorder the rows of the batched features
+        if samples[0][1] is not None:
+            samples.sort(key=lambda x: len(x[1]), reverse=True)
+
+        feature_sets = ExternalFeature.load_sets_batch(self.feature_loaders,
+                                                       [s[3] for s in samples])
+        return FeatureBatch([s[:3] + (None,) for s in samples], feature_sets)
+
+
+class CocoDataset(BatchFeatureDataset):
     """COCO Custom Dataset compatible with torch.utils.data.DataLoader."""
 
     def __init__(self, root, json_file, vocab, subset=None, transform=None, skip_images=False,
@@ -386,50 +809,61 @@ class CocoDataset(data.Dataset):
             subset: file defining a further subset of the dataset to be used
             transform: image transformer.
         """
-        from pycocotools.coco import COCO
         self.root = root
-        self.coco = COCO(json_file)
+        self.index = CocoIndex.load(json_file, config_dict and config_dict.get('cache_dir'))
         self.iter_over_images = iter_over_images
-        if iter_over_images:
-            self.ids = list(self.coco.imgs.keys())
-        else:
-            self.ids = list(self.coco.anns.keys())
         self.vocab = vocab
         self.transform = transform
         self.skip_images = skip_images
         self.feature_loaders = feature_loaders
         self.config_dict = config_dict
+        self.shard = None if skip_images else get_image_shard(config_dict)
 
-        print("COCO info loaded for {} images and {} captions.".format(len(self.coco.imgs),
-                                                                       len(self.coco.anns)))
+        print("COCO info loaded for {} images and {} captions.".format(
+            self.index.num_images(), self.index.num_captions()))
 
-    def __getitem__(self, index):
-        """Returns one training sample as a tuple (image, caption, image_id)."""
+        self.caption_cache = None
+        if not iter_over_images:
+            self.caption_cache = get_caption_cache(self._caption_texts(), vocab, config_dict)
+
+    def _caption_texts(self):
+        assert not self.iter_over_images
+        return [self.index.caption(a) for a in range(self.index.num_captions())]
+
+    def _get_sample(self, index):
         if self.iter_over_images:
-            img_id = self.ids[index]
-            caption = [a['caption'] for a in self.coco.imgToAnns[img_id]]
+            img = index
+            caption = [self.index.caption(a) for a in self.index.image_captions(img)]
             assert self.vocab is None, 'iter_over_images=True and tokenization not supported!'
+        elif self.caption_cache is not None:
+            img = self.index.ann_imgs[index]
+            caption = None
         else:
-            ann_id = self.ids[index]
-            caption = self.coco.anns[ann_id]['caption']
-            img_id = self.coco.anns[ann_id]['image_id']
+            img = self.index.ann_imgs[index]
+            caption = self.index.caption(index)
+        img_id = self.index.image_id(img)
 
         # Get image path
-        path = self.coco.loadImgs(img_id)[0]['file_name']
+        path = self.index.file_name(img)
         if not path.startswith('COCO'):  # Yes, this works... for now
             path = 'COCO_val2014_' + path
 
-        if not self.skip_images:
-            image = Image.open(os.path.join(self.root, path)).convert('RGB')
+        cached = None if self.skip_images else self._cached_image(img_id)
+        if cached is not None:
+            image = cached
+        elif self.shard is not None:
+            image = self.shard.get(path)
+        elif not self.skip_images:
+            image = open_image(self.root, path).convert('RGB')
             if self.transform is not None:
                 image = self.transform(image)
         else:
             image = torch.zeros(1, 1)
 
-        # Prepare external features, we use paths to access features
-        # NOTE: this only works with lmdb
-        feature_sets = ExternalFeature.load_sets(self.feature_loaders, path)
-        target = tokenize_caption(caption, self.vocab)
+        if self.caption_cache is not None:
+            target = self.caption_cache[index]
+        else:
+            target = tokenize_caption(caption, self.vocab)
 
         # We are in feature extraction-only mode,
         # use image filename as image identifier in lmdb:
@@ -440,13 +874,17 @@ class CocoDataset(data.Dataset):
         if self.config_dict.get('return_full_image_path'):
             img_id = os.path.join(self.root, path)
 
-        return image, target, img_id, feature_sets
+        # We use paths to access external features
+        # NOTE: this only works with lmdb
+        return image, target, img_id, path
 
     def __len__(self):
-        return len(self.ids)
+        if self.iter_over_images:
+            return self.index.num_images()
+        return self.index.num_captions()
 
 
-class VisualGenomeIM2PDataset(data.Dataset):
+class VisualGenomeIM2PDataset(BatchFeatureDataset):
     """Visual Genome / MS COCO Paragraph-length caption dataset"""
 
     # FIXME: skip_images, feature_loaders not implemented
@@ -466,6 +904,7 @@ class VisualGenomeIM2PDataset(data.Dataset):
         self.skip_images = skip_images
         self.feature_loaders = feature_loaders
         self.config_dict = config_dict
+        self.shard = None if skip_images else get_image_shard(config_dict)
 
         self.paragraphs = []
 
@@ -501,23 +940,34 @@ class VisualGenomeIM2PDataset(data.Dataset):
 
         print("VisualGenome paragraph data loaded for {} images...".format(len(self.paragraphs)))
 
-    def __getitem__(self, index):
+        self.caption_cache = get_caption_cache(self._caption_texts(), vocab, config_dict)
+
+    def _caption_texts(self):
+        return [p['caption'] for p in self.paragraphs]
+
+    def _get_sample(self, index):
         """Returns one data pair (image and paragraph)."""
         cap = self.paragraphs[index]['caption']
         img_id = self.paragraphs[index]['image_id']
-        path = os.path.join(self.root, str(img_id) + '.jpg')
-
-        if not self.skip_images:
-            image = Image.open(path).convert('RGB')
+        name = str(img_id) + '.jpg'
+        path = os.path.join(self.root, name)
+
+        cached = None if self.skip_images else self._cached_image(img_id)
+        if cached is not None:
+            image = cached
+        elif self.shard is not None:
+            image = self.shard.get(name)
+        elif not self.skip_images:
+            image = open_image(self.root, name).convert('RGB')
             if self.transform is not None:
                 image = self.transform(image)
         else:
             image = torch.zeros(1, 1)
 
-        # Prepare external features
-        # TODO probably wrong index ...
-        feature_sets = ExternalFeature.load_sets(self.feature_loaders, path)
-        target = tokenize_caption(cap, self.vocab)
+        if self.caption_cache is not None:
+            target = self.caption_cache[index]
+        else:
+            target = tokenize_caption(cap, self.vocab)
 
         # We are in feature extraction-only mode,
         # use image filename as image identifier in lmdb:
@@ -527,7 +977,8 @@ class VisualGenomeIM2PDataset(data.Dataset):
         if self.config_dict.get('return_full_image_path'):
             img_id = os.path.join(self.root, path)
 
-        return image, target, img_id, feature_sets
+        # TODO probably wrong index for external features ...
+        return image, target, img_id, path
 
     def __len__(self):
         return len(self.paragraphs)
@@ -553,7 +1004,8 @@ class VistDataset(data.Dataset):
         self.transform = transform
 
         # Get the list of available images:
-        images = [str(file).split('.')[0] for file in os.listdir(root)]
+        files = root.glob('*') if isinstance(root, ZipImageDir) else os.listdir(root)
+        images = [str(file).split('.')[0] for file in files]
 
         with open(json_file) as raw_data:
             json_data = json.load(raw_data)
@@ -595,12 +1047,10 @@ class VistDataset(data.Dataset):
 
         sequence = []
         for image_id in image_ids:
-            image_path = os.path.join(self.root, str(image_id) + '.jpg')
-            if os.path.isfile(image_path):
-                image = Image.open(image_path).convert('RGB')
-            else:
-                image_path = os.path.join(self.root, str(image_id) + '.png')
-                image = Image.open(image_path).convert('RGB')
+            image_name = str(image_id) + '.jpg'
+            if not image_exists(self.root, image_name):
+                image_name = str(image_id) + '.png'
+            image = open_image(self.root, image_name).convert('RGB')
 
             if self.transform is not None:
                 image = self.transform(image)
@@ -616,7 +1066,7 @@ class VistDataset(data.Dataset):
         return len(self.data_hold)
 
 
-class MSRVTTDataset(data.Dataset):
+class MSRVTTDataset(BatchFeatureDataset):
     """MSR-VTT Custom Dataset compatible with torch.utils.data.DataLoader."""
 
     def __init__(self, root, json_file, vocab, subset=None, transform=None, skip_images=False,
@@ -634,6 +1084,7 @@ class MSRVTTDataset(data.Dataset):
         self.transform = transform
         self.skip_images = skip_images
         self.feature_loaders = feature_loaders
+        self.config_dict = config_dict
         self.subset = subset if subset else 'train'
 
         self.captions = []
@@ -653,9 +1104,12 @@ class MSRVTTDataset(data.Dataset):
         print("MSR-VTT info [{}] loaded for {} images, {} captions.".format(self.subset,
                                                                             len(subset_vids), len(self.captions)))
 
-    def __getitem__(self, index):
-        """Returns one training sample as a tuple (image, caption, image_id)."""
+        self.caption_cache = get_caption_cache(self._caption_texts(), vocab, config_dict)
+
+    def _caption_texts(self):
+        return [c[1] for c in self.captions]
 
+    def _get_sample(self, index):
         vid = self.captions[index][0]
         caption = self.captions[index][1]
 
@@ -663,27 +1117,29 @@ class MSRVTTDataset(data.Dataset):
         vid_idx = int(vid[5:])
         path = '{:04}:kf1.jpeg'.format(vid_idx)
 
-        if not self.skip_images:
-            image = Image.open(os.path.join(self.root, path)).convert('RGB')
+        cached = None if self.skip_images else self._cached_image(vid_idx)
+        if cached is not None:
+            image = cached
+        elif not self.skip_images:
+            image = open_image(self.root, path).convert('RGB')
             if self.transform is not None:
                 image = self.transform(image)
         else:
             image = torch.zeros(1, 1)
 
-        # Prepare external features
-        feature_sets = ExternalFeature.load_sets(self.feature_loaders, vid_idx)
-
         # Convert caption (string) to word ids.
-        vocab = self.vocab
-        target = tokenize_caption(caption, vocab)
+        if self.caption_cache is not None:
+            target = self.caption_cache[index]
+        else:
+            target = tokenize_caption(caption, self.vocab)
 
-        return image, target, vid_idx, feature_sets
+        return image, target, vid_idx, vid_idx
 
     def __len__(self):
         return len(self.captions)
 
 
-class TRECVID2018Dataset(data.Dataset):
+class TRECVID2018Dataset(BatchFeatureDataset):
     def __init__(self, root, json_file, vocab, subset=None, transform=None, skip_images=False,
                  iter_over_images=False, feature_loaders=None, config_dict=None):
         self.root = root
@@ -693,7 +1149,7 @@ class TRECVID2018Dataset(data.Dataset):
         self.feature_loaders = feature_loaders
 
         self.id_to_filename = {}
-        for filename in glob.glob(self.root + '/*.jpeg'):
+        for filename in glob_images(self.root, '*.jpeg'):
             m = re.match(r'(\d+):\d+$', basename(filename))
             if m:
                 image_id = int(m.group(1))
@@ -705,14 +1161,12 @@ class TRECVID2018Dataset(data.Dataset):
 
         print("TRECVID 2018 info loaded for {} images.".format(len(self)))
 
-    def __getitem__(self, index):
-        """Returns one training sample as a tuple (image, caption, image_id)."""
-
+    def _get_sample(self, index):
         filename = self.id_to_filename[index]
 
         if not self.skip_images:
             image_path = os.path.join(self.root, filename)
-            image = Image.open(image_path)
+            image = open_image(self.root, filename)
             image = image.resize([224, 224], Image.LANCZOS)
             if image.mode != 'RGB':
                 print('WARNING: converting {} from {} to RGB'.
@@ -724,16 +1178,13 @@ class TRECVID2018Dataset(data.Dataset):
         else:
             image = torch.zeros(1, 1)
 
-        # Prepare external features
-        feature_sets = ExternalFeature.load_sets(self.feature_loaders, index)
-
-        return image, None, index, feature_sets
+        return image, None, index, index
 
     def __len__(self):
         return len(self.id_to_filename)
 
 
-class PicSOMDataset(data.Dataset):
+class PicSOMDataset(BatchFeatureDataset):
     def __init__(self, root, json_file, vocab, subset=None, transform=None, skip_images=False,
                  iter_over_images=False, feature_loaders=None, config_dict=None):
         from picsom.label_index import picsom_label_index
@@ -763,7 +1214,7 @@ class PicSOMDataset(data.Dataset):
 
         self.use_lmdb = self.feature_loaders is not None and \
                         len(self.feature_loaders[0]) and \
-                        self.feature_loaders[0][0].lmdb is not None
+                        self.feature_loaders[0][0].lmdb_path is not None
         print('PicSOM using {} features'.format('LMDB' if self.use_lmdb else 'BIN'))
 
         subset = self.db_root+'/classes/'+self.subset
@@ -820,11 +1271,18 @@ class PicSOMDataset(data.Dataset):
         
         print('PicSOM {} texts loaded for {} images from {}'.
               format(len(self.data), len(ll), tt))
-        
 
-    def __getitem__(self, index):
-        """Returns one training sample as a tuple (image, caption, image_id)."""
+        # --show_tokens needs the tokenizer to run for each caption
+        self.caption_cache = None
+        if not self.show_tokens:
+            self.caption_cache = get_caption_cache(self._caption_texts(), vocab,
+                                                   config_dict, self.no_tokenize)
 
+    def _caption_texts(self):
+        return [d[1] for d in self.data]
+        
+
+    def _get_sample(self, index):
         label_text_index = self.data[index]
         label = label_text_index[0]
         label_or_idx = label if self.use_lmdb else label_text_index[2]
@@ -832,20 +1290,20 @@ class PicSOMDataset(data.Dataset):
             print('PicSOMDataset.getitem() {:d} {:s} {!s:s}'.
                   format(index, label, label_or_idx))
 
-        target  = tokenize_caption(label_text_index[1], self.vocab,
-                                   no_tokenize=self.no_tokenize, show_tokens=self.show_tokens)
+        if self.caption_cache is not None:
+            target = self.caption_cache[index]
+        else:
+            target = tokenize_caption(label_text_index[1], self.vocab,
+                                      no_tokenize=self.no_tokenize,
+                                      show_tokens=self.show_tokens)
     
-        feature_sets = ExternalFeature.load_sets(self.feature_loaders, label_or_idx)
-
-        #print('__getitem__ ending', target, feature_sets)
-        
-        return torch.zeros(1, 1), target, label, feature_sets
+        return torch.zeros(1, 1), target, label, label_or_idx
 
     def __len__(self):
         return len(self.data)
         
 
-class GenericDataset(data.Dataset):
+class GenericDataset(BatchFeatureDataset):
     def __init__(self, root, json_file, vocab, subset=None, transform=None, skip_images=False,
                  iter_over_images=False, feature_loaders=None, config_dict=None):
         self.vocab = vocab
@@ -853,8 +1311,13 @@ class GenericDataset(data.Dataset):
         self.skip_images = skip_images
         self.feature_loaders = feature_loaders
 
+        # Entries of filelist are relative to root when reading from a zip archive
+        self.root = ''
         if type(root) is list:
             self.filelist = root
+        elif isinstance(root, ZipImageDir):
+            self.root = root
+            self.filelist = root.glob('*.jpeg')
         elif os.path.isdir(root):
             self.filelist = []
             for filename in glob.glob(root + '/*.jpeg'):
@@ -865,13 +1328,11 @@ class GenericDataset(data.Dataset):
 
         print("GenericDataset: loaded {} images.".format(len(self.filelist)))
 
-    def __getitem__(self, index):
-        """Returns one training sample as a tuple (image, caption, image_id)."""
-
+    def _get_sample(self, index):
         image_path = self.filelist[index]
 
         if not self.skip_images:
-            image = Image.open(image_path)
+            image = open_image(self.root, image_path)
             image = image.resize([224, 224], Image.LANCZOS)
             if image.mode != 'RGB':
                 print('WARNING: converting {} from {} to RGB'.
@@ -883,16 +1344,101 @@ class GenericDataset(data.Dataset):
         else:
             image = torch.zeros(1, 1)
 
-        # Prepare external features
+        # External features are accessed by the image basename
         path = os.path.splitext(os.path.basename(image_path))[0]
-        feature_sets = ExternalFeature.load_sets(self.feature_loaders, path)
 
-        return image, None, path, feature_sets
+        return image, None, path, path
 
     def __len__(self):
         return len(self.filelist)
 
 
+class BucketBatchSampler(data.Sampler):
+    """Batch sampler that puts captions of similar length in the same batch to
+    reduce padding.  Each epoch the indices are shuffled and split into pools
+    of bucket_size batches, each pool is sorted by caption length and cut into
+    batches, and finally the batches of all pools are shuffled.
+
+    If max_tokens is set, the number of captions in a batch is chosen so that
+    the padded batch holds at most max_tokens tokens instead of using a fixed
+    batch_size."""
+
+    def __init__(self, lengths, batch_size, bucket_size=100, max_tokens=None, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def _epoch_batches(self):
+        if self._batches is not None:
+            return self._batches
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+        perm = rng.permutation(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+
+        batches = []
+        for start in range(0, len(perm), pool_size):
+            pool = perm[start:start + pool_size]
+            pool = pool[np.argsort(-self.lengths[pool], kind='stable')]
+            i = 0
+            while i < len(pool):
+                if self.max_tokens is None:
+                    n = self.batch_size
+                else:
+                    # The pool is sorted longest first, so the first caption
+                    # determines the padded length of the batch
+                    n = max(1, self.max_tokens // int(self.lengths[pool[i]]))
+                batches.append(pool[i:i + n].tolist())
+                i += n
+
+        rng.shuffle(batches)
+        self._batches = batches
+        return batches
+
+    def __iter__(self):
+        batches = self._epoch_batches()
+        self._batches = None
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._epoch_batches())
+
+
+def caption_lengths(dataset):
+    """Returns the caption lengths of all samples of dataset"""
+    if isinstance(dataset, data.ConcatDataset):
+        return np.concatenate([caption_lengths(d) for d in dataset.datasets])
+    return dataset.caption_lengths()
+
+
+def caption_word_counts(dataset, vocab_size):
+    """Returns the number of occurrences of each vocabulary index in the
+    captions of all samples of dataset"""
+    if isinstance(dataset, data.ConcatDataset):
+        return sum(caption_word_counts(d, vocab_size) for d in dataset.datasets)
+    return dataset.word_counts(vocab_size)
+
+
+def feature_loaders(dataset):
+    """Returns all the ExternalFeature loaders used by dataset"""
+    if isinstance(dataset, data.ConcatDataset):
+        return [ef for d in dataset.datasets for ef in feature_loaders(d)]
+    fls = getattr(dataset, 'feature_loaders', None) or []
+    return [ef for efs in fls for ef in efs]
+
+
+def worker_init_fn(worker_id):
+    """DataLoader worker hook that opens the per-worker LMDB environments of
+    the external features once, instead of on each sample"""
+    for ef in feature_loaders(data.get_worker_info().dataset):
+        ef.open_handles()
+
+
 def collate_fn(data):
     """Creates mini-batch tensors from the list of tuples (image, caption, image_ids).
 
@@ -941,7 +1487,11 @@ def collate_fn(data):
     # feature_sets is a tuple of lists - 
     # -- one tuple corresponds to an image
     # -- list elements correspond to different feature types for the same image
-    if feature_sets[0] is not None:
+    if isinstance(data, FeatureBatch):
+        # The dataset has already fetched the features for the whole batch
+        # (in the same order as data has been sorted above)
+        features = data.feature_sets
+    elif feature_sets[0] is not None:
         batch_size = len(feature_sets)
         num_feature_sets = len(feature_sets[0])
         features = list()
@@ -990,26 +1540,170 @@ def collate_fn_vist(data):
     return images, targets, lengths, story_ids
 
 
-def unzip_image_dir(image_dir):
-    # Check if $TMPDIR envirnoment variable is set and use that
-    env_tmp = os.environ.get('TMPDIR')
-    # Also check if the environment variable points to '/tmp/some/dir' to avoid
-    # nasty surprises
-    if env_tmp and os.path.commonprefix([os.path.abspath(env_tmp), '/tmp']) == '/tmp':
-        tmp_root = os.path.abspath(env_tmp)
-    else:
-        tmp_root = '/tmp'
-
-    extract_path = os.path.join(tmp_root)
-
-    if not os.path.exists(extract_path):
-        os.makedirs(extract_path)
-
-    with zipfile.ZipFile(image_dir, 'r') as zipped_images:
-        print("Extracting training data from {} to {}".format(image_dir, extract_path))
-        zipped_images.extractall(extract_path)
-        unzipped_dir = os.path.basename(image_dir).split('.')[0]
-        return os.path.join(extract_path, unzipped_dir)
+class ZipImageDir:
+    """Image directory inside a zip archive, read without extracting it.  The
+    central directory is indexed once, and each process keeps one open file
+    handle from which the members are decoded straight into memory.  Stored
+    (uncompressed) members are the fastest, see resize.py --create_zip."""
+
+    # struct zipfile.structFileHeader, fields 10 and 11 are the lengths of
+    # the file name and the extra field following the local file header
+    _local_header = struct.Struct('<4s2B4HL2L2H')
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        # Like the extracted directory used to be, names are relative to the
+        # top-level directory named after the archive, if there is one
+        prefix = os.path.basename(zip_path).split('.')[0] + '/'
+        self.members = {}
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                name = info.filename
+                if name.startswith(prefix):
+                    name = name[len(prefix):]
+                self.members[name] = (info.header_offset, info.compress_type,
+                                      info.compress_size)
+        self._fd = None
+        self._pid = None
+        print('Indexed {} files in {}'.format(len(self.members), zip_path))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = state['_pid'] = None
+        return state
+
+    def __fspath__(self):
+        return self.zip_path
+
+    def __str__(self):
+        return self.zip_path
+
+    def _file(self):
+        # Forked DataLoader workers must not share the file offset, so each
+        # process opens its own handle
+        if self._pid != os.getpid():
+            self._fd = os.open(self.zip_path, os.O_RDONLY)
+            self._pid = os.getpid()
+        return self._fd
+
+    def exists(self, name):
+        return name in self.members
+
+    def glob(self, pattern):
+        """Returns the names of the members matching the glob pattern, which
+        like glob.glob() doesn't match across directories"""
+        depth = pattern.count('/')
+        return [name for name in self.members
+                if name.count('/') == depth and fnmatch.fnmatchcase(name, pattern)]
+
+    def read(self, name):
+        offset, compress_type, size = self.members[name]
+        fd = self._file()
+        header = self._local_header.unpack(os.pread(fd, self._local_header.size, offset))
+        offset += self._local_header.size + header[10] + header[11]
+        data = os.pread(fd, size, offset)
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+        raise ValueError('unsupported compression in {}: {}'.format(self.zip_path, name))
+
+    def open(self, name):
+        return Image.open(io.BytesIO(self.read(name)))
+
+
+def open_image(root, name):
+    """Opens image name in root, which is a directory or a ZipImageDir"""
+    if isinstance(root, ZipImageDir):
+        return root.open(name)
+    return Image.open(os.path.join(root, name))
+
+
+def image_exists(root, name):
+    if isinstance(root, ZipImageDir):
+        return root.exists(name)
+    return os.path.isfile(os.path.join(root, name))
+
+
+def glob_images(root, pattern):
+    """Returns the images in root matching pattern, as names for open_image()"""
+    if isinstance(root, ZipImageDir):
+        return root.glob(pattern)
+    return glob.glob(os.path.join(root, pattern))
+
+
+class ImageShard:
+    """Pre-resized images of a dataset, stored as one memory-mapped (N, S, S, 3)
+    uint8 array by create_image_shard.py.  Samples are cropped from it
+    without any image decoding, the rest of the preprocessing is done for
+    whole batches by shard_batch_transform()."""
+
+    def __init__(self, path, crop_size=None):
+        self.path = path
+        self.crop_size = crop_size
+        with open(path + '.json') as f:
+            keys = json.load(f)['keys']
+        self.keys = np.array(keys)
+        self.order = np.argsort(self.keys)
+        self.images = np.load(path + '.npy', mmap_mode='r')
+        assert len(self.images) == len(keys), path
+        assert not crop_size or crop_size <= min(self.images.shape[1:3]), \
+            'crop size {} is larger than the images in {}'.format(crop_size, path)
+        print('Image shard {} contains {} images of size {}x{}'.format(
+            path, len(keys), self.images.shape[1], self.images.shape[2]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['images']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.images = np.load(self.path + '.npy', mmap_mode='r')
+
+    def row(self, key):
+        i = np.searchsorted(self.keys, key, sorter=self.order)
+        if i == len(self.keys) or self.keys[self.order[i]] != key:
+            raise KeyError('image {} not found in shard {}'.format(key, self.path))
+        return self.order[i]
+
+    def get(self, key):
+        """Returns a random crop of image key as a (3, crop_size, crop_size) uint8 tensor"""
+        image = self.images[self.row(key)]
+        if self.crop_size:
+            h, w = image.shape[:2]
+            # torch's RNG is seeded differently in each DataLoader worker
+            y = torch.randint(h - self.crop_size + 1, (1,)).item()
+            x = torch.randint(w - self.crop_size + 1, (1,)).item()
+            image = image[y:y + self.crop_size, x:x + self.crop_size]
+        return torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+
+def get_image_shard(config_dict):
+    """Returns the ImageShard configured with image_shard in datasets.conf, if
+    the caller has asked for shards by setting config_dict['shard_crop_size']"""
+    if not config_dict or not config_dict.get('image_shard') or \
+       'shard_crop_size' not in config_dict:
+        return None
+    path = config_dict['image_shard']
+    if not os.path.isabs(path):
+        path = os.path.join(config_dict.get('root_dir', ''), path)
+    return ImageShard(path, config_dict['shard_crop_size'])
+
+
+def shard_batch_transform(images, flip=True):
+    """Converts a batch of uint8 images from an ImageShard to normalized floats,
+    flipping a random half of them horizontally, like the per-sample
+    RandomHorizontalFlip, ToTensor and Normalize transforms of train.py"""
+    images = images.float().div_(255)
+    if flip:
+        flipped = torch.rand(images.shape[0], device=images.device) < 0.5
+        images = torch.where(flipped.view(-1, 1, 1, 1), images.flip(3), images)
+    mean = images.new_tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = images.new_tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    return (images - mean) / std
 
 
 def get_dataset_class(cls_name):
@@ -1035,8 +1729,12 @@ def get_dataset_class(cls_name):
 
 def get_loader(dataset_configs, vocab, transform, batch_size, shuffle, num_workers,
                ext_feature_sets=None, skip_images=False, iter_over_images=False,
-               _collate_fn=collate_fn, verbose=False):
-    """Returns torch.utils.data.DataLoader for user-specified dataset."""
+               _collate_fn=collate_fn, verbose=False, bucket_size=0, max_tokens=None,
+               shared_features=False):
+    """Returns torch.utils.data.DataLoader for user-specified dataset.
+    Setting bucket_size or max_tokens enables length bucketing of the shuffled
+    batches, see BucketBatchSampler.  If shared_features is set, .npy external
+    features are loaded into shared memory instead of being memory-mapped."""
 
     datasets = []
 
@@ -1052,14 +1750,15 @@ def get_loader(dataset_configs, vocab, transform, batch_size, shuffle, num_worke
         dims = None
         if ext_feature_sets is not None:
             # Construct external feature loaders for each of the specified feature sets
-            loaders_and_dims = [ExternalFeature.loaders(fs, fpath) for fs in ext_feature_sets]
+            loaders_and_dims = [ExternalFeature.loaders(fs, fpath, shared_features)
+                                for fs in ext_feature_sets]
 
             # List of tuples into two lists...
             loaders, dims = zip(*loaders_and_dims)
 
-        # Unzip training images to /tmp/data if image_dir argument points to zip file:
+        # Read the images directly from the archive if image_dir points to a zip file:
         if isinstance(root, str) and zipfile.is_zipfile(root):
-            root = unzip_image_dir(root)
+            root = ZipImageDir(root)
 
         if verbose:
             print((' root={!s:s}\n json_file={!s:s}\n vocab={!s:s}\n subset={!s:s}\n'+
@@ -1087,11 +1786,25 @@ def get_loader(dataset_configs, vocab, transform, batch_size, shuffle, num_worke
     # captions: a tensor of shape (batch_size, padded_length).
     # lengths: a list indicating valid length for each caption.
     # length is (batch_size).
-    data_loader = torch.utils.data.DataLoader(dataset=dataset,
-                                              batch_size=batch_size,
-                                              shuffle=shuffle,
-                                              num_workers=num_workers,
-                                              collate_fn=_collate_fn)
+    if shuffle and (bucket_size or max_tokens):
+        batch_sampler = BucketBatchSampler(caption_lengths(dataset), batch_size,
+                                           bucket_size=bucket_size or 100,
+                                           max_tokens=max_tokens)
+        print('Using length bucketing with {} batches per bucket{}'.format(
+            batch_sampler.bucket_size,
+            ', max {} tokens per batch'.format(max_tokens) if max_tokens else ''))
+        data_loader = torch.utils.data.DataLoader(dataset=dataset,
+                                                  batch_sampler=batch_sampler,
+                                                  num_workers=num_workers,
+                                                  collate_fn=_collate_fn,
+                                                  worker_init_fn=worker_init_fn)
+    else:
+        data_loader = torch.utils.data.DataLoader(dataset=dataset,
+                                                  batch_size=batch_size,
+                                                  shuffle=shuffle,
+                                                  num_workers=num_workers,
+                                                  collate_fn=_collate_fn,
+                                                  worker_init_fn=worker_init_fn)
     return data_loader, dims
 
 
@@ -10,7 +10,10 @@
 # Authors: Ramakrishna Vedantam <vrama91@vt.edu> and
 # Tsung-Yi Lin <tl483@cornell.edu>
 
-from .cider_scorer import CiderScorer
+import numpy as np
+
+from .cider_scorer import (CiderScorer, CiderReferences, CiderAccumulator,
+                           ShardedCiderScorer, load_document_frequency)
 
 
 class Cider:
@@ -18,27 +21,62 @@ class Cider:
     Main Class to compute the CIDEr metric
 
     """
-    def __init__(self, n=4, df="corpus"):
+    # Smaller sets of images are scored faster in one process
+    parallel_threshold = 20000
+
+    def __init__(self, n=4, df="corpus", num_workers=None):
         """
         Initialize the CIDEr scoring function
         : param n (int): n-gram size
         : param df (string): specifies where to get the IDF values from
-                    takes values 'corpus', 'coco-train'
+                    takes values 'corpus', or the path of a document
+                    frequency table built with build_cider_df.py, which
+                    is also looked for in data/, e.g. 'coco-val-df'
+        : param num_workers (int): number of processes for scoring at
+                    least parallel_threshold images, by default up to 8,
+                    0 or 1 to always score in one process
         : return: None
         """
         # set cider to sum over 1 to 4-grams
         self._n = n
         self._df = df
+        self._num_workers = num_workers
+        # loaded at the first call of compute_score()
+        self._document_frequency = None
+
+    def document_frequency(self):
+        if self._df != "corpus" and self._document_frequency is None:
+            self._document_frequency = load_document_frequency(self._df)
+        return self._document_frequency
 
     def compute_score(self, gts, res):
         """
         Main function to compute CIDEr score
-        : param  gts (dict) : {image:tokenized reference sentence}
+        : param  gts (dict) : {image:tokenized reference sentence}, or
+                              CiderReferences from references()
         : param res (dict)  : {image:tokenized candidate sentence}
         : return: cider (float) : computed CIDEr score for the corpus
         """
 
+        if isinstance(gts, CiderReferences):
+            return self._compute_score_references(gts, res)
+
+        sharded = self._sharded_scorer(len(res))
+        if sharded is not None:
+            test = []
+            refs = []
+            for image_id, hypo in res.items():
+                assert(type(hypo) is list)
+                assert(len(hypo) == 1)
+                test.append(hypo[0])
+                refs.append(gts[image_id])
+            scores = sharded.compute_cider(test, refs, self._df, self._ref_len(),
+                                           self.document_frequency())
+            return np.mean(scores), scores
+
         cider_scorer = CiderScorer(n=self._n)
+        if self._df != "corpus":
+            cider_scorer.document_frequency = self.document_frequency()
 
         for image_id, hypo in res.items():
             ref = gts[image_id]
@@ -54,5 +92,55 @@ class Cider:
 
         return score, scores
 
+    def references(self, gts):
+        """
+        Index of the reference sentences, which can be given as gts to
+        compute_score() to score several sets of candidates for the same
+        references without processing the references again
+        : param  gts (dict) : {image:tokenized reference sentence}
+        : return: CiderReferences
+        """
+        return CiderReferences.build(list(gts.values()), n=self._n,
+                                     image_ids=list(gts.keys()))
+
+    def accumulator(self):
+        """
+        CiderAccumulator for scoring the candidates batch by batch, with the
+        same document frequencies as compute_score()
+        : return: CiderAccumulator
+        """
+        return CiderAccumulator(self._n, self._df, self._ref_len(), self.document_frequency())
+
+    def _compute_score_references(self, refs, res):
+        assert refs.n == self._n
+        images = []
+        test = []
+        for image_id, hypo in res.items():
+            # Sanity check.
+            assert(type(hypo) is list)
+            assert(len(hypo) == 1)
+            images.append(refs.image_index[image_id])
+            test.append(hypo[0])
+
+        sharded = self._sharded_scorer(len(test))
+        if sharded is not None:
+            scores = sharded.compute_cider_references(refs, test, images, self._df,
+                                                      self._ref_len(),
+                                                      self.document_frequency())
+        else:
+            scores = refs.compute_cider(test, images, self._df, self._ref_len(),
+                                        self.document_frequency())
+        return np.mean(scores), scores
+
+    def _ref_len(self):
+        # DocumentFrequency tables and the "corpus" mode have their own
+        return np.log(float(40504)) if self._df == "coco-val-df" else None
+
+    def _sharded_scorer(self, num_images):
+        sharded = ShardedCiderScorer(self._n, self._num_workers)
+        if sharded.num_workers > 1 and num_images >= self.parallel_threshold:
+            return sharded
+        return None
+
     def method(self):
         return "CIDEr"
@@ -4,9 +4,10 @@
 
 import copy
 import pickle
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from itertools import chain
 import numpy as np
-import math
+import multiprocessing
 import os
 
 def precook(s, n=4, out=False):
@@ -45,6 +46,771 @@ def cook_test(test, n=4):
     '''
     return precook(test, n, True)
 
+# Sparse n-gram vectors of a list of sentences: the sentence index, n-gram id,
+# n-gram length - 1 and count of each entry
+SparseVectors = namedtuple('SparseVectors', 'sentence, ngram, order, count')
+
+
+class NgramIndex(object):
+    '''
+    Interns words and n-grams to integer ids, so that the n-gram counts of
+    many sentences can be computed with numpy.  The id of an n-gram is found
+    from the id of its first n-1 words and the id of its last word, so all
+    the n-grams of a given length are looked up in one go.  New n-grams are
+    added as they are seen, so the ids stay the same for later sentences.
+    '''
+
+    def __init__(self, n=4):
+        self.n = n
+        self.word_ids = {}
+        self.words = []
+        # Sorted keys (prefix id + 1) << 32 | word id and the n-gram ids
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.key_ids = np.zeros(0, dtype=np.int64)
+        # Prefix id (-1 for unigrams) and last word id of each n-gram id
+        self.prefix = np.zeros(0, dtype=np.int64)
+        self.last_word = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.prefix)
+
+    def copy(self):
+        '''A copy, to which n-grams can be added without changing this index'''
+        new = copy.copy(self)
+        new.word_ids = dict(self.word_ids)
+        new.words = list(self.words)
+        return new
+
+    def _find(self, keys):
+        '''Ids of the n-grams with the given keys, -1 for unknown ones'''
+        pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = self.keys[pos] == keys if len(self.keys) > 0 else np.zeros(len(keys), bool)
+        return np.where(found, self.key_ids[pos] if len(self.keys) > 0 else -1, -1)
+
+    def _intern(self, prefix, word):
+        keys, inverse = np.unique(((prefix + 1) << 32) | word, return_inverse=True)
+        ids = self._find(keys)
+        found = ids >= 0
+        if not found.all():
+            # keys are unique and sorted, so are the new ones
+            new_keys = keys[~found]
+            ids[~found] = np.arange(len(self), len(self) + len(new_keys))
+            self.prefix = np.concatenate([self.prefix, (new_keys >> 32) - 1])
+            self.last_word = np.concatenate([self.last_word, new_keys & 0xffffffff])
+            pos = np.searchsorted(self.keys, new_keys)
+            self.keys = np.insert(self.keys, pos, new_keys)
+            self.key_ids = np.insert(self.key_ids, pos, ids[~found])
+        return ids[inverse.ravel()]
+
+    def lookup(self, other):
+        '''
+        Ids in this index of all the n-grams of another NgramIndex, -1 for
+        those not in this index
+        '''
+        word_ids = np.array([self.word_ids.get(w, -1) for w in other.words], dtype=np.int64)
+        ids = np.full(len(other), -1, dtype=np.int64)
+        # The prefix of an n-gram is always added before it, so the n-grams of
+        # each length are looked up after their prefixes
+        unigram = other.prefix < 0
+        done = np.zeros(len(other), dtype=bool)
+        for k in range(other.n):
+            ready = np.flatnonzero(~done & (unigram | done[other.prefix]))
+            prefix = np.where(unigram[ready], -1, ids[other.prefix[ready]])
+            word = word_ids[other.last_word[ready]]
+            known = (word >= 0) & (unigram[ready] | (prefix >= 0))
+            ids[ready[known]] = self._find(((prefix[known] + 1) << 32) | word[known])
+            done[ready] = True
+        return ids
+
+    def add(self, other):
+        '''
+        Interns all the n-grams of another NgramIndex, returns their ids in
+        this index
+        '''
+        for w in other.words:
+            if w not in self.word_ids:
+                self.word_ids[w] = len(self.words)
+                self.words.append(w)
+        word_ids = np.array([self.word_ids[w] for w in other.words], dtype=np.int64)
+        ids = np.full(len(other), -1, dtype=np.int64)
+        unigram = other.prefix < 0
+        done = np.zeros(len(other), dtype=bool)
+        for k in range(other.n):
+            ready = np.flatnonzero(~done & (unigram | done[other.prefix]))
+            prefix = np.where(unigram[ready], -1, ids[other.prefix[ready]])
+            ids[ready] = self._intern(prefix, word_ids[other.last_word[ready]])
+            done[ready] = True
+        return ids
+
+    def ngram(self, i):
+        '''The n-gram with id i as a tuple of words, like in precook()'''
+        words = []
+        while i >= 0:
+            words.append(self.words[self.last_word[i]])
+            i = self.prefix[i]
+        return tuple(reversed(words))
+
+    def vectors(self, sentences):
+        '''
+        Counts the n-grams of each sentence like precook(), returns them as
+        SparseVectors.  The entries of a sentence are in the same order as the
+        items of the dict of precook(): by n-gram length, and by the position
+        of the first occurrence.
+        '''
+        tokens = [sentence.split() for sentence in sentences]
+        words = list(chain.from_iterable(tokens))
+        for w in dict.fromkeys(words):
+            if w not in self.word_ids:
+                self.word_ids[w] = len(self.words)
+                self.words.append(w)
+        word = np.fromiter(map(self.word_ids.__getitem__, words), dtype=np.int64,
+                           count=len(words))
+
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        sentence = np.repeat(np.arange(len(tokens), dtype=np.int64), lengths)
+        word_start = np.cumsum(lengths) - lengths
+        position = np.arange(len(words)) - np.repeat(word_start, lengths)
+        # number of n-grams of each length k in each sentence, and where the
+        # n-grams of length k of each sentence start in the list of entries
+        num_ngrams = np.maximum(lengths[None, :] - np.arange(self.n)[:, None], 0)
+        entry_start = np.cumsum(num_ngrams.T.ravel()).reshape(-1, self.n).T - num_ngrams
+
+        # n-grams of each length k starting at each word where they fit,
+        # entries sorted by sentence, length and position
+        num_entries = int(num_ngrams.sum())
+        e_sentence = np.empty(num_entries, dtype=np.int64)
+        e_order = np.empty(num_entries, dtype=np.int64)
+        e_ngram = np.empty(num_entries, dtype=np.int64)
+        ids = np.full(len(words), -1, dtype=np.int64)
+        for k in range(self.n):
+            start = np.flatnonzero(position < lengths[sentence] - k)
+            ids[start] = self._intern(ids[start], word[start + k])
+            entry = entry_start[k, sentence[start]] + position[start]
+            e_sentence[entry] = sentence[start]
+            e_order[entry] = k
+            e_ngram[entry] = ids[start]
+
+        # count the occurrences of each n-gram of a sentence, keeping the first
+        _, first, inverse, counts = np.unique(e_sentence * len(self) + e_ngram,
+                                              return_index=True, return_inverse=True,
+                                              return_counts=True)
+        is_first = np.zeros(num_entries, dtype=bool)
+        is_first[first] = True
+        return SparseVectors(e_sentence[is_first], e_ngram[is_first], e_order[is_first],
+                             counts[inverse.ravel()[is_first]].astype(np.float64))
+
+
+def vector_norms(vectors, values, num_sentences, n):
+    '''
+    Norms of the n-gram vectors of each length of each sentence, as a
+    (num_sentences x n) array
+    '''
+    norms = np.bincount(vectors.sentence * n + vectors.order, weights=values * values,
+                        minlength=num_sentences * n)
+    return np.sqrt(norms).reshape(num_sentences, n)
+
+
+class DocumentFrequency(object):
+    '''
+    Document frequencies of the n-grams of the references of a dataset, i.e.
+    the number of images with an n-gram in any of their references.  Scoring
+    with fixed document frequencies instead of those of the scored images
+    gives the same score for an image however the images are split for
+    scoring.  The table is stored as .npy files next to each other, which
+    load() memory-maps.
+    '''
+
+    version = 1
+    fields = ['words', 'keys', 'key_ids', 'df']
+
+    def __init__(self, n, num_images, arrays):
+        self.n = n
+        self.num_images = num_images
+        # log of the number of images, in place of that of the scored images
+        self.ref_len = np.log(float(num_images))
+        self.index = NgramIndex(n)
+        self.index.words = arrays['words']
+        self.index.keys = arrays['keys']
+        self.index.key_ids = arrays['key_ids']
+        self.df = arrays['df']
+        self._word_ids = None
+
+    @classmethod
+    def build(cls, refs, images=None):
+        '''
+        Document frequencies of all the images of CiderReferences refs, or
+        of the given images only
+        '''
+        return cls(refs.n, refs.num_images if images is None else len(images),
+                   {'words': np.array(refs.index.words), 'keys': refs.index.keys,
+                    'key_ids': refs.index.key_ids,
+                    'df': refs.corpus_document_frequency(images).astype(np.int32)})
+
+    @classmethod
+    def merge(cls, shards):
+        '''
+        Document frequencies of all the images of several CiderReferences of
+        disjoint sets of images
+        :param shards: list of CiderReferences and the document frequencies
+                       of their n-grams from corpus_document_frequency()
+        '''
+        index = NgramIndex(shards[0][0].n)
+        df = np.zeros(0, dtype=np.int64)
+        for refs, refs_df in shards:
+            ids = index.add(refs.index)
+            df = np.append(df, np.zeros(len(index) - len(df), dtype=np.int64))
+            # the n-grams of an index are unique
+            df[ids] += refs_df.astype(np.int64)
+        return cls(index.n, sum(refs.num_images for refs, _ in shards),
+                   {'words': np.array(index.words), 'keys': index.keys,
+                    'key_ids': index.key_ids, 'df': df.astype(np.int32)})
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(path + '.info.npy')
+
+    @classmethod
+    def load(cls, path):
+        version, n, num_images = np.load(path + '.info.npy').tolist()
+        assert version == cls.version, 'unsupported document frequency file ' + path
+        return cls(n, num_images, {f: np.load('{}.{}.npy'.format(path, f), mmap_mode='r')
+                                   for f in cls.fields})
+
+    def save(self, path):
+        # The info file is written last, and signals that the table is complete
+        np.save(path + '.words.npy', self.index.words)
+        np.save(path + '.keys.npy', self.index.keys)
+        np.save(path + '.key_ids.npy', self.index.key_ids)
+        np.save(path + '.df.npy', self.df)
+        np.save(path + '.info.npy', np.array([self.version, self.n, self.num_images]))
+
+    def lookup(self, index):
+        '''Document frequencies of all the n-grams of NgramIndex index'''
+        if self._word_ids is None:
+            self._word_ids = {w: i for i, w in enumerate(self.index.words.tolist())}
+            self.index.word_ids = self._word_ids
+        ids = self.index.lookup(index)
+        df = np.zeros(len(ids))
+        df[ids >= 0] = self.df[ids[ids >= 0]]
+        return df
+
+
+def load_document_frequency(df_mode):
+    '''
+    Document frequencies for CIDEr: a DocumentFrequency table with the path
+    prefix df_mode or data/<df_mode>, or a pickled dict of n-gram tuples in
+    data/<df_mode>.p
+    '''
+    for path in (df_mode, os.path.join('data', df_mode)):
+        if DocumentFrequency.exists(path):
+            return DocumentFrequency.load(path)
+    with open(os.path.join('data', df_mode + '.p'), 'rb') as f:
+        return pickle.load(f)
+
+
+class CiderReferences(object):
+    '''
+    The reference side of CIDEr for a fixed set of images: the n-gram
+    vectors of the reference sentences and the images in which each n-gram
+    occurs.  Built once, it can score any number of sets of hypotheses, e.g.
+    after every validation epoch, without processing the references again.
+    It can be saved to and loaded from a .npz file.
+
+    The tf-idf vectors of all hypotheses and references are kept as sparse
+    entries of interned n-gram ids, see NgramIndex.  The sums of the norms,
+    dot products and per-image scores are done with np.bincount(), which
+    adds the values in the order they are given.  That is the order of the
+    loops of the original implementation with a dict per sentence, which
+    tests/test_cider.py checks, so the scores are equal bit for bit.
+    '''
+
+    version = 1
+    fields = ['n', 'words', 'keys', 'key_ids', 'prefix', 'last_word', 'sentence', 'ngram',
+              'order', 'count', 'num_refs', 'image_ngrams']
+
+    def __init__(self, arrays, image_ids=None):
+        self.n = int(arrays['n'])
+        self.index = NgramIndex(self.n)
+        self.index.words = list(arrays['words'])
+        self.index.word_ids = {w: i for i, w in enumerate(self.index.words)}
+        for f in ('keys', 'key_ids', 'prefix', 'last_word'):
+            setattr(self.index, f, arrays[f])
+        self.vectors = SparseVectors(arrays['sentence'], arrays['ngram'], arrays['order'],
+                                     arrays['count'])
+        self.num_ngrams = len(self.index)
+        # image of each reference sentence, and the index of its first one
+        self.num_refs = arrays['num_refs']
+        self.num_images = len(self.num_refs)
+        self.ref_image = np.repeat(np.arange(self.num_images), self.num_refs)
+        self.ref_start = np.cumsum(self.num_refs) - self.num_refs
+        # sorted image * num_ngrams + n-gram keys of the n-grams of each image
+        self.image_ngrams = arrays['image_ngrams']
+
+        # the reference entries sorted by reference * num_ngrams + n-gram
+        ref_keys = self.vectors.sentence * self.num_ngrams + self.vectors.ngram
+        self.ref_order = np.argsort(ref_keys)
+        self.ref_keys = ref_keys[self.ref_order]
+
+        self.image_ids = image_ids
+        if image_ids is not None:
+            self.image_index = {image_id: i for i, image_id in enumerate(image_ids)}
+        # tf-idf of the references with the corpus document frequencies of all
+        # images, computed at the first call of compute_cider()
+        self._corpus_tfidf = None
+        # same for the last DocumentFrequency table
+        self._table_tfidf = None
+
+    @classmethod
+    def build(cls, refs, n=4, image_ids=None):
+        '''
+        :param refs: list of lists of reference sentences of each image
+        :param image_ids: optional list of the ids of the images, for
+                          scoring them with Cider.compute_score()
+        '''
+        index = NgramIndex(n)
+        vectors = index.vectors([ref for image_refs in refs for ref in image_refs])
+        num_refs = np.fromiter(map(len, refs), dtype=np.int64, count=len(refs))
+        return cls.from_vectors(index, vectors, num_refs, image_ids)
+
+    @classmethod
+    def from_vectors(cls, index, vectors, num_refs, image_ids=None):
+        '''
+        :param index: NgramIndex of the n-grams of the references
+        :param vectors: SparseVectors of all the reference sentences
+        :param num_refs: array of the number of references of each image
+        '''
+        ref_image = np.repeat(np.arange(len(num_refs)), num_refs)
+        image_ngrams = np.sort(ref_image[vectors.sentence] * len(index) + vectors.ngram)
+        image_ngrams = image_ngrams[np.append(True, image_ngrams[1:] != image_ngrams[:-1])]
+
+        arrays = {'n': index.n, 'words': index.words, 'keys': index.keys,
+                  'key_ids': index.key_ids, 'prefix': index.prefix,
+                  'last_word': index.last_word, 'num_refs': num_refs,
+                  'image_ngrams': image_ngrams}
+        arrays.update(vectors._asdict())
+        return cls(arrays, image_ids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            if int(arrays['version']) != cls.version:
+                return None
+            image_ids = arrays['image_ids'].tolist() if 'image_ids' in arrays else None
+            return cls({f: arrays[f].tolist() if f == 'words' else arrays[f]
+                        for f in cls.fields}, image_ids)
+
+    def save(self, path):
+        arrays = {'version': self.version, 'n': self.n, 'words': np.array(self.index.words),
+                  'num_refs': self.num_refs, 'image_ngrams': self.image_ngrams}
+        for f in ('keys', 'key_ids', 'prefix', 'last_word'):
+            arrays[f] = getattr(self.index, f)
+        arrays.update(self.vectors._asdict())
+        if self.image_ids is not None:
+            arrays['image_ids'] = np.array(self.image_ids)
+        np.savez(path, **arrays)
+
+    def subset(self, images):
+        '''
+        CiderReferences of the given images only, in the given order, with
+        the n-grams of their references only
+        '''
+        images = np.asarray(images, dtype=np.int64)
+        num_refs = self.num_refs[images]
+        refs = (np.repeat(self.ref_start[images] - np.cumsum(num_refs) + num_refs, num_refs) +
+                np.arange(num_refs.sum()))
+        ref_map = np.full(len(self.ref_image), -1)
+        ref_map[refs] = np.arange(len(refs))
+
+        # the entries of each reference stay together and in the same order
+        sentence = ref_map[self.vectors.sentence]
+        entries = np.flatnonzero(sentence >= 0)
+        entries = entries[np.argsort(sentence[entries], kind='stable')]
+
+        # The prefixes of the n-grams of a sentence are n-grams of the same
+        # sentence, so the n-grams of the references are all that is needed
+        # for looking n-grams up.  They are renumbered in the same order.
+        used = np.unique(self.vectors.ngram[entries])
+        prefix = self.index.prefix[used]
+        prefix = np.where(prefix < 0, -1, np.searchsorted(used, prefix))
+        used_words = np.unique(self.index.last_word[used])
+        last_word = np.searchsorted(used_words, self.index.last_word[used])
+        keys = ((prefix + 1) << 32) | last_word
+        key_ids = np.argsort(keys, kind='stable')
+
+        image_map = np.full(self.num_images, -1)
+        image_map[images] = np.arange(len(images))
+        image_ngrams = self.image_ngrams
+        image = image_map[image_ngrams // self.num_ngrams]
+        image_ngrams = np.sort(image[image >= 0] * len(used) +
+                               np.searchsorted(used, image_ngrams[image >= 0] % self.num_ngrams))
+
+        arrays = {'n': self.n, 'words': [self.index.words[w] for w in used_words],
+                  'keys': keys[key_ids], 'key_ids': key_ids, 'prefix': prefix,
+                  'last_word': last_word, 'sentence': sentence[entries],
+                  'ngram': np.searchsorted(used, self.vectors.ngram[entries]),
+                  'order': self.vectors.order[entries], 'count': self.vectors.count[entries],
+                  'num_refs': num_refs, 'image_ngrams': image_ngrams}
+        image_ids = (None if self.image_ids is None else
+                     [self.image_ids[i] for i in images])
+        return CiderReferences(arrays, image_ids)
+
+    def corpus_document_frequency(self, images=None):
+        '''
+        Number of images with each n-gram in any of their references, counting
+        only the given images if images is not None
+        '''
+        image_ngrams = self.image_ngrams
+        if images is not None:
+            selected = np.zeros(self.num_images, dtype=bool)
+            selected[images] = True
+            image_ngrams = image_ngrams[selected[image_ngrams // self.num_ngrams]]
+        return np.bincount(image_ngrams % self.num_ngrams,
+                           minlength=self.num_ngrams).astype(np.float64)
+
+    def _tfidf(self, log_df, ref_len):
+        ref_vec = self.vectors.count * (ref_len - log_df[self.vectors.ngram])
+        return ref_vec, vector_norms(self.vectors, ref_vec, len(self.ref_image), self.n)
+
+    def compute_cider(self, test, images=None, df_mode="corpus", ref_len=None,
+                      document_frequency=None):
+        '''
+        CIDEr scores of hypotheses for the references of some of the images.
+        The corpus document frequencies are computed over the scored images
+        only, like when scoring them with CiderScorer.
+        :param test: list of hypothesis sentences
+        :param images: indices of the images of the hypotheses, by default
+                       one hypothesis for each image in order
+        :param ref_len: log of the number of images of the document
+                        frequencies, computed for the "corpus" mode and
+                        taken from DocumentFrequency tables
+        :param document_frequency: DocumentFrequency or dict of the document
+                                   frequencies of each n-gram tuple if
+                                   df_mode is not "corpus"
+        :return: array of the scores of each hypothesis
+        '''
+        # the n-grams of the hypotheses which are not in the references get new
+        # ids after those of the references, and never match them
+        index = self.index.copy()
+        return self.compute_cider_vectors(index.vectors(test), len(test), index, images,
+                                          df_mode, ref_len, document_frequency)
+
+    def compute_cider_vectors(self, hyp, num_test, index, images=None, df_mode="corpus",
+                              ref_len=None, document_frequency=None):
+        '''
+        Same as compute_cider() for the SparseVectors hyp of num_test
+        hypotheses, with n-gram ids of NgramIndex index, which contains the
+        n-grams of the references with the same ids
+        '''
+        all_images = images is None or len(images) == self.num_images
+        images = np.arange(num_test) if images is None else np.asarray(images, dtype=np.int64)
+        num_ngrams = self.num_ngrams
+
+        if df_mode == "corpus":
+            ref_len = np.log(float(len(images)))
+            if all_images and self._corpus_tfidf is not None:
+                log_df, ref_vec, ref_norm = self._corpus_tfidf
+            else:
+                df = self.corpus_document_frequency(None if all_images else images)
+                assert(len(images) >= df.max(initial=0))
+                log_df = np.log(np.maximum(1.0, df))
+                ref_vec, ref_norm = self._tfidf(log_df, ref_len)
+                if all_images:
+                    self._corpus_tfidf = log_df, ref_vec, ref_norm
+            log_df = np.append(log_df, np.zeros(len(index) - num_ngrams))
+        elif isinstance(document_frequency, DocumentFrequency):
+            ref_len = document_frequency.ref_len
+            log_df = np.log(np.maximum(1.0, document_frequency.lookup(index)))
+            # the tf-idf of the references only depends on the table
+            if self._table_tfidf is not None and self._table_tfidf[0] is document_frequency:
+                ref_vec, ref_norm = self._table_tfidf[1:]
+            else:
+                ref_vec, ref_norm = self._tfidf(log_df, ref_len)
+                self._table_tfidf = document_frequency, ref_vec, ref_norm
+        else:
+            df = np.array([document_frequency.get(index.ngram(i), 0.0)
+                           for i in range(len(index))])
+            log_df = np.log(np.maximum(1.0, df))
+            ref_vec, ref_norm = self._tfidf(log_df, ref_len)
+
+        return self._score_tfidf(hyp, num_test, images, log_df, ref_len, ref_vec, ref_norm)
+
+    def _score_tfidf(self, hyp, num_test, images, log_df, ref_len, ref_vec, ref_norm):
+        '''
+        Scores of the hypotheses with the idf log_df of each n-gram, and the
+        reference tf-idf vectors and norms from _tfidf()
+        '''
+        num_ngrams = self.num_ngrams
+        hyp_vec = hyp.count * (ref_len - log_df[hyp.ngram])
+        hyp_norm = vector_norms(hyp, hyp_vec, num_test, self.n)
+
+        # Pair every hypothesis entry of an n-gram occurring in the references
+        # with each reference of its image, keeping the order of the hypothesis
+        # entries for each reference
+        hyp_entry = np.flatnonzero(hyp.ngram < num_ngrams)
+        hyp_image = images[hyp.sentence[hyp_entry]]
+        hyp_num_refs = self.num_refs[hyp_image]
+        entry = np.repeat(hyp_entry, hyp_num_refs)
+        ref = (np.repeat(self.ref_start[hyp_image] - np.cumsum(hyp_num_refs) + hyp_num_refs,
+                         hyp_num_refs) + np.arange(len(entry)))
+
+        # Look the pairs up among the reference entries by (reference, n-gram)
+        keys = ref * num_ngrams + hyp.ngram[entry]
+        pos = np.minimum(np.searchsorted(self.ref_keys, keys), max(len(self.ref_keys) - 1, 0))
+        found = (self.ref_keys[pos] == keys if len(self.ref_keys) > 0 else
+                 np.zeros(len(keys), bool))
+        entry, ref, pos = entry[found], ref[found], self.ref_order[pos[found]]
+
+        # cosine similarities of each reference and n-gram length, with the
+        # hypothesis of the image of the reference
+        val = np.bincount(ref * self.n + hyp.order[entry],
+                          weights=hyp_vec[entry] * ref_vec[pos],
+                          minlength=len(self.ref_image) * self.n).reshape(-1, self.n)
+        # without any matches, bincount() returns integers
+        val = val.astype(np.float64, copy=False)
+        image_hyp = np.full(self.num_images, -1)
+        image_hyp[images] = np.arange(len(images))
+        ref_hyp = image_hyp[self.ref_image]
+        ref_hyp_norm = np.where(ref_hyp[:, None] >= 0, hyp_norm[ref_hyp], 0.0)
+        nonzero = (ref_hyp_norm != 0) & (ref_norm != 0)
+        val[nonzero] /= (ref_hyp_norm * ref_norm)[nonzero]
+        assert(not np.isnan(val).any())
+
+        score = np.stack([np.bincount(self.ref_image, weights=val[:, n],
+                                      minlength=self.num_images)[images]
+                          for n in range(self.n)], 1)
+        # mean of ngram scores, divided by number of references, times 10
+        scores = np.mean(score, axis=1)
+        scores /= self.num_refs[images]
+        scores *= 10.0
+        return scores
+
+
+def _build_shard(args):
+    '''
+    Map step of ShardedCiderScorer: the CiderReferences of a shard of
+    images, and their document frequencies in the "corpus" mode
+    '''
+    refs, n, corpus = args
+    shard = CiderReferences.build(refs, n)
+    return shard, shard.corpus_document_frequency() if corpus else None
+
+
+def _score_shard(args):
+    '''Scores of the hypotheses of the images of a shard, in order'''
+    shard, test, ref_len, document_frequency = args
+    # the document frequencies are always given to the shards
+    return shard.compute_cider(test, df_mode="fixed", ref_len=ref_len,
+                               document_frequency=document_frequency)
+
+
+class ShardedCiderScorer(object):
+    '''
+    Computes the same CIDEr scores as CiderReferences.compute_cider() with a
+    pool of processes, each scoring a shard of the images.  In the "corpus"
+    mode, the document frequencies of all the scored images are first merged
+    from those of each shard into a DocumentFrequency table, with which each
+    shard is then scored.  The scores are equal bit for bit to those of
+    scoring all the images in one process.
+    '''
+
+    def __init__(self, n=4, num_workers=None):
+        self.n = n
+        if num_workers is None:
+            num_workers = min(8, multiprocessing.cpu_count())
+        self.num_workers = num_workers
+
+    def _shards(self, num_images):
+        bounds = np.linspace(0, num_images, self.num_workers + 1).astype(np.int64)
+        return [slice(bounds[i], bounds[i + 1]) for i in range(self.num_workers)
+                if bounds[i] < bounds[i + 1]]
+
+    def compute_cider(self, test, refs, df_mode="corpus", ref_len=None,
+                      document_frequency=None):
+        '''
+        :param test: list of hypothesis sentences
+        :param refs: list of lists of reference sentences of each image
+        :param ref_len, document_frequency: as in
+                                            CiderReferences.compute_cider()
+        :return: array of the scores of each hypothesis
+        '''
+        shards = self._shards(len(test))
+        corpus = df_mode == "corpus"
+        with multiprocessing.Pool(self.num_workers) as pool:
+            built = pool.map(_build_shard, [(refs[s], self.n, corpus) for s in shards])
+            if corpus:
+                document_frequency = DocumentFrequency.merge(built)
+            scores = pool.map(_score_shard, [(shard, test[s], ref_len, document_frequency)
+                                             for (shard, _), s in zip(built, shards)])
+        return np.concatenate(scores)
+
+    def compute_cider_references(self, refs, test, images, df_mode="corpus", ref_len=None,
+                                 document_frequency=None):
+        '''
+        Same as refs.compute_cider(test, images, ...) for CiderReferences
+        refs, whose document frequencies are already known
+        '''
+        images = np.asarray(images, dtype=np.int64)
+        shards = self._shards(len(test))
+        if df_mode == "corpus":
+            document_frequency = DocumentFrequency.build(refs, images)
+        with multiprocessing.Pool(self.num_workers) as pool:
+            scores = pool.map(_score_shard, [(refs.subset(images[s]), test[s], ref_len,
+                                              document_frequency) for s in shards])
+        return np.concatenate(scores)
+
+
+def _compact_vectors(vectors, ids):
+    '''SparseVectors with the n-gram ids mapped through ids, in small dtypes'''
+    return SparseVectors(vectors.sentence.astype(np.int32), ids[vectors.ngram].astype(np.int32),
+                         vectors.order.astype(np.int8), vectors.count.astype(np.int32))
+
+
+def _join_vectors(vectors, num_sentences):
+    '''SparseVectors of the sentences of all the SparseVectors in vectors'''
+    offsets = np.cumsum(num_sentences) - num_sentences
+    return SparseVectors(
+        np.concatenate([v.sentence + o for v, o in zip(vectors, offsets)]).astype(np.int64),
+        np.concatenate([v.ngram for v in vectors]).astype(np.int64),
+        np.concatenate([v.order for v in vectors]).astype(np.int64),
+        np.concatenate([v.count for v in vectors]).astype(np.float64))
+
+
+class CiderAccumulator(object):
+    '''
+    CIDEr of hypotheses added batch by batch, e.g. while they are generated.
+
+    The rows of an image may come in several batches, as in datasets with a
+    row per reference caption.  Like Cider.compute_score() on dicts built
+    row by row, such an image is scored once, with the references of all
+    its rows in order and the hypothesis of its last row.
+
+    Only the n-gram vectors of the sentences are kept, and finish() scores
+    all the images from them, which gives the same scores as CiderScorer.
+    The scores of a batch are computed when it is added with the rows of
+    the batch only, and in the "corpus" mode with the document frequencies
+    of the batches added so far.  They are final only with fixed document
+    frequencies, for images which do not come back in a later batch.
+    '''
+
+    def __init__(self, n=4, df_mode="corpus", ref_len=None, document_frequency=None):
+        self.n = n
+        self.df_mode = df_mode
+        self.ref_len = ref_len
+        self.document_frequency = document_frequency
+        # image ids in the order of their first row, and their positions
+        self.image_ids = []
+        self.image_index = {}
+        # True once an image has come back in a later batch
+        self.repeated = False
+        # latest score of each image
+        self.scores = np.zeros(0)
+        self.total = 0.0
+        # all the n-grams, and for the "corpus" mode the number of images of
+        # each batch with each n-gram in their references, summed
+        self.index = NgramIndex(n)
+        self.df = np.zeros(0, dtype=np.int64)
+        # vectors of each batch, and the image position of each of their
+        # reference and hypothesis sentences
+        self.ref_vectors = []
+        self.ref_images = []
+        self.hyp_vectors = []
+        self.hyp_images = []
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def score(self):
+        '''Mean of the latest scores of the images returned by add()'''
+        return self.total / max(len(self), 1)
+
+    def add(self, test, refs, image_ids=None):
+        '''
+        :param test: list of the hypothesis sentences of a batch of rows
+        :param refs: list of lists of reference sentences of each row
+        :param image_ids: optional list of the image id of each row, by
+                          default each row is a new image
+        :return: array of the scores of the images of the batch, in the
+                 order of their first row in the batch
+        '''
+        if image_ids is None:
+            image_ids = range(len(self), len(self) + len(test))
+        rows = {}
+        for image_id, hypothesis, image_refs in zip(image_ids, test, refs):
+            row = rows.setdefault(image_id, [None, []])
+            row[0] = hypothesis
+            row[1].extend(image_refs)
+        images = []
+        for image_id in rows:
+            if image_id in self.image_index:
+                self.repeated = True
+            else:
+                self.image_index[image_id] = len(self.image_ids)
+                self.image_ids.append(image_id)
+            images.append(self.image_index[image_id])
+        images = np.array(images, dtype=np.int64)
+        test = [hypothesis for hypothesis, _ in rows.values()]
+
+        batch = CiderReferences.build([image_refs for _, image_refs in rows.values()], self.n)
+        index = batch.index.copy()
+        hyp = index.vectors(test)
+        ids = self.index.add(index)
+        if self.df_mode != "corpus":
+            scores = batch.compute_cider_vectors(hyp, len(test), index, df_mode=self.df_mode,
+                                                 ref_len=self.ref_len,
+                                                 document_frequency=self.document_frequency)
+        else:
+            self.df = np.append(self.df, np.zeros(len(self.index) - len(self.df), dtype=np.int64))
+            self.df[ids[:batch.num_ngrams]] += batch.corpus_document_frequency().astype(np.int64)
+
+            ref_len = np.log(float(len(self)))
+            log_df = np.log(np.maximum(1.0, self.df[ids]))
+            ref_vec, ref_norm = batch._tfidf(log_df, ref_len)
+            scores = batch._score_tfidf(hyp, len(test), np.arange(len(test)), log_df, ref_len,
+                                        ref_vec, ref_norm)
+        self.ref_vectors.append(_compact_vectors(batch.vectors, ids))
+        self.ref_images.append(np.repeat(images, batch.num_refs).astype(np.int32))
+        self.hyp_vectors.append(_compact_vectors(hyp, ids))
+        self.hyp_images.append(images.astype(np.int32))
+
+        self.scores = np.append(self.scores, np.zeros(len(self) - len(self.scores)))
+        self.total += scores.sum() - self.scores[images].sum()
+        self.scores[images] = scores
+        return scores
+
+    def finish(self):
+        '''
+        :return: mean and array of the final scores of all the images, in the
+                 order of their first row
+        '''
+        if len(self) == 0 or (self.df_mode != "corpus" and not self.repeated):
+            return np.mean(self.scores), self.scores
+
+        # The reference sentences grouped by image, in the order they were
+        # added, and the entries sorted by sentence
+        ref_image = np.concatenate(self.ref_images)
+        refs = _join_vectors(self.ref_vectors, [len(i) for i in self.ref_images])
+        sentence = np.empty(len(ref_image), dtype=np.int64)
+        sentence[np.argsort(ref_image, kind='stable')] = np.arange(len(ref_image))
+        refs = refs._replace(sentence=sentence[refs.sentence])
+        refs = SparseVectors(*(a[np.argsort(refs.sentence, kind='stable')] for a in refs))
+        num_refs = np.bincount(ref_image, minlength=len(self))
+
+        # The last hypothesis of each image, as the hypothesis of its position
+        hyp_image = np.concatenate(self.hyp_images)
+        hyp = _join_vectors(self.hyp_vectors, [len(i) for i in self.hyp_images])
+        last = np.full(len(self), -1, dtype=np.int64)
+        np.maximum.at(last, hyp_image, np.arange(len(hyp_image)))
+        hyp = SparseVectors(*(a[last[hyp_image[hyp.sentence]] == hyp.sentence] for a in hyp))
+        hyp = hyp._replace(sentence=hyp_image[hyp.sentence].astype(np.int64))
+
+        scores = CiderReferences.from_vectors(self.index, refs, num_refs).compute_cider_vectors(
+            hyp, len(self), self.index, df_mode=self.df_mode, ref_len=self.ref_len,
+            document_frequency=self.document_frequency)
+        self.scores = scores
+        self.total = scores.sum()
+        return np.mean(scores), scores
+
+
 class CiderScorer(object):
     """CIDEr scorer.
     """
@@ -52,16 +818,16 @@ class CiderScorer(object):
     def copy(self):
         ''' copy the refs.'''
         new = CiderScorer(n=self.n)
-        new.ctest = copy.copy(self.ctest)
-        new.crefs = copy.copy(self.crefs)
+        new.test = copy.copy(self.test)
+        new.refs = copy.copy(self.refs)
         return new
 
     def __init__(self, test=None, refs=None, n=4, sigma=6.0):
         ''' singular instance '''
         self.n = n
         self.sigma = sigma
-        self.crefs = []
-        self.ctest = []
+        self.refs = []
+        self.test = []
         self.document_frequency = defaultdict(float)
         self.cook_append(test, refs)
         self.ref_len = None
@@ -70,15 +836,21 @@ class CiderScorer(object):
         '''called by constructor and __iadd__ to avoid creating new instances.'''
 
         if refs is not None:
-            self.crefs.append(cook_refs(refs))
-            if test is not None:
-                self.ctest.append(cook_test(test)) ## N.B.: -1
-            else:
-                self.ctest.append(None) # lens of crefs and ctest have to match
+            # The sentences are cooked when computing the scores
+            self.refs.append(refs)
+            self.test.append(test) # lens of refs and test have to match
+
+    @property
+    def crefs(self):
+        return [cook_refs(refs) for refs in self.refs]
+
+    @property
+    def ctest(self):
+        return [cook_test(test) if test is not None else None for test in self.test]
 
     def size(self):
-        assert len(self.crefs) == len(self.ctest), "refs/test mismatch! %d<>%d" % (len(self.crefs), len(self.ctest))
-        return len(self.crefs)
+        assert len(self.refs) == len(self.test), "refs/test mismatch! %d<>%d" % (len(self.refs), len(self.test))
+        return len(self.refs)
 
     def __iadd__(self, other):
         '''add an instance (e.g., from another sentence).'''
@@ -87,8 +859,8 @@ class CiderScorer(object):
             ## avoid creating new CiderScorer instances
             self.cook_append(other[0], other[1])
         else:
-            self.ctest.extend(other.ctest)
-            self.crefs.extend(other.crefs)
+            self.test.extend(other.test)
+            self.refs.extend(other.refs)
 
         return self
     def compute_doc_freq(self):
@@ -105,93 +877,29 @@ class CiderScorer(object):
             # maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
 
     def compute_cider(self, df_mode="corpus"):
-        def counts2vec(cnts):
-            """
-            Function maps counts of ngram to vector of tfidf weights.
-            The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
-            The n-th entry of array denotes length of n-grams.
-            :param cnts:
-            :return: vec (array of dict), norm (array of float), length (int)
-            """
-            vec = [defaultdict(float) for _ in range(self.n)]
-            length = 0
-            norm = [0.0 for _ in range(self.n)]
-            for (ngram,term_freq) in cnts.items():
-                # give word count 1 if it doesn't appear in reference corpus
-                df = np.log(max(1.0, self.document_frequency[ngram]))
-                # ngram index
-                n = len(ngram)-1
-                # tf (term_freq) * idf (precomputed idf) for n-grams
-                vec[n][ngram] = float(term_freq)*(self.ref_len - df)
-                # compute norm for the vector.  the norm will be used for
-                # computing similarity
-                norm[n] += pow(vec[n][ngram], 2)
-
-                if n == 1:
-                    length += term_freq
-            norm = [np.sqrt(n) for n in norm]
-            return vec, norm, length
-
-        def sim(vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
-            '''
-            Compute the cosine similarity of two vectors.
-            :param vec_hyp: array of dictionary for vector corresponding to hypothesis
-            :param vec_ref: array of dictionary for vector corresponding to reference
-            :param norm_hyp: array of float for vector corresponding to hypothesis
-            :param norm_ref: array of float for vector corresponding to reference
-            :param length_hyp: int containing length of hypothesis
-            :param length_ref: int containing length of reference
-            :return: array of score for each n-grams cosine similarity
-            '''
-            delta = float(length_hyp - length_ref)
-            # measure consine similarity
-            val = np.array([0.0 for _ in range(self.n)])
-            for n in range(self.n):
-                # ngram
-                for (ngram,count) in vec_hyp[n].items():
-                    val[n] += vec_hyp[n][ngram] * vec_ref[n][ngram]
-
-                if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
-                    val[n] /= (norm_hyp[n]*norm_ref[n])
-
-                assert(not math.isnan(val[n]))
-            return val
-
-        # compute log reference length
+        '''
+        CIDEr scores of all images, computed with numpy arrays for all images
+        at once, see CiderReferences.
+        :return: list of the scores of each image
+        '''
+        refs = CiderReferences.build(self.refs, self.n)
         if df_mode == "corpus":
-            self.ref_len = np.log(float(len(self.crefs)))
+            self.ref_len = np.log(float(len(self.refs)))
+        elif isinstance(self.document_frequency, DocumentFrequency):
+            self.ref_len = self.document_frequency.ref_len
         elif df_mode == "coco-val-df":
-            # if coco option selected, use length of coco-val set
             self.ref_len = np.log(float(40504))
-
-        scores = []
-        for test, refs in zip(self.ctest, self.crefs):
-            # compute vector for test captions
-            vec, norm, length = counts2vec(test)
-            # compute vector for ref captions
-            score = np.array([0.0 for _ in range(self.n)])
-            for ref in refs:
-                vec_ref, norm_ref, length_ref = counts2vec(ref)
-                score += sim(vec, vec_ref, norm, norm_ref, length, length_ref)
-            # change by vrama91 - mean of ngram scores, instead of sum
-            score_avg = np.mean(score)
-            # divide by number of references
-            score_avg /= len(refs)
-            # multiply score by 10
-            score_avg *= 10.0
-            # append score of an image to the score list
-            scores.append(score_avg)
-        return scores
+        scores = refs.compute_cider(self.test, df_mode=df_mode, ref_len=self.ref_len,
+                                    document_frequency=self.document_frequency)
+        return list(scores)
 
     def compute_score(self, df_mode, option=None, verbose=0):
         # compute idf
         if df_mode == "corpus":
-            self.compute_doc_freq()
-            # assert to check document frequency
-            assert(len(self.ctest) >= max(self.document_frequency.values()))
-            # import json for now and write the corresponding files
-        else:
-            self.document_frequency = pickle.load(open(os.path.join('data', df_mode + '.p'),'r'))
+            # the document frequencies are computed by compute_cider()
+            pass
+        elif not self.document_frequency:
+            self.document_frequency = load_document_frequency(df_mode)
         # compute cider score
         score = self.compute_cider(df_mode)
         # debug
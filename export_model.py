@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""Exports a trained EncoderDecoder or SpatialAttentionEncoderDecoder model as a
+TorchScript module, which infer.py can run without the Python model classes.
+The module holds the CNN trunks of the internal features, the encoder and the
+greedy decoding loop, and the model parameters and vocabulary are stored in
+the same file.  The captions of the exported module are checked against those
+of the eager model on the first batches of the dataset."""
+
+import argparse
+import json
+import sys
+
+import torch
+from torchvision import transforms
+
+from vocabulary import Vocabulary  # (Needed to handle Vocabulary pickle)
+from data_loader import get_loader, DatasetParams
+from model import (ModelParams, EncoderDecoder, SpatialAttentionEncoderDecoder,
+                   ScriptableEncoderDecoder)
+
+
+def params_to_json(params):
+    """The ModelParams needed by infer.py, features as comma separated lists"""
+    d = {}
+    for key in ('embed_size', 'hidden_size', 'num_layers', 'dropout', 'encoder_dropout',
+                'attention', 'adaptive_softmax'):
+        d[key] = getattr(params, key)
+    for key in ('features', 'persist_features'):
+        f = getattr(params, key)
+        d[key] = ','.join(f.external + f.internal)
+    return json.dumps(d)
+
+
+def check_parity(model, scripted, data_loader, vocab, device, args):
+    """Compares the captions of the scripted module and of the eager model's
+    sample() on the first args.check_batches batches, returns the number of
+    differing captions"""
+    num_captions = num_different = 0
+    for i, (images, _, _, _, features) in enumerate(data_loader):
+        if i == args.check_batches:
+            break
+        images = images.to(device)
+        init_features = features[0].to(device) if len(features) > 0 and \
+            features[0] is not None else None
+        persist_features = features[1].to(device) if len(features) > 1 and \
+            features[1] is not None else None
+
+        with torch.no_grad():
+            eager_ids = model.sample(images, init_features, persist_features,
+                                     max_seq_length=args.max_seq_length,
+                                     start_id=vocab('<start>'), end_id=vocab('<end>'))
+            if isinstance(eager_ids, tuple):
+                eager_ids = eager_ids[0]
+            scripted_ids = scripted(images, init_features, persist_features,
+                                    args.max_seq_length, vocab('<end>'))
+
+        num_captions += eager_ids.size(0)
+        if eager_ids.shape != scripted_ids.shape:
+            num_different += eager_ids.size(0)
+        else:
+            num_different += int((eager_ids != scripted_ids).any(1).sum())
+
+    print('Parity check: {} of {} captions differ from the eager model.'.format(
+        num_different, num_captions))
+    return num_different
+
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+
+    state = torch.load(args.model, map_location=device)
+    params = ModelParams(state)
+    if args.ext_features:
+        params.update_ext_features(args.ext_features)
+    if args.ext_persist_features:
+        params.update_ext_persist_features(args.ext_persist_features)
+
+    if params.attention is None:
+        _Model = EncoderDecoder
+    elif params.attention == 'spatial':
+        _Model = SpatialAttentionEncoderDecoder
+    else:
+        print('ERROR: models with {} attention cannot be exported.'.format(params.attention))
+        sys.exit(1)
+
+    vocab = params.vocab
+    if vocab is None:
+        print('ERROR: the model must contain its vocabulary to be exported.')
+        sys.exit(1)
+
+    # Same preprocessing as in infer.py
+    transform = transforms.Compose([
+        transforms.Resize((args.resize, args.resize)),
+        transforms.ToTensor(),
+        transforms.Normalize((0.485, 0.456, 0.406),
+                             (0.229, 0.224, 0.225))])
+
+    dataset_configs = DatasetParams(args.dataset_config_file)
+    dataset_params = dataset_configs.get_params(args.dataset, args.image_dir,
+                                                args.image_files)
+    ext_feature_sets = [params.features.external, params.persist_features.external]
+    data_loader, ef_dims = get_loader(dataset_params, vocab=None, transform=transform,
+                                      batch_size=args.batch_size, shuffle=False,
+                                      num_workers=args.num_workers,
+                                      ext_feature_sets=ext_feature_sets,
+                                      skip_images=not params.has_internal_features(),
+                                      iter_over_images=True)
+
+    model = _Model(params, device, len(vocab), state, ef_dims).eval()
+    scripted = torch.jit.script(ScriptableEncoderDecoder(model).eval())
+
+    extra_files = {'params.json': params_to_json(params),
+                   'vocab.json': json.dumps(vocab.get_list())}
+    torch.jit.save(scripted, args.output, _extra_files=extra_files)
+    print('Saved scripted model as {}'.format(args.output))
+
+    if args.check_batches:
+        scripted = torch.jit.load(args.output, map_location=device)
+        if check_parity(model, scripted, data_loader, vocab, device, args) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True,
+                        help='path to the model to export')
+    parser.add_argument('--output', type=str, required=True,
+                        help='path for the scripted model')
+    parser.add_argument('--dataset', type=str, default='generic',
+                        help='dataset giving the feature dimensions and the images '
+                        'for the parity check')
+    parser.add_argument('--dataset_config_file', type=str,
+                        default='datasets/datasets.conf',
+                        help='location of dataset configuration file')
+    parser.add_argument('image_files', type=str, nargs='*')
+    parser.add_argument('--image_dir', type=str,
+                        help='input image dir for the generic dataset')
+    parser.add_argument('--ext_features', type=str,
+                        help='paths for the external features, overrides the '
+                        'paths in the model ckpt file, comma separated')
+    parser.add_argument('--ext_persist_features', type=str,
+                        help='paths for external persist features')
+    parser.add_argument('--resize', type=int, default=224,
+                        help='resize input image to this size')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--max_seq_length', type=int, default=20,
+                        help='maximum length of the captions in the parity check')
+    parser.add_argument('--check_batches', type=int, default=1,
+                        help='number of batches for comparing the captions of the '
+                        'scripted and the eager model, 0 to skip the check')
+    parser.add_argument('--cpu', action="store_true",
+                        help="Use CPU even when GPU is available")
+
+    main(parser.parse_args())
@@ -7,7 +7,7 @@ import numpy as np
 import torch
 from torchvision import transforms
 
-from model import FeatureExtractor
+from model import FeatureExtractor, SharedExtractors
 from data_loader import get_loader, DatasetParams
 
 try:
@@ -22,10 +22,19 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 def main(args):
+    extractor_names = args.extractor.split(',')
+    if 'resnet152caffe-original' in extractor_names and len(extractor_names) > 1:
+        print('ERROR: resnet152caffe-original needs different input images than the '
+              'other extractors, please extract it separately.')
+        sys.exit(1)
+    if args.output_file and len(extractor_names) > 1:
+        print('ERROR: --output_file can only be used with a single extractor.')
+        sys.exit(1)
+
     #
     # Image preprocessing
     if args.feature_type == 'plain':
-        if args.extractor == 'resnet152caffe-original':
+        if extractor_names == ['resnet152caffe-original']:
             # Use custom transform:
             transform = transforms.Compose([
                 transforms.Resize((args.crop_size, args.crop_size)),
@@ -97,43 +106,47 @@ def main(args):
                                 skip_images=False,
                                 iter_over_images=True)
 
-    extractor = FeatureExtractor(args.extractor, True).to(device).eval()
+    # Extractors using the same ResNet trunk, e.g. resnet152 and resnet152-conv,
+    # share it and get their features from a single pass over each batch
+    shared = SharedExtractors()
+    extractors = [FeatureExtractor(name, True, backbones=shared.backbones).to(device).eval()
+                  for name in extractor_names]
 
     # To open an lmdb handle and prepare it for the right size
     # it needs to fit the total number of elements in the dataset
     # so we set a map_size to a largish value here:
     map_size = 1e12
 
-    lmdb_path = None
-    file_name = None
-
-    if args.output_file:
-        file_name = args.output_file
-    else:
-        file_name = '{}-{}-{}-normalize-{}.lmdb'.format(args.dataset, args.extractor,
-                                                        args.feature_type, args.normalize)
-
     os.makedirs(args.output_dir, exist_ok=True)
 
-    lmdb_path = os.path.join(args.output_dir, file_name)
-
-    # Check that we are not overwriting anything
-    if os.path.exists(lmdb_path):
-        print('ERROR: {} exists, please remove it first if you really want to replace it.'.
-              format(lmdb_path))
-        sys.exit(1)
+    lmdb_paths = []
+    for name in extractor_names:
+        if args.output_file:
+            file_name = args.output_file
+        else:
+            file_name = '{}-{}-{}-normalize-{}.lmdb'.format(args.dataset, name,
+                                                            args.feature_type, args.normalize)
+        lmdb_path = os.path.join(args.output_dir, file_name)
+
+        # Check that we are not overwriting anything
+        if os.path.exists(lmdb_path):
+            print('ERROR: {} exists, please remove it first if you really want to replace it.'.
+                  format(lmdb_path))
+            sys.exit(1)
 
-    print("Preparing to store extracted features to {}...".format(lmdb_path))
+        print("Preparing to store extracted features to {}...".format(lmdb_path))
+        lmdb_paths.append(lmdb_path)
 
     print("Starting to extract features from dataset {} using {}...".
-          format(args.dataset, args.extractor))
+          format(args.dataset, ', '.join(extractor_names)))
     show_progress = sys.stderr.isatty()
 
     # If feature shape is not 1-dimensional, store feature shape metadata:
-    if isinstance(extractor.output_dim, np.ndarray):
-        with lmdb.open(lmdb_path, map_size=map_size) as env:
-            with env.begin(write=True) as txn:
-                txn.put(str('@vdim').encode('ascii'), extractor.output_dim)
+    for extractor, lmdb_path in zip(extractors, lmdb_paths):
+        if isinstance(extractor.output_dim, np.ndarray):
+            with lmdb.open(lmdb_path, map_size=map_size) as env:
+                with env.begin(write=True) as txn:
+                    txn.put(str('@vdim').encode('ascii'), extractor.output_dim)
 
     for i, (images, _, _,
             image_ids, _) in enumerate(tqdm(data_loader, disable=not show_progress)):
@@ -141,36 +154,42 @@ def main(args):
         images = images.to(device)
 
         # If we are dealing with cropped images, image dimensions are: bs, ncrops, c, h, w
+        ncrops = None
         if images.dim() == 5:
             bs, ncrops, c, h, w = images.size()
-            # fuse batch size and ncrops:
-            raw_features = extractor(images.view(-1, c, h, w))
-
-            if args.feature_type == 'avg':
-                # Average over crops:
-                features = raw_features.view(bs, ncrops, -1).mean(1).data.cpu().numpy()
-            elif args.feature_type == 'max':
-                # Max over crops:
-                features = raw_features.view(bs, ncrops, -1).max(1)[0].data.cpu().numpy()
-        # Otherwise our image dimensions are bs, c, h, w
-        else:
-            features = extractor(images).data.cpu().numpy()
-
-        # Write to LMDB object:
-        with lmdb.open(lmdb_path, map_size=map_size) as env:
-            with env.begin(write=True) as txn:
-                for j, image_id in enumerate(image_ids):
-
-                    # If output dimension is not a scalar, flatten the array.
-                    # When retrieving this feature from the LMDB, developer must take
-                    # care to reshape the feature back to the correct dimensions!
-                    if isinstance(extractor.output_dim, np.ndarray):
-                        _feature = features[j].flatten()
-                    # Otherwise treat it as is:
-                    else:
-                        _feature = features[j]
-
-                    txn.put(str(image_id).encode('ascii'), _feature)
+            # fuse batch size and ncrops, once so that all the extractors get
+            # the same tensor and a shared trunk runs only once:
+            images = images.view(-1, c, h, w)
+
+        for extractor, lmdb_path in zip(extractors, lmdb_paths):
+            if ncrops is not None:
+                raw_features = extractor(images)
+
+                if args.feature_type == 'avg':
+                    # Average over crops:
+                    features = raw_features.view(bs, ncrops, -1).mean(1).data.cpu().numpy()
+                elif args.feature_type == 'max':
+                    # Max over crops:
+                    features = raw_features.view(bs, ncrops, -1).max(1)[0].data.cpu().numpy()
+            # Otherwise our image dimensions are bs, c, h, w
+            else:
+                features = extractor(images).data.cpu().numpy()
+
+            # Write to LMDB object:
+            with lmdb.open(lmdb_path, map_size=map_size) as env:
+                with env.begin(write=True) as txn:
+                    for j, image_id in enumerate(image_ids):
+
+                        # If output dimension is not a scalar, flatten the array.
+                        # When retrieving this feature from the LMDB, developer must take
+                        # care to reshape the feature back to the correct dimensions!
+                        if isinstance(extractor.output_dim, np.ndarray):
+                            _feature = features[j].flatten()
+                        # Otherwise treat it as is:
+                        else:
+                            _feature = features[j]
+
+                        txn.put(str(image_id).encode('ascii'), _feature)
 
         # Print log info
         if not show_progress and ((i + 1) % args.log_step == 0):
@@ -212,7 +231,9 @@ if __name__ == '__main__':
                         help='file for saving features, if no name specified it '
                              'defaults to "dataset_name-extractor.lmdb"')
     parser.add_argument('--extractor', type=str, default='resnet152',
-                        help='name of the extractor, ex: alexnet, resnet152, densenet201')
+                        help='name of the extractor, ex: alexnet, resnet152, densenet201, '
+                        'or a comma separated list of extractors which are all computed '
+                        'in one pass, each written to its own file')
     parser.add_argument('--log_step', type=int, default=10,
                         help='How often do we want to log output')
 
@@ -6,6 +6,8 @@ import json
 import os
 import re
 import sys
+import time
+import zipfile
 
 from datetime import datetime
 from PIL import Image
@@ -13,9 +15,10 @@ from PIL import Image
 import torch
 from torchvision import transforms
 
-from vocabulary import Vocabulary, get_vocab # (Needed to handle Vocabulary pickle)
+from vocabulary import Vocabulary, get_vocab, get_vocab_from_list # (Needed to handle Vocabulary pickle)
 from data_loader import get_loader, ExternalFeature, DatasetConfig, DatasetParams
-from model import ModelParams, EncoderDecoder, SpatialAttentionEncoderDecoder
+from model import (ModelParams, EncoderDecoder, SpatialAttentionEncoderDecoder,
+                   SoftAttentionEncoderDecoder, quantize_dynamic)
 
 try:
     from tqdm import tqdm
@@ -53,6 +56,59 @@ def caption_ids_to_words(sampled_ids, vocab):
     return fix_caption(' '.join(sampled_caption))
 
 
+def generate_ids(model, scripted, images, init_features, persist_features, vocab, args):
+    """Word ids of the captions generated by model for a batch of images"""
+    with torch.no_grad():
+        if scripted:
+            return model(images, init_features, persist_features, args.max_seq_length,
+                         vocab('<end>'))
+        sampled_ids = model.sample(images, init_features, persist_features,
+                                   max_seq_length=args.max_seq_length,
+                                   beam_size=args.beam_size,
+                                   start_id=vocab('<start>'),
+                                   end_id=vocab('<end>'))
+    # Attention models also return the attention weights
+    return sampled_ids[0] if isinstance(sampled_ids, tuple) else sampled_ids
+
+
+def ids_to_caption(sampled_ids, vocab, args):
+    caption = caption_ids_to_words(sampled_ids, vocab)
+
+    if args.no_repeat_sentences:
+        caption = remove_duplicate_sentences(caption)
+
+    if args.only_complete_sentences:
+        caption = remove_incomplete_sentences(caption)
+
+    return caption
+
+
+def save_quantized_model(path, model, state, quantize):
+    """Saves the quantized model like train.py saves models, so that infer.py
+    can load it without quantizing it again"""
+    qstate = {k: v for k, v in state.items() if k not in ('encoder', 'decoder', 'optimizer')}
+    qstate['encoder'] = model.encoder.state_dict()
+    qstate['decoder'] = model.decoder.state_dict()
+    qstate['quantize'] = quantize
+    torch.save(qstate, path)
+    print('Saved quantized model as {}'.format(path))
+
+
+def print_quantize_report(num_same, num_captions, times, gts, res, res_fp32, cider_df):
+    """Compares the captions of the quantized model to those of the fp32 one"""
+    print('Quantized model: {} of {} captions ({:.1%}) identical to the fp32 model'.
+          format(num_same, num_captions, num_same / max(num_captions, 1)))
+    print('Generation time: fp32 {:.2f} s, quantized {:.2f} s ({:.2f}x)'.
+          format(times['fp32'], times['quantized'],
+                 times['fp32'] / max(times['quantized'], 1e-9)))
+    if len(gts) > 0:
+        from eval.cider import Cider
+        cider_fp32 = Cider(df=cider_df).compute_score(gts, res_fp32)[0]
+        cider = Cider(df=cider_df).compute_score(gts, res)[0]
+        print('CIDEr: fp32 {:.4f}, quantized {:.4f}, delta {:+.4f}'.
+              format(cider_fp32, cider, cider - cider_fp32))
+
+
 def path_from_id(image_dir, image_id):
     """Return image path based on image directory, image id and
     glob matching for extension"""
@@ -73,6 +129,25 @@ def load_image(image_path, transform=None):
     return image
 
 
+def is_scripted_model(path):
+    """True if path is a TorchScript module written by export_model.py instead
+    of a model checkpoint, the former has its compiled code in a code/ folder"""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as zf:
+        return any(name.split('/')[1:2] == ['code'] for name in zf.namelist())
+
+
+def load_scripted_model(path):
+    """Loads a module exported by export_model.py, and the model parameters and
+    vocabulary stored with it"""
+    extra_files = {'params.json': '', 'vocab.json': ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    params = ModelParams(json.loads(extra_files['params.json']))
+    vocab = get_vocab_from_list(json.loads(extra_files['vocab.json']), False)
+    return model.eval(), params, vocab
+
+
 def remove_duplicate_sentences(caption):
     """Removes consecutively repeating sentences from the caption"""
     sentences = caption.split('.')
@@ -97,6 +172,16 @@ def remove_incomplete_sentences(caption):
         return caption
 
 
+def write_cider_scores(output_path, image_ids, scores):
+    """Writes the CIDEr scores of images to a file next to the output file
+    output_path"""
+    path = os.path.splitext(output_path)[0] + '.cider.txt'
+    with open(path, 'w') as fp:
+        for image_id, score in zip(image_ids, scores):
+            print(image_id, score, file=fp)
+    print('Wrote per-image CIDEr scores to {}'.format(path))
+
+
 def infer(ext_args=None):
     args = parse_args(ext_args)
 
@@ -113,7 +198,7 @@ def infer(ext_args=None):
             s = s.lower().strip()
             if s == 'cider':
                 from eval.cider import Cider
-                scorers['CIDEr'] = Cider(df='corpus')
+                scorers['CIDEr'] = Cider(df=args.cider_df, num_workers=args.cider_workers)
 
     # Image preprocessing
     transform = transforms.Compose([
@@ -131,11 +216,33 @@ def infer(ext_args=None):
     # Build models
     print('Bulding models.')
 
-    if device.type == 'cpu':
-        state = torch.load(args.model, map_location=lambda storage, loc: storage)
+    scripted = is_scripted_model(args.model)
+    if scripted:
+        if args.beam_size > 1:
+            print('ERROR: scripted models only support greedy search, use the '
+                  'original model for beam search.')
+            sys.exit(1)
+        if args.quantize or args.save_quantized or args.quantize_report:
+            print('ERROR: scripted models cannot be quantized, use --quantize '
+                  'with the original model.')
+            sys.exit(1)
+        print('Loading scripted model.')
+        model, params, scripted_vocab = load_scripted_model(args.model)
     else:
-        state = torch.load(args.model)
-    params = ModelParams(state)
+        if device.type == 'cpu':
+            state = torch.load(args.model, map_location=lambda storage, loc: storage)
+        else:
+            state = torch.load(args.model)
+        params = ModelParams(state)
+    if (args.quantize or params.quantize) and device.type != 'cpu':
+        print('ERROR: quantized models run only on CPU, please add --cpu.')
+        sys.exit(1)
+    if args.quantize_report and not args.quantize:
+        print('ERROR: --quantize_report needs --quantize.')
+        sys.exit(1)
+    if params.quantize and args.quantize:
+        print('ERROR: {} has already been quantized.'.format(args.model))
+        sys.exit(1)
     if args.ext_features:
         params.update_ext_features(args.ext_features)
     if args.ext_persist_features:
@@ -148,6 +255,9 @@ def infer(ext_args=None):
     if args.vocab is not None:
         # Loading vocabulary from file path supplied by the user:
         vocab = get_vocab(args)
+    elif scripted:
+        print('Loading vocabulary stored in the model file.')
+        vocab = scripted_vocab
     elif params.vocab is not None:
         print('Loading vocabulary stored in the model file.')
         vocab = params.vocab
@@ -174,36 +284,90 @@ def infer(ext_args=None):
                                       num_workers=args.num_workers,
                                       ext_feature_sets=ext_feature_sets,
                                       skip_images=not params.has_internal_features(),
-                                      iter_over_images=True)
+                                      iter_over_images=True,
+                                      shared_features=args.shared_features)
+
+    # Build the models, a scripted model is ready to use
+    if not scripted:
+        if params.attention is None:
+            _Model = EncoderDecoder
+        elif params.attention == 'soft':
+            _Model = SoftAttentionEncoderDecoder
+        else:
+            _Model = SpatialAttentionEncoderDecoder
+
+        if params.quantize:
+            # Saved with --save_quantized, the int8 weights can only be loaded
+            # into quantized layers
+            model = quantize_dynamic(_Model(params, device, len(vocab), None, ef_dims),
+                                     inplace=True)
+            model.encoder.load_state_dict(state['encoder'])
+            model.decoder.load_state_dict(state['decoder'])
+        else:
+            model = _Model(params, device, len(vocab), state, ef_dims)
+        model.eval()
+
+    # The original model is kept for comparing it with the quantized one
+    fp32_model = None
+    if args.quantize:
+        print('Quantizing the model.')
+        if args.quantize_report:
+            fp32_model = model
+        model = quantize_dynamic(model, inplace=fp32_model is None)
+        if args.save_quantized:
+            save_quantized_model(args.save_quantized, model, state, args.quantize)
+
+    res_fp32 = {}
+    num_same = 0
+    times = {'fp32': 0.0, 'quantized': 0.0}
+
+    # Decide output format, fall back to txt
+    if args.output_format is not None:
+        output_format = args.output_format
+    elif args.output_file and args.output_file.endswith('.json'):
+        output_format = 'json'
+    else:
+        output_format = 'txt'
 
-    # Build the models
-    if params.attention is None:
-        _Model = EncoderDecoder
+    # Create a sensible default output path for results:
+    output_file = None
+    if not args.output_file and not args.print_results:
+        model_name = args.model.split(os.sep)[-2]
+        model_epoch = basename(args.model)
+        output_file = '{}-{}.{}'.format(model_name, model_epoch, output_format)
     else:
-        _Model = SpatialAttentionEncoderDecoder
+        output_file = args.output_file
 
-    model = _Model(params, device, len(vocab), state, ef_dims).eval()
+    output_path = None
+    if output_file:
+        output_path = os.path.join(args.results_path, output_file)
 
     output_data = []
 
     gts = {}
     res = {}
 
+    # CIDEr is scored batch by batch, the other scorers and the quantization
+    # report need all the captions at the end
+    cider = scorers['CIDEr'].accumulator() if 'CIDEr' in scorers else None
+    collect_captions = (fp32_model is not None or
+                        any(name != 'CIDEr' for name in scorers))
+
     print('Starting inference...')
     show_progress = sys.stderr.isatty() and not args.verbose
-    for i, (images, ref_captions, lengths, image_ids,
-            features) in enumerate(tqdm(data_loader, disable=not show_progress)):
+    progress = tqdm(data_loader, disable=not show_progress)
+    for i, (images, ref_captions, lengths, image_ids, features) in enumerate(progress):
 
-        if len(scorers) > 0:
+        batch_gts = []
+        if ref_captions is not None and (collect_captions or cider is not None):
             for j in range(len(ref_captions)):
-                jid = image_ids[j]
-                if jid not in gts:
-                    gts[jid] = []
                 rcs = ref_captions[j]
                 if type(rcs) is str:
                     rcs = [rcs]
-                for rc in rcs:
-                    gts[jid].append(rc.lower())
+                batch_gts.append([rc.lower() for rc in rcs])
+            if collect_captions:
+                for image_id, refs in zip(image_ids, batch_gts):
+                    gts.setdefault(image_id, []).extend(refs)
 
         images = images.to(device)
 
@@ -213,54 +377,58 @@ def infer(ext_args=None):
             features[1] is not None else None
 
         # Generate a caption from the image
-        if params.attention is None:
-            sampled_ids_batch = model.sample(images, init_features, persist_features,
-                                             max_seq_length=args.max_seq_length)
-        else:
-            sampled_ids_batch, alphas = model.sample(images, init_features, persist_features,
-                                                     max_seq_length=args.max_seq_length)
-
+        begin = time.perf_counter()
+        sampled_ids_batch = generate_ids(model, scripted, images, init_features,
+                                         persist_features, vocab, args)
+        times['quantized'] += time.perf_counter() - begin
+
+        if fp32_model is not None:
+            begin = time.perf_counter()
+            fp32_ids_batch = generate_ids(fp32_model, scripted, images, init_features,
+                                          persist_features, vocab, args)
+            times['fp32'] += time.perf_counter() - begin
+
+        batch_res = []
         for i in range(sampled_ids_batch.shape[0]):
-            sampled_ids = sampled_ids_batch[i]
-
             # Convert word_ids to words
-            caption = caption_ids_to_words(sampled_ids, vocab)
-
-            if args.no_repeat_sentences:
-                caption = remove_duplicate_sentences(caption)
+            caption = ids_to_caption(sampled_ids_batch[i], vocab, args)
 
-            if args.only_complete_sentences:
-                caption = remove_incomplete_sentences(caption)
+            if fp32_model is not None:
+                fp32_caption = ids_to_caption(fp32_ids_batch[i], vocab, args)
+                num_same += caption == fp32_caption
+                res_fp32[image_ids[i]] = [fp32_caption.lower()]
 
             if args.verbose:
                 print('=>', caption)
 
             output_data.append({'caption': caption, 'image_id': image_ids[i]})
-            res[image_ids[i]] = [caption.lower()]
+            batch_res.append(caption.lower())
+            if collect_captions:
+                res[image_ids[i]] = [caption.lower()]
+
+        if cider is not None and batch_gts:
+            # The rows of an image, e.g. one per reference caption in MSR-VTT,
+            # can come in several batches, the accumulator merges them
+            cider.add(batch_res, batch_gts, image_ids)
+            if show_progress and hasattr(progress, 'set_postfix'):
+                progress.set_postfix(CIDEr='{:.4f}'.format(cider.score()))
 
     for score_name, scorer in scorers.items():
-        score = scorer.compute_score(gts, res)[0]
+        if score_name == 'CIDEr':
+            if len(cider) == 0:
+                continue
+            score, cider_scores = cider.finish()
+            if output_path:
+                write_cider_scores(output_path, cider.image_ids, cider_scores)
+        else:
+            score, scores = scorer.compute_score(gts, res)
         print('Test', score_name, score)
 
-    # Decide output format, fall back to txt
-    if args.output_format is not None:
-        output_format = args.output_format
-    elif args.output_file and args.output_file.endswith('.json'):
-        output_format = 'json'
-    else:
-        output_format = 'txt'
-
-    # Create a sensible default output path for results:
-    output_file = None
-    if not args.output_file and not args.print_results:
-        model_name = args.model.split(os.sep)[-2]
-        model_epoch = basename(args.model)
-        output_file = '{}-{}.{}'.format(model_name, model_epoch, output_format)
-    else:
-        output_file = args.output_file
+    if fp32_model is not None:
+        print_quantize_report(num_same, len(output_data), times, gts, res, res_fp32,
+                              args.cider_df)
 
     if output_file:
-        output_path = os.path.join(args.results_path, output_file)
         if output_format == 'json':
             json.dump(output_data, open(output_path, 'w'))
         else:
@@ -288,11 +456,15 @@ def parse_args(ext_args=None):
                         help='resize input image to this size')
     parser.add_argument('--batch_size', type=int, default=128)
     parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--shared_features', action='store_true',
+                        help='load .npy external features into shared memory instead '
+                        'of memory-mapping them')
     parser.add_argument('image_files', type=str, nargs='*')
     parser.add_argument('--image_dir', type=str,
                         help='input image dir for generating captions')
     parser.add_argument('--model', type=str, required=True,
-                        help='path to existing model')
+                        help='path to existing model, or to a scripted model '
+                        'written by export_model.py')
     parser.add_argument('--vocab', type=str, help='path for vocabulary wrapper')
     parser.add_argument('--ext_features', type=str,
                         help='paths for the external features, overrides the '
@@ -309,13 +481,34 @@ def parse_args(ext_args=None):
                         help='path for saving results')
     parser.add_argument('--print_results', action='store_true')
     parser.add_argument('--scoring', type=str)
+    parser.add_argument('--cider_df', type=str, default='corpus',
+                        help='document frequencies for CIDEr: "corpus" for those of '
+                        'the scored images, or the path of a table built with '
+                        'build_cider_df.py')
+    parser.add_argument('--cider_workers', type=int,
+                        help='number of processes for scoring CIDEr on at least 20000 '
+                        'images, by default up to 8, 1 for scoring in one process')
     parser.add_argument('--max_seq_length', type=int, default=20,
                         help='maximum allowed length of the decoded sequence')
+    parser.add_argument('--beam_size', type=int, default=1,
+                        help='number of hypotheses kept in beam search, default: '
+                        '1, i.e. greedy search')
     parser.add_argument('--no_repeat_sentences', action='store_true',
                         help='allow repeating sentences inside a paragraph')
     parser.add_argument('--only_complete_sentences', action='store_true')
     parser.add_argument('--cpu', action="store_true",
                         help="Use CPU even when GPU is available")
+    parser.add_argument('--quantize', type=str, choices=['dynamic'],
+                        help='quantize the encoder output layer and the decoder '
+                        'to int8 for faster inference on CPU, "dynamic" quantizes '
+                        'the weights in advance and the activations on the fly')
+    parser.add_argument('--save_quantized', type=str,
+                        help='save the model quantized with --quantize to this '
+                        'path, it can then be given as --model without --quantize')
+    parser.add_argument('--quantize_report', action='store_true',
+                        help='also generate captions with the original model, '
+                        'and report the agreement and the CIDEr difference of the '
+                        'quantized model')
 
     return parser.parse_args(ext_args)
 
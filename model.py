@@ -1,13 +1,19 @@
+import copy
+import hashlib
 import os
+import weakref
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 
 import numpy as np
 
 from collections import OrderedDict, namedtuple
+from typing import Dict, List, Optional, Tuple
 from torch.nn.utils.rnn import pack_padded_sequence
+from torch.utils.checkpoint import checkpoint
 
 import external_models as ext_models
 
@@ -29,7 +35,13 @@ class ModelParams:
         self.persist_features = self._get_features(d, 'persist_features', '')
         self.encoder_dropout = self._get_param(d, 'encoder_dropout', 0)
         self.attention = self._get_param(d, 'attention', None)
+        self.adaptive_softmax = self._get_cutoffs(d, 'adaptive_softmax')
         self.vocab = self._get_param(d, 'vocab', None)
+        # Set in models whose layers have been quantized, see quantize_dynamic()
+        self.quantize = self._get_param(d, 'quantize', None)
+        # Only needed when creating a new adaptive softmax layer, the word order
+        # of a trained model is stored in its state
+        self.word_counts = None
 
     @classmethod
     def fromargs(cls, args):
@@ -42,6 +54,12 @@ class ModelParams:
             return default
         return d[param]
 
+    def _get_cutoffs(self, d, param):
+        p = self._get_param(d, param, None)
+        if isinstance(p, str):
+            p = [int(c) for c in p.split(',')] if p else None
+        return p
+
     def _get_features(self, d, param, default):
         p = self._get_param(d, param, default)
 
@@ -90,21 +108,214 @@ class ModelParams:
                           self.__dict__.items()])
 
 
+class FeatureCache:
+    """LMDB cache of the outputs of frozen FeatureExtractors, keyed by the
+    extractor name, a signature of the image transform and the image id.
+    Filled during the first epoch, later epochs skip the CNN forward passes.
+    The transform must be deterministic for the cached features to be valid.
+
+    The datasets skip loading the images whose features are cached for all
+    the extractors in names, and return a zero tensor of image_shape in
+    their place, see has().  Each process opens its own LMDB environment, so
+    the cache can be passed to DataLoader workers."""
+
+    def __init__(self, path, signature, names=(), image_shape=None, map_size=int(1e12)):
+        self.path = path
+        self.signature = signature
+        self.names = list(names)
+        self.image_shape = image_shape
+        self.map_size = map_size
+        self.shapes = {}
+        self._env = None
+        self._pid = None
+        self.env()
+        print('Using feature cache {} with transform signature {}'.format(path, signature))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_env'] = state['_pid'] = None
+        return state
+
+    def env(self):
+        if self._pid != os.getpid():
+            import lmdb
+            self._env = lmdb.open(self.path, map_size=self.map_size)
+            self._pid = os.getpid()
+        return self._env
+
+    def _key(self, name, image_id):
+        return '{}|{}|{}'.format(name, self.signature, image_id).encode('utf-8')
+
+    def has(self, image_id):
+        """Returns True if the features of image_id are cached for all names"""
+        if not self.names or self.image_shape is None:
+            return False
+        with self.env().begin(write=False) as txn:
+            return all(txn.get(self._key(name, image_id)) is not None for name in self.names)
+
+    def get(self, name, image_ids):
+        """Returns the cached features of image_ids as a tensor and the indices
+        of the images that are not cached, whose rows are left uninitialized.
+        The tensor is None if nothing has been cached for name yet."""
+        missing = []
+        with self.env().begin(write=False) as txn:
+            shape = self.shapes.get(name)
+            if shape is None:
+                value = txn.get(self._key(name, '@shape'))
+                if value is None:
+                    return None, list(range(len(image_ids)))
+                shape = self.shapes[name] = tuple(np.frombuffer(value, dtype=np.int64))
+
+            features = np.empty((len(image_ids),) + shape, dtype=np.float32)
+            for i, image_id in enumerate(image_ids):
+                value = txn.get(self._key(name, image_id))
+                if value is None:
+                    missing.append(i)
+                else:
+                    features[i] = np.frombuffer(value, dtype=np.float32).reshape(shape)
+        return torch.from_numpy(features), missing
+
+    def put(self, name, image_ids, features):
+        features = features.detach().float().cpu().numpy()
+        with self.env().begin(write=True) as txn:
+            if name not in self.shapes:
+                self.shapes[name] = features.shape[1:]
+                txn.put(self._key(name, '@shape'), np.array(features.shape[1:],
+                                                             dtype=np.int64).tobytes())
+            for image_id, feature in zip(image_ids, features):
+                txn.put(self._key(name, image_id), feature.tobytes(), overwrite=False)
+
+    @classmethod
+    def signature_of(cls, transform):
+        """Returns a short hash identifying the image transform, torchvision
+        transforms include all their parameters in their repr()"""
+        return hashlib.sha1(repr(transform).encode('utf-8')).hexdigest()[:16]
+
+
+class _LastBatch:
+    """Remembers a value computed from an images tensor, until another tensor
+    is given.  The tensor is identified by a weak reference and its version
+    counter, so in-place changes to it also invalidate the value."""
+
+    def __init__(self):
+        self.images = None
+        self.value = None
+
+    def get(self, images):
+        if self.images is not None:
+            last_images, last_version = self.images
+            if last_images() is images and last_version == images._version:
+                return self.value
+        return None
+
+    def set(self, images, value):
+        self.images = (weakref.ref(images), images._version)
+        self.value = value
+
+
+class Backbone(nn.Sequential):
+    """CNN trunk whose module outputs, "taps", can be used as features.  All the
+    taps used by the FeatureExtractors sharing the trunk are computed in a
+    single pass, which is done only once for the same images tensor."""
+
+    def __init__(self, modules, tap_indices):
+        super(Backbone, self).__init__(*modules)
+        self.tap_indices = tap_indices
+        self.taps = set()
+        self._last = _LastBatch()
+
+    def add_tap(self, tap):
+        self.taps.add(tap)
+
+    def forward_taps(self, images):
+        """Returns a dict of the outputs of all taps for images"""
+        outputs = self._last.get(images)
+        if outputs is None:
+            indices = {self.tap_indices[tap]: tap for tap in self.taps}
+            outputs = {}
+            x = images
+            for i, module in enumerate(self):
+                x = module(x)
+                if i in indices:
+                    outputs[indices[i]] = x
+                    if len(outputs) == len(indices):
+                        break
+            self._last.set(images, outputs)
+        return outputs
+
+
+class SharedExtractors:
+    """The FeatureExtractors and Backbones of a model by name, so that each is
+    loaded only once, see FeatureExtractor.list()"""
+
+    def __init__(self):
+        self.extractors = {}
+        self.backbones = {}
+
+
 class FeatureExtractor(nn.Module):
-    def __init__(self, model_name, debug=False, finetune=False):
+    # Features taken from the modules of a ResNet, which can share one pass of
+    # the same trunk: name -> (trunk, tap, output_dim)
+    resnet_features = {
+        'resnet152': ('resnet152', 'pool', 2048),
+        'resnet152-conv': ('resnet152', 'conv', np.array([2048, 7, 7], dtype=np.int32)),
+        'resnet152-layer3': ('resnet152', 'layer3', np.array([1024, 14, 14], dtype=np.int32)),
+        'resnet152-layer2': ('resnet152', 'layer2', np.array([512, 28, 28], dtype=np.int32)),
+        'resnet152-layer1': ('resnet152', 'layer1', np.array([256, 56, 56], dtype=np.int32)),
+        'resnet152caffe-torchvision': ('resnet152caffe-torchvision', 'pool', 2048),
+        'resnet152caffe-conv': ('resnet152caffe-torchvision', 'conv',
+                                np.array([2048, 7, 7], dtype=np.int32)),
+        'resnet152caffe-original': ('resnet152caffe-original', 'pool', 2048),
+    }
+    # Index of the module of the ResNet children() whose output each tap is
+    resnet_taps = {'layer1': 4, 'layer2': 5, 'layer3': 6, 'conv': 7, 'pool': 8}
+
+    def __init__(self, model_name, debug=False, finetune=False, backbones=None):
         """Load the pretrained model and replace top fc layer.
         Inception assumes input image size to be 299x299.
         Other models assume input image of size 224x224
-        More info: https://pytorch.org/docs/stable/torchvision/models.html """
+        More info: https://pytorch.org/docs/stable/torchvision/models.html
+        ResNet trunks are taken from and added to the dict backbones if given,
+        so that the features of one trunk are computed in a single pass."""
         super(FeatureExtractor, self).__init__()
 
+        self.model_name = model_name
+
+        # Optional FeatureCache, used only when not finetuning
+        self.cache = None
+
+        # Set by list() when the extractor is shared, the output for the last
+        # batch of images is then remembered, see forward()
+        self.shared = False
+        self._last = _LastBatch()
+
+        # Output of the Backbone used as the feature, None if the whole
+        # extractor is used
+        self.tap = None
+
         # Set flatten to False if we do not want to flatten the output features
         self.flatten = True
 
         # Toggle finetuning
         self.finetune = finetune
 
-        if model_name == 'alexnet':
+        if model_name in self.resnet_features:
+            trunk, self.tap, self.output_dim = self.resnet_features[model_name]
+            if debug:
+                print('Using {}, {} features shape {}'.format(
+                    trunk, self.tap, ' x '.join(str(d) for d in np.atleast_1d(self.output_dim))))
+                if trunk == 'resnet152caffe-original':
+                    print('resnet152caffe-original requires BGR images with pixel values '
+                          'in range 0..255')
+            if backbones is not None and trunk in backbones:
+                self.extractor = backbones[trunk]
+            else:
+                self.extractor = self.resnet_trunk(trunk)
+                if backbones is not None:
+                    backbones[trunk] = self.extractor
+            self.extractor.add_tap(self.tap)
+            self.flatten = self.tap == 'pool'
+        elif model_name == 'alexnet':
             if debug:
                 print('Using AlexNet, features shape 256 x 6 x 6')
             model = models.alexnet(pretrained=True)
@@ -118,46 +329,6 @@ class FeatureExtractor(nn.Module):
             self.output_dim = 1920 * 7 * 7
             modules = list(model.children())[:-1]
             self.extractor = nn.Sequential(*modules)
-        elif model_name == 'resnet152':
-            if debug:
-                print('Using resnet 152, features shape 2048')
-            model = models.resnet152(pretrained=True)
-            self.output_dim = 2048
-            modules = list(model.children())[:-1]
-            self.extractor = nn.Sequential(*modules)
-        elif model_name == 'resnet152-conv':
-            if debug:
-                print('Using resnet 152, '
-                      'last convolutional layer, features shape 2048 x 7 x 7')
-            model = models.resnet152(pretrained=True)
-            self.output_dim = np.array([2048, 7, 7], dtype=np.int32)
-            modules = list(model.children())[:-2]
-            self.extractor = nn.Sequential(*modules)
-            self.flatten = False
-        elif model_name == 'resnet152caffe-torchvision':
-            if debug:
-                print('Using resnet 152 converted from caffe, features shape 2048')
-            model = ext_models.resnet152caffe_torchvision(pretrained=True)
-            self.output_dim = 2048
-            modules = list(model.children())[:-1]
-            self.extractor = nn.Sequential(*modules)
-        elif model_name == 'resnet152caffe-original':
-            if debug:
-                print('Using resnet 152 converted from caffe, requires BGR images with '
-                      ' pixel values in range 0..255 features shape 2048')
-            model = ext_models.resnet152caffe_original(pretrained=True)
-            self.output_dim = 2048
-            modules = list(model.children())[:-1]
-            self.extractor = nn.Sequential(*modules)
-        elif model_name == 'resnet152caffe-conv':
-            if debug:
-                print('Using resnet 152 converted from caffe, '
-                      'last convolutional layer, features shape 2048 x 7 x 7')
-            model = ext_models.resnet152caffe_torchvision(pretrained=True)
-            self.output_dim = np.array([2048, 7, 7], dtype=np.int32)
-            modules = list(model.children())[:-2]
-            self.extractor = nn.Sequential(*modules)
-            self.flatten = False
         elif model_name == 'vgg16':
             if debug:
                 print('Using vgg 16, features shape 4096')
@@ -178,37 +349,101 @@ class FeatureExtractor(nn.Module):
         else:
             raise ValueError('Unknown model name: {}'.format(model_name))
 
-    def forward(self, images):
-        """Extract feature vectors from input images."""
+    @classmethod
+    def resnet_trunk(cls, name):
+        if name == 'resnet152':
+            model = models.resnet152(pretrained=True)
+        elif name == 'resnet152caffe-torchvision':
+            model = ext_models.resnet152caffe_torchvision(pretrained=True)
+        elif name == 'resnet152caffe-original':
+            model = ext_models.resnet152caffe_original(pretrained=True)
+        # Everything up to the global average pooling, the state keys are the
+        # same as those of the pooled and convolutional features before
+        return Backbone(list(model.children())[:-1], cls.resnet_taps)
+
+    def forward(self, images, image_ids=None):
+        """Extract feature vectors from input images.  If a cache has been set,
+        image_ids are used to look up the features of earlier epochs.  A shared
+        extractor returns the features it computed last if called again with
+        the same images tensor, so that the encoder and the decoder using the
+        same backbone run it only once per batch."""
+        features = self._last.get(images) if self.shared else None
+        if features is None:
+            features = self._extract(images, image_ids)
+            if self.shared:
+                self._last.set(images, features)
+        return features
+
+    def _run(self, images):
+        if self.tap is not None:
+            return self.extractor.forward_taps(images)[self.tap]
+        return self.extractor(images)
+
+    def _extract(self, images, image_ids):
+        use_cache = self.cache is not None and image_ids is not None and not self.finetune
+        cached = None
+        if use_cache:
+            cached, missing = self.cache.get(self.model_name, image_ids)
+            if not missing:
+                return cached.to(images.device)
+            # Only the images whose features are missing have been loaded
+            if cached is not None:
+                images = images[torch.tensor(missing, device=images.device)]
+
         if self.finetune:
-            features = self.extractor(images)
+            features = self._run(images)
         else:
             with torch.no_grad():
                 self.extractor.eval()
-                features = self.extractor(images)
+                features = self._run(images)
 
         if self.flatten:
             features = features.reshape(features.size(0), -1)
+
+        if use_cache:
+            self.cache.put(self.model_name, [image_ids[i] for i in missing], features)
+            if cached is not None:
+                cached = cached.to(features.device, features.dtype)
+                cached[torch.tensor(missing, device=features.device)] = features
+                features = cached
         return features
 
     @classmethod
-    def list(cls, internal_features):
+    def list(cls, internal_features, shared=None):
+        """Returns a ModuleList of the extractors of internal_features and their
+        total output dimension.  Extractors and ResNet trunks already in the
+        SharedExtractors shared are reused instead of loading another copy of
+        the same backbone, and new ones are added to it."""
         el = nn.ModuleList()
         total_dim = 0
         for fn in internal_features:
-            e = cls(fn)
+            if shared is not None and fn in shared.extractors:
+                e = shared.extractors[fn]
+                e.shared = True
+            else:
+                e = cls(fn, backbones=shared.backbones if shared is not None else None)
+                if shared is not None:
+                    shared.extractors[fn] = e
             el.append(e)
             total_dim += e.output_dim
         return el, total_dim
 
 
+def set_feature_cache(model, cache):
+    """Make all the FeatureExtractors of model use the given FeatureCache"""
+    for m in model.modules():
+        if isinstance(m, FeatureExtractor):
+            m.cache = cache
+
+
 class EncoderCNN(nn.Module):
-    def __init__(self, p, ext_features_dim=0):
-        """Load a pretrained CNN and replace top fc layer."""
+    def __init__(self, p, ext_features_dim=0, shared_extractors=None):
+        """Load a pretrained CNN and replace top fc layer.  shared_extractors
+        is passed to FeatureExtractor.list()."""
         super(EncoderCNN, self).__init__()
 
         (self.extractors,
-         int_features_dim) = FeatureExtractor.list(p.features.internal)
+         int_features_dim) = FeatureExtractor.list(p.features.internal, shared_extractors)
 
         # Sum of the dimensionalities of the concatenated features
         total_feat_dim = ext_features_dim + int_features_dim
@@ -220,13 +455,13 @@ class EncoderCNN(nn.Module):
         self.dropout = nn.Dropout(p=p.encoder_dropout)
         self.bn = nn.BatchNorm1d(p.embed_size, momentum=0.01)
 
-    def forward(self, images, external_features=None):
+    def forward(self, images, external_features=None, image_ids=None):
         """Extract feature vectors from input images."""
         with torch.no_grad():
             feat_outputs = []
             # Extract features with each extractor
             for extractor in self.extractors:
-                feat_outputs.append(extractor(images))
+                feat_outputs.append(extractor(images, image_ids))
             # Add external features
             if external_features is not None:
                 feat_outputs.append(external_features)
@@ -245,33 +480,188 @@ class EncoderCNN(nn.Module):
             fixed_states.append((key, value))
 
         fixed_state_dict = OrderedDict(fixed_states)
+        # The versions of the modules, which quantized layers need to load
+        if hasattr(state_dict, '_metadata'):
+            fixed_state_dict._metadata = state_dict._metadata
         super(EncoderCNN, self).load_state_dict(fixed_state_dict, strict)
 
 
+class UnfusedLSTM(nn.Module):
+    """The layers of an nn.LSTM whose first layer input is the concatenated
+    [embeddings, persist features], as nn.Linear modules: the input and hidden
+    state projections ih and hh of each layer, and the projection persist of
+    the persist features, without bias.  Used by DecoderRNN in place of its
+    nn.LSTM once quantized, as dynamic quantization handles nn.Linear modules
+    but not the weights of an nn.LSTM used directly."""
+
+    def __init__(self, lstm, embed_size):
+        super(UnfusedLSTM, self).__init__()
+
+        def linear(weight, bias=None):
+            layer = nn.Linear(weight.size(1), weight.size(0), bias=bias is not None)
+            layer.weight = nn.Parameter(weight.detach().clone())
+            if bias is not None:
+                layer.bias = nn.Parameter(bias.detach().clone())
+            return layer
+
+        self.persist = linear(lstm.weight_ih_l0[:, embed_size:])
+        self.ih = nn.ModuleList()
+        self.hh = nn.ModuleList()
+        for layer in range(lstm.num_layers):
+            weight_ih = getattr(lstm, 'weight_ih_l{}'.format(layer))
+            if layer == 0:
+                weight_ih = weight_ih[:, :embed_size]
+            self.ih.append(linear(weight_ih, getattr(lstm, 'bias_ih_l{}'.format(layer))))
+            self.hh.append(linear(getattr(lstm, 'weight_hh_l{}'.format(layer)),
+                                  getattr(lstm, 'bias_hh_l{}'.format(layer))))
+
+
 class DecoderRNN(nn.Module):
-    def __init__(self, p, vocab_size, ext_features_dim=0):
-        """Set the hyper-parameters and build the layers."""
+    def __init__(self, p, vocab_size, ext_features_dim=0, shared_extractors=None):
+        """Set the hyper-parameters and build the layers.  shared_extractors is
+        passed to FeatureExtractor.list()."""
         super(DecoderRNN, self).__init__()
 
         self.embed = nn.Embedding(vocab_size, p.embed_size)
 
         (self.extractors,
-         int_features_dim) = FeatureExtractor.list(p.persist_features.internal)
+         int_features_dim) = FeatureExtractor.list(p.persist_features.internal,
+                                                   shared_extractors)
         # Sum of the dimensionalities of the concatenated features
         total_feat_dim = ext_features_dim + int_features_dim
 
         print('DecoderCNN: total feature dim={}'.format(total_feat_dim))
 
+        self.embed_size = p.embed_size
+        self.hidden_size = p.hidden_size
+        self.num_layers = p.num_layers
+        self.dropout = p.dropout
+
+        # The persistent features are concatenated to the input of the first
+        # LSTM layer at each time step
+        self.persist_size = total_feat_dim
         self.lstm = nn.LSTM(p.embed_size + total_feat_dim, p.hidden_size,
                             p.num_layers, dropout=p.dropout, batch_first=True)
-        self.linear = nn.Linear(p.hidden_size, vocab_size)
+        self.linear = output_layer(p, p.hidden_size, vocab_size)
 
-    def _cat_features(self, images, external_features):
+    def _persist_gates(self, persist_features):
+        """The persist features part of the gate pre-activations of the first
+        LSTM layer, which is the same at each time step"""
+        if persist_features is None:
+            return None
+        if isinstance(self.lstm, UnfusedLSTM):
+            return self.lstm.persist(persist_features)
+        return F.linear(persist_features, self.lstm.weight_ih_l0[:, self.embed_size:])
+
+    def _input_gates(self, layer, x):
+        """The input part of the gate pre-activations of the given LSTM layer,
+        without the persist features for the first layer"""
+        lstm = self.lstm
+        if isinstance(lstm, UnfusedLSTM):
+            return lstm.ih[layer](x)
+        weight = getattr(lstm, 'weight_ih_l{}'.format(layer))
+        if layer == 0:
+            weight = weight[:, :self.embed_size]
+        return F.linear(x, weight, getattr(lstm, 'bias_ih_l{}'.format(layer)))
+
+    def _layer_step(self, layer, gates_x, h, c):
+        """One time step of the given LSTM layer, from the input part of its
+        gate pre-activations gates_x"""
+        lstm = self.lstm
+        if isinstance(lstm, UnfusedLSTM):
+            gates = gates_x + lstm.hh[layer](h)
+        else:
+            gates = gates_x + F.linear(h, getattr(lstm, 'weight_hh_l{}'.format(layer)),
+                                       getattr(lstm, 'bias_hh_l{}'.format(layer)))
+        i, f, g, o = gates.chunk(4, 1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        return torch.sigmoid(o) * torch.tanh(c), c
+
+    def _step(self, inputs, persist_gates, states):
+        """One time step of the LSTM for inputs (batch_size, embed_size), returns
+        the hidden state of the top layer and the new states.  persist_gates is
+        from _persist_gates(), or None if there are no persist features."""
+        if persist_gates is None:
+            hiddens, states = self.lstm(inputs.unsqueeze(1), states)
+            return hiddens.squeeze(1), states
+
+        # Same as self.lstm on the concatenated [inputs, persist features], with
+        # the persist features part of the first layer computed once by
+        # _persist_gates() instead of at each step
+        if states is None:
+            states = (inputs.new_zeros(self.num_layers, inputs.size(0), self.hidden_size),) * 2
+        h, c = states
+        gates_x = self._input_gates(0, inputs) + persist_gates
+        new_h = []
+        new_c = []
+        for layer in range(self.num_layers):
+            if layer > 0:
+                gates_x = self._input_gates(layer, F.dropout(new_h[-1], self.dropout,
+                                                             self.training))
+            h_layer, c_layer = self._layer_step(layer, gates_x, h[layer], c[layer])
+            new_h.append(h_layer)
+            new_c.append(c_layer)
+        return new_h[-1], (torch.stack(new_h), torch.stack(new_c))
+
+    def _packed_layer(self, layer, gates_x, batch_sizes):
+        """Runs the given LSTM layer step by step on the input part gates_x of
+        its gate pre-activations, packed as batch_sizes, and returns its packed
+        hidden states"""
+        # Rows of packed data are grouped by time step, each step holding the
+        # batch_size_t longest sequences, see pack_padded_sequence()
+        h = c = gates_x.new_zeros(int(batch_sizes[0]), self.hidden_size)
+        hiddens = []
+        offset = 0
+        for batch_size_t in batch_sizes.tolist():
+            h, c = self._layer_step(layer, gates_x[offset:offset + batch_size_t],
+                                    h[:batch_size_t], c[:batch_size_t])
+            hiddens.append(h)
+            offset += batch_size_t
+        return torch.cat(hiddens, 0)
+
+    def _packed_lstm(self, embeddings, lengths, persist_gates):
+        """Same as self.lstm on the packed concatenated [embeddings, persist
+        features], returns the packed hidden states of the top layer.  The
+        embedding part of the first layer input is projected for all time
+        steps in one matrix product and the persist features part once per
+        sequence, and the first layer runs step by step on these gates.  The
+        other layers run in one fused LSTM call."""
+        packed = pack_padded_sequence(embeddings, lengths, batch_first=True)
+        batch_sizes = packed.batch_sizes
+        # The persist gates of the sequences at each step, in packed order
+        persist_rows = torch.cat([persist_gates[:batch_size_t]
+                                  for batch_size_t in batch_sizes.tolist()], 0)
+        hiddens = self._packed_layer(0, self._input_gates(0, packed.data) + persist_rows,
+                                     batch_sizes)
+        if self.num_layers == 1:
+            return hiddens
+
+        lstm = self.lstm
+        if isinstance(lstm, UnfusedLSTM):
+            for layer in range(1, self.num_layers):
+                x = F.dropout(hiddens, self.dropout, self.training)
+                hiddens = self._packed_layer(layer, self._input_gates(layer, x), batch_sizes)
+            return hiddens
+        params = [getattr(lstm, '{}_l{}'.format(name, layer))
+                  for layer in range(1, self.num_layers)
+                  for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh')]
+        zeros = embeddings.new_zeros(self.num_layers - 1, embeddings.size(0), self.hidden_size)
+        return torch.lstm(F.dropout(hiddens, self.dropout, self.training), batch_sizes,
+                          (zeros, zeros), params, True, self.num_layers - 1, self.dropout,
+                          self.training, False)[0]
+
+    def unfuse_lstm(self):
+        """Replaces self.lstm by an UnfusedLSTM with the same weights, so that
+        quantize_dynamic() can quantize all the matrix products of _step()"""
+        if self.persist_size and not isinstance(self.lstm, UnfusedLSTM):
+            self.lstm = UnfusedLSTM(self.lstm, self.embed_size)
+
+    def _cat_features(self, images, external_features, image_ids=None):
         """Concatenate internal and external features"""
         feat_outputs = []
         # Extract features with each extractor (internal feature)
         for ext in self.extractors:
-            feat_outputs.append(ext(images))
+            feat_outputs.append(ext(images, image_ids))
         # Also add external features
         if external_features is not None:
             feat_outputs.append(external_features)
@@ -279,8 +669,10 @@ class DecoderRNN(nn.Module):
         return torch.cat(feat_outputs, 1) if feat_outputs else None
 
     def forward(self, features, captions, lengths, images, external_features=None,
-                teacher_p=1.0, teacher_forcing='always'):
-        """Decode image feature vectors and generates captions."""
+                teacher_p=1.0, teacher_forcing='always', image_ids=None, hiddens_only=False):
+        """Decode image feature vectors and generates captions.  With
+        hiddens_only=True the packed hidden states are returned instead of the
+        word scores, see hiddens_loss()."""
 
         # First, construct embeddings input, with initial feature as
         # the first: (batch_size, 1 + longest caption length, embed_size)
@@ -290,33 +682,31 @@ class DecoderRNN(nn.Module):
         seq_length = embeddings.size()[1]
 
         with torch.no_grad():
-            persist_features = self._cat_features(images, external_features)
-            if persist_features is None:
-                persist_features = features.new_empty(0)
-            else:
-                # Get into shape: batch_size, seq_length, embed_size
-                persist_features = (persist_features.unsqueeze(1).
-                                    expand(-1, seq_length, -1))
+            persist_features = self._cat_features(images, external_features, image_ids)
 
         if teacher_forcing == 'always':
             # Teacher forcing enabled -
             # Feed ground truth as next input at each time-step when training:
-            inputs = torch.cat([embeddings, persist_features], 2)
-            packed = pack_padded_sequence(inputs, lengths, batch_first=True)
-            hiddens, _ = self.lstm(packed)
-            outputs = self.linear(hiddens[0])
+            if persist_features is None:
+                packed = pack_padded_sequence(embeddings, lengths, batch_first=True)
+                hiddens = self.lstm(packed)[0].data
+            else:
+                hiddens = self._packed_lstm(embeddings, lengths,
+                                            self._persist_gates(persist_features))
+            outputs = hiddens if hiddens_only else self.linear(hiddens)
         else:
             # Use sampled or additive scheduling mode:
+            persist_gates = self._persist_gates(persist_features)
             batch_size = features.size()[0]
-            vocab_size = self.linear.out_features
-            outputs = torch.zeros(batch_size, seq_length, vocab_size).to(device)
+            output_size = self.linear.in_features if hiddens_only else self.linear.out_features
+            outputs = torch.zeros(batch_size, seq_length, output_size).to(device)
             states = None
-            inputs = torch.cat([features, persist_features], 1).unsqueeze(1)
+            inputs = features
 
             for t in range(seq_length - 1):
-                hiddens, states = self.lstm(inputs, states)
-                step_output = self.linear(hiddens.squeeze(1))
-                outputs[:, t, :] = step_output
+                hiddens, states = self._step(inputs, persist_gates, states)
+                step_output = self.linear(hiddens)
+                outputs[:, t, :] = hiddens if hiddens_only else step_output
 
                 if teacher_forcing == 'sampled':
                     # Sampled mode: sample next token from lstm with probability
@@ -362,7 +752,7 @@ class DecoderRNN(nn.Module):
                     # Invalid teacher forcing mode specified
                     return None
 
-                inputs = torch.cat([embed_t, persist_features], 1).unsqueeze(1)
+                inputs = embed_t
 
             # Generate a packed sequence of outputs with generated captions assuming
             # exactly the same lengths are ground-truth. If needed, model could be modified
@@ -372,31 +762,287 @@ class DecoderRNN(nn.Module):
 
         return outputs
 
-    def sample(self, features, images, external_features, states=None, max_seq_length=20):
-        """Generate captions for given image features using greedy search."""
-        sampled_ids = []
-
-        # Concatenate internal and external features
-        persist_features = self._cat_features(images, external_features)
-        if persist_features is None:
-            persist_features = features.new_empty(0)
-
-        # inputs: (batch_size, 1, embed_size + len(external features))
-        inputs = torch.cat([features, persist_features], 1).unsqueeze(1)
-
-        for i in range(max_seq_length):
-            hiddens, states = self.lstm(inputs, states)
-            outputs = self.linear(hiddens.squeeze(1))
-            _, predicted = outputs.max(1)
-            sampled_ids.append(predicted)
+    def hiddens_loss(self, hiddens, targets, chunk_size):
+        """Cross-entropy loss of the hidden states returned by forward() with
+        hiddens_only=True, see chunked_cross_entropy()"""
+        return chunked_cross_entropy(self.linear, hiddens, targets, chunk_size) / targets.size(0)
+
+    def init_decoding(self, features, images, external_features, states=None,
+                      start_id=None, image_ids=None):
+        """Initial inputs, states and per-image context for beam_search()"""
+        persist_features = self._cat_features(images, external_features, image_ids)
+        return features, states, self._persist_gates(persist_features), None
+
+    def decode_step(self, inputs, states, persist_gates):
+        hiddens, states = self._step(inputs, persist_gates, states)
+        return hiddens, states, None
+
+    def select_states(self, states, index):
+        # nn.LSTM states are (num_layers, batch_size, hidden_size)
+        return select_rows(states, index, 1)
+
+    def sample(self, features, images, external_features, states=None, max_seq_length=20,
+               beam_size=1, start_id=None, end_id=None, image_ids=None):
+        """Generate captions for given image features using beam search, greedy
+        search by default, see beam_search()."""
+        sampled_ids, _ = beam_search(self, features, images, external_features,
+                                     max_seq_length, beam_size, start_id, end_id, states,
+                                     image_ids)
+        return sampled_ids
 
-            # inputs: (batch_size, 1, embed_size + len(external_features))
-            embeddings = self.embed(predicted)
-            inputs = torch.cat([embeddings, persist_features], 1).unsqueeze(1)
 
-        # sampled_ids: (batch_size, max_seq_length)
-        sampled_ids = torch.stack(sampled_ids, 1)
-        return sampled_ids
+def select_rows(x, index, dim=0):
+    """Selects index along dim of tensor x, or of all tensors in the (nested)
+    tuple x, as needed for reordering decoder states and contexts"""
+    if x is None:
+        return None
+    if isinstance(x, (tuple, list)):
+        return type(x)(select_rows(i, index, dim) for i in x)
+    return x.index_select(dim, index)
+
+
+@torch.no_grad()
+def beam_search(decoder, features, images, external_features, max_seq_length=20,
+                beam_size=1, start_id=None, end_id=None, states=None, image_ids=None):
+    """Batched beam search for decoders implementing init_decoding(),
+    decode_step() and select_states(), decode_step() returning the inputs of
+    decoder.linear.  The beams of all images are decoded as one batch of
+    (images x beam_size) rows, and the rows of an image are dropped as soon as
+    none of its unfinished hypotheses can beat its best finished one, so the
+    batch shrinks as captions end.  beam_size=1 is greedy search, which stops
+    at <end> in the same way.  Without end_id all max_seq_length steps are
+    decoded.  Returns the best token sequences (batch_size, length), padded
+    with end_id, and the corresponding attention weights or None."""
+    inputs, states, context, prefix = decoder.init_decoding(features, images,
+                                                            external_features, states,
+                                                            start_id, image_ids)
+    batch_size = inputs.size(0)
+    K = beam_size
+    dev = inputs.device
+
+    # Every image starts with K copies of the same row, only the first of which
+    # is alive, so the first step does not pick the same word K times
+    rows = torch.arange(batch_size, device=dev).repeat_interleave(K)
+    inputs = inputs.index_select(0, rows)
+    states = decoder.select_states(states, rows)
+    context = select_rows(context, rows)
+    scores = torch.full((batch_size, K), float('-inf'), device=dev)
+    scores[:, 0] = 0
+    tokens = torch.zeros(batch_size * K, 0, dtype=torch.long, device=dev)
+    alphas = None
+
+    items = torch.arange(batch_size, device=dev)  # images still being decoded
+    best_scores = torch.full((batch_size,), float('-inf'), device=dev)
+    best_tokens = [None] * batch_size
+    best_alphas = [None] * batch_size
+
+    for t in range(max_seq_length):
+        hiddens, states, alpha = decoder.decode_step(inputs, states, context)
+        if alpha is not None:
+            alpha = alpha.unsqueeze(1)
+            alphas = alpha if alphas is None else torch.cat([alphas, alpha], 1)
+
+        # The 2K best candidates of an image are among the 2K best words of
+        # each of its rows
+        log_probs, row_words = top_log_probs(decoder.linear, hiddens, 2 * K)
+        num_words = log_probs.size(1)
+        num_items = items.size(0)
+        candidates = (scores.view(-1, 1) + log_probs).view(num_items, K * num_words)
+        top_scores, top_idx = candidates.topk(min(2 * K, K * num_words), 1)
+        top_rows = (torch.arange(num_items, device=dev).unsqueeze(1) * K +
+                    top_idx // num_words)
+        top_words = row_words.view(num_items, K * num_words).gather(1, top_idx)
+
+        # Hypotheses end with <end> among the K best candidates, or with any
+        # word at the maximum length
+        if end_id is not None:
+            is_end = top_words == end_id
+        else:
+            is_end = torch.zeros_like(top_words, dtype=torch.bool)
+        if t == max_seq_length - 1:
+            ending = torch.zeros_like(is_end)
+            ending[:, 0] = True
+        else:
+            ending = is_end.clone()
+            ending[:, K:] = False
+        end_scores, end_pos = top_scores.masked_fill(~ending, float('-inf')).max(1)
+        improved = end_scores > best_scores[items]
+        for i in improved.nonzero().view(-1).tolist():
+            item = items[i].item()
+            row = top_rows[i, end_pos[i]]
+            best_scores[item] = end_scores[i]
+            best_tokens[item] = torch.cat([tokens[row], top_words[i, end_pos[i]].view(1)])
+            if alphas is not None:
+                best_alphas[item] = alphas[row]
+
+        # The K best candidates without <end> continue, the sort is stable so
+        # they stay in order of score
+        order = is_end.long().argsort(dim=1, stable=True)[:, :K]
+        scores = top_scores.gather(1, order)
+        rows = top_rows.gather(1, order)
+        words = top_words.gather(1, order)
+
+        # Log probabilities only decrease, so an image is done when its best
+        # finished hypothesis is at least as good as its best unfinished one
+        alive = scores[:, 0] > best_scores[items]
+        if t == max_seq_length - 1 or not alive.any():
+            break
+        rows = rows[alive].view(-1)
+        items = items[alive]
+        scores = scores[alive]
+        words = words[alive].view(-1)
+
+        tokens = torch.cat([tokens.index_select(0, rows), words.unsqueeze(1)], 1)
+        if alphas is not None:
+            alphas = alphas.index_select(0, rows)
+        states = decoder.select_states(states, rows)
+        context = select_rows(context, rows)
+        inputs = decoder.embed(words)
+
+    length = max(len(x) for x in best_tokens)
+    sampled_ids = torch.full((batch_size, length), end_id if end_id is not None else 0,
+                             dtype=torch.long, device=dev)
+    for i, x in enumerate(best_tokens):
+        sampled_ids[i, :len(x)] = x
+    if prefix is not None:
+        sampled_ids = torch.cat([prefix, sampled_ids], 1)
+
+    if best_alphas[0] is None:
+        return sampled_ids, None
+    sampled_alphas = features.new_zeros(batch_size, length, best_alphas[0].size(1))
+    for i, x in enumerate(best_alphas):
+        sampled_alphas[i, :len(x)] = x
+    return sampled_ids, sampled_alphas
+
+
+def _cross_entropy_sum(output_layer, hiddens, targets):
+    if isinstance(output_layer, AdaptiveSoftmax):
+        return output_layer.cross_entropy_sum(hiddens, targets)
+    return F.cross_entropy(output_layer(hiddens), targets, reduction='sum')
+
+
+def chunked_cross_entropy(linear, hiddens, targets, chunk_size):
+    """Sum of the cross-entropy losses of linear(hiddens) for targets, computed
+    chunk_size rows at a time.  When training, each chunk is checkpointed, so
+    that its word scores are freed right after its loss is computed and
+    recomputed in the backward pass.  Only the scores of one chunk of tokens
+    are thus held in memory at a time instead of (tokens x vocab_size).
+    Without chunk_size all rows are done at once without checkpointing.  For
+    an AdaptiveSoftmax linear its clustered loss is used."""
+    if not chunk_size:
+        return _cross_entropy_sum(linear, hiddens, targets)
+    loss = hiddens.new_zeros(())
+    for i in range(0, hiddens.size(0), chunk_size):
+        args = (linear, hiddens[i:i + chunk_size], targets[i:i + chunk_size])
+        if torch.is_grad_enabled():
+            loss = loss + checkpoint(_cross_entropy_sum, *args, use_reentrant=False)
+        else:
+            loss = loss + _cross_entropy_sum(*args)
+    return loss
+
+
+class ChunkedCrossEntropyLoss:
+    """Same as nn.CrossEntropyLoss() applied to the word scores of decoder, but
+    takes the hidden states the models return with hiddens_only=True, and
+    computes the word scores in chunks of chunk_size tokens, or all at once
+    if chunk_size is 0"""
+
+    def __init__(self, decoder, chunk_size):
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+
+    def __call__(self, hiddens, targets):
+        return self.decoder.hiddens_loss(hiddens, targets, self.chunk_size)
+
+
+class AdaptiveSoftmax(nn.Module):
+    """Adaptive softmax output layer, see nn.AdaptiveLogSoftmaxWithLoss.  The
+    words are ordered by word_counts, so that the most frequent ones are in the
+    head and the rarer ones in the tail clusters, whose scores are only
+    computed when needed.  The order is stored in the state of the layer, so
+    word_counts is only needed when creating a new model.  Called on hidden
+    states it returns the log probabilities of all words, in vocabulary order."""
+
+    def __init__(self, in_features, vocab_size, cutoffs, word_counts=None, div_value=4.0):
+        super(AdaptiveSoftmax, self).__init__()
+        self.in_features = in_features
+        self.out_features = vocab_size
+        cutoffs = [c for c in cutoffs if c < vocab_size]
+        if not cutoffs:
+            raise ValueError('No adaptive softmax cutoff is smaller than the vocabulary '
+                             'size {}'.format(vocab_size))
+        self.asm = nn.AdaptiveLogSoftmaxWithLoss(in_features, vocab_size, cutoffs,
+                                                 div_value=div_value)
+
+        if word_counts is None:
+            words = torch.arange(vocab_size)
+        else:
+            assert len(word_counts) == vocab_size, \
+                'got {} word counts for {} words'.format(len(word_counts), vocab_size)
+            words = torch.as_tensor(np.asarray(word_counts)).argsort(descending=True,
+                                                                    stable=True)
+        # words[rank] is the vocabulary index of a word, ranks[index] its rank
+        self.register_buffer('words', words)
+        self.register_buffer('ranks', torch.empty_like(words).scatter_(
+            0, words, torch.arange(vocab_size)))
+
+    def forward(self, hiddens):
+        return self.asm.log_prob(hiddens).index_select(1, self.ranks)
+
+    def cross_entropy_sum(self, hiddens, targets):
+        """Sum of the cross-entropy losses for targets, using only the head and
+        the clusters of the targets"""
+        return -self.asm(hiddens, self.ranks[targets]).output.sum()
+
+    def topk_log_prob(self, hiddens, k):
+        """The k highest log probabilities of each row of hiddens and their word
+        indices, at most as many as there are words in the head.  A tail cluster
+        is only computed for the rows where it is more likely than the k-th best
+        word found so far, as none of its words can be more likely than that."""
+        asm = self.asm
+        shortlist = asm.shortlist_size
+        head_log_probs = F.log_softmax(asm.head(hiddens), 1)
+        top_log_probs, top_ranks = head_log_probs[:, :shortlist].topk(min(k, shortlist), 1)
+
+        for i, cluster in enumerate(asm.tail):
+            cluster_log_probs = head_log_probs[:, shortlist + i]
+            rows = (cluster_log_probs > top_log_probs[:, -1]).nonzero().view(-1)
+            if rows.numel() == 0:
+                continue
+            tail_log_probs = (F.log_softmax(cluster(hiddens[rows]), 1) +
+                              cluster_log_probs[rows].unsqueeze(1))
+            tail_ranks = torch.arange(asm.cutoffs[i], asm.cutoffs[i + 1],
+                                      device=hiddens.device).expand(rows.size(0), -1)
+            log_probs, idx = torch.cat([top_log_probs[rows], tail_log_probs], 1).topk(
+                top_log_probs.size(1), 1)
+            top_log_probs[rows] = log_probs
+            top_ranks[rows] = torch.cat([top_ranks[rows], tail_ranks], 1).gather(1, idx)
+
+        return top_log_probs, self.words[top_ranks]
+
+
+def output_layer(p, in_features, vocab_size):
+    """The layer giving the word scores of a decoder, an AdaptiveSoftmax with
+    the cutoffs p.adaptive_softmax if set, a plain nn.Linear otherwise.  A
+    vocabulary that fits in the head of the adaptive softmax, with no cutoff
+    smaller than its size, also gets an nn.Linear."""
+    cutoffs = getattr(p, 'adaptive_softmax', None)
+    if cutoffs and not any(c < vocab_size for c in cutoffs):
+        print('WARNING: no adaptive softmax cutoff is smaller than the vocabulary '
+              'size {}, using a full softmax'.format(vocab_size))
+        cutoffs = None
+    if cutoffs:
+        return AdaptiveSoftmax(in_features, vocab_size, cutoffs,
+                               getattr(p, 'word_counts', None))
+    return nn.Linear(in_features, vocab_size)
+
+
+def top_log_probs(output_layer, hiddens, k):
+    """The k highest log probabilities of the words given by output_layer on
+    hiddens, and the corresponding word indices"""
+    if isinstance(output_layer, AdaptiveSoftmax):
+        return output_layer.topk_log_prob(hiddens, k)
+    return F.log_softmax(output_layer(hiddens), 1).topk(min(k, output_layer.out_features), 1)
 
 
 class SpatialAttention(nn.Module):
@@ -418,13 +1064,20 @@ class SpatialAttention(nn.Module):
         self.relu = nn.ReLU()
         self.softmax = nn.Softmax(dim=1)  # (dim=0 is our current minitbatch)
 
-    def forward(self, features, h):
+    def project(self, features):
+        """Image part of the attention logits, which stays the same for all time
+        steps of a sequence, so it can be computed once and passed to forward()"""
+        return self.image_att(features)
+
+    def forward(self, features, h, att_img: Optional[torch.Tensor] = None):
         """ Forward step for attention network
         features - convolutional image features of shape ((W' * H') , C)
-        h - hidden state of the decoder"""
+        h - hidden state of the decoder
+        att_img - project(features), computed here if not given"""
 
         # torch.Size([128, 49, 49])
-        att_img = self.image_att(features)
+        if att_img is None:
+            att_img = self.image_att(features)
         # torch.Size([128, 49])
         att_h = self.lstm_att(h)
 
@@ -440,10 +1093,19 @@ class SpatialAttention(nn.Module):
 class SoftAttentionDecoderRNN(nn.Module):
     # Show, attend, and tell soft attention implementation based on
     # https://github.com/sgrvinod/a-PyTorch-Tutorial-to-Image-Captioning
-    def __init__(self, p, vocab_size, ext_features_dim=0):
-        """Set the hyper-parameters and build the layers."""
+    def __init__(self, p, vocab_size, ext_features_dim=0, shared_extractors=None):
+        """Set the hyper-parameters and build the layers.  The spatial features
+        are external, or computed by one internal persist feature such as
+        resnet152-conv, shared_extractors being passed to FeatureExtractor.list()."""
         super(SoftAttentionDecoderRNN, self).__init__()
 
+        self.extractors, _ = FeatureExtractor.list(p.persist_features.internal,
+                                                   shared_extractors)
+        if len(self.extractors) > 0:
+            assert len(self.extractors) == 1 and not ext_features_dim, \
+                'attention needs exactly one set of spatial features'
+            ext_features_dim = self.extractors[0].output_dim
+
         print('SoftAttentionDecoderRNN: total feature dim: {}'.
               format(ext_features_dim))
 
@@ -482,7 +1144,7 @@ class SoftAttentionDecoderRNN(nn.Module):
         self.lstm_step = nn.LSTMCell(p.embed_size + self.feature_size, p.hidden_size)
 
         # fc layer that predicts scores for each word in vocabulary
-        self.linear = nn.Linear(p.hidden_size, vocab_size)
+        self.linear = output_layer(p, p.hidden_size, vocab_size)
 
         # Init some weights from uniform distribution
         self.init_weights()
@@ -491,8 +1153,15 @@ class SoftAttentionDecoderRNN(nn.Module):
         """ Initializes some parameters with values from the uniform distribution,
         for easier convergence. """
         self.embed.weight.data.uniform_(-0.1, 0.1)
-        self.linear.bias.data.fill_(0)
-        self.linear.weight.data.uniform_(-0.1, 0.1)
+        if isinstance(self.linear, nn.Linear):
+            self.linear.bias.data.fill_(0)
+            self.linear.weight.data.uniform_(-0.1, 0.1)
+
+    def _spatial_features(self, images, external_features, image_ids=None):
+        """The spatial features as (batch_size, num_attention_locs, feature_size)"""
+        if len(self.extractors) > 0:
+            external_features = self.extractors[0](images, image_ids).reshape(images.size(0), -1)
+        return external_features.view(external_features.size(0), -1, self.feature_size)
 
     def init_hidden_state(self, features):
         """Initialize the initial hidden and cell state of the LSTM"""
@@ -503,7 +1172,7 @@ class SoftAttentionDecoderRNN(nn.Module):
         return h, c
 
     def forward(self, encoder_features, captions, lengths, images, external_features=None,
-                teacher_p=1.0, teacher_forcing='always'):
+                teacher_p=1.0, teacher_forcing='always', image_ids=None, hiddens_only=False):
 
         batch_size = captions.size()[0]
         seq_length = captions.size()[1]
@@ -511,24 +1180,29 @@ class SoftAttentionDecoderRNN(nn.Module):
         # Flatten (BS x W x H x C) image to (BS x (W*H) x C),
         # where self.feature_size is for example 2048 in case of ResNet152
         # 224x224 input images:
-        features = external_features.view(batch_size, -1, self.feature_size)
+        features = self._spatial_features(images, external_features, image_ids)
 
         embeddings = self.embed(captions)
 
         h, c = self.init_hidden_state(features)
 
         # Store predictions and alphas here:
-        outputs = torch.zeros(batch_size, seq_length, self.vocab_size).to(device)
+        output_size = self.hidden_size if hiddens_only else self.vocab_size
+        outputs = torch.zeros(batch_size, seq_length, output_size).to(device)
         alphas = torch.zeros(batch_size, seq_length, self.num_attention_locs).to(device)
 
-        index = captions[:, 0].unsqueeze(1)
-        # Create one-hot encoding of the <start> token:
-        outputs[:, 0] = torch.zeros(batch_size,
-                                    self.vocab_size).to(device).scatter_(1, index, 1)
+        if not hiddens_only:
+            index = captions[:, 0].unsqueeze(1)
+            # Create one-hot encoding of the <start> token:
+            outputs[:, 0] = torch.zeros(batch_size,
+                                        self.vocab_size).to(device).scatter_(1, index, 1)
+
+        att_img = self.attention.project(features)
 
         for t in range(seq_length - 1):
             batch_size_t = sum([l > t for l in lengths])
-            att_context, alpha = self.attention(features[:batch_size_t], h[:batch_size_t])
+            att_context, alpha = self.attention(features[:batch_size_t], h[:batch_size_t],
+                                                att_img[:batch_size_t])
 
             # Perform the gating as per Show, Attend and Tell:
             gate = self.sigmoid(self.f_beta(h[:batch_size_t]))
@@ -538,43 +1212,67 @@ class SoftAttentionDecoderRNN(nn.Module):
                 torch.cat([embeddings[:batch_size_t, t], att_context], dim=1),
                 (h[:batch_size_t], c[:batch_size_t]))
 
-            outputs_t = self.linear(self.dropout(h))
+            outputs_t = self.dropout(h)
+            if not hiddens_only:
+                outputs_t = self.linear(outputs_t)
             outputs[:batch_size_t, t + 1] = outputs_t
 
             alphas[:batch_size_t, t + 1] = alpha
 
         outputs = pack_padded_sequence(outputs, lengths, batch_first=True)[0]
+        if hiddens_only:
+            # The first batch_size rows are the <start> positions, which have
+            # no hidden state, see hiddens_loss()
+            outputs = outputs[batch_size:]
 
         return outputs, alphas
 
-    def sample(self, features, images, external_features, states=None, max_seq_length=20):
-        sampled_ids = []
-        batch_size = len(images)
-        alphas = torch.zeros(batch_size, max_seq_length, self.num_attention_locs).to(device)
-
-        features = external_features.view(batch_size, -1, self.feature_size)
-
-        h, c = self.init_hidden_state(features)
-
-        # inputs: (batch_size, 1, embed_size + len(external features))
-        inputs = features.unsqueeze(1)
-
-        for t in range(max_seq_length):
-            att_context, alpha = self.attention(features, h)
-            h, c = self.lstm_step(torch.cat([
-                inputs], dim=1), (h, c))
-            alphas[:, t] = alpha
-            outputs = self.linear(torch.cat([h, att_context], dim=1))
-            _, predicted = outputs.max(1)
-            sampled_ids.append(predicted)
-
-            # inputs: (batch_size, 1, embed_size + len(external_features))
-            embeddings = self.embed(predicted)
-            inputs = embeddings.unsqueeze(1)
-
-        # sampled_ids: (batch_size, max_seq_length)
-        sampled_ids = torch.stack(sampled_ids, 1)
-        return sampled_ids, alphas
+    def hiddens_loss(self, hiddens, targets, chunk_size):
+        """Cross-entropy loss of the hidden states returned by forward() with
+        hiddens_only=True, see chunked_cross_entropy()"""
+        # The scores at the <start> positions are the one-hot encodings of
+        # <start>, as in forward()
+        num_start = targets.size(0) - hiddens.size(0)
+        start_targets = targets[:num_start]
+        start_scores = hiddens.new_zeros(num_start, self.vocab_size).scatter_(
+            1, start_targets.unsqueeze(1), 1)
+        loss = F.cross_entropy(start_scores, start_targets, reduction='sum')
+        loss = loss + chunked_cross_entropy(self.linear, hiddens, targets[num_start:],
+                                            chunk_size)
+        return loss / targets.size(0)
+
+    def init_decoding(self, features, images, external_features, states=None,
+                      start_id=None, image_ids=None):
+        """Initial inputs, states and per-image context for beam_search().  Like
+        in training, decoding starts from the hidden state computed from the
+        mean image features, with <start> as the first input word."""
+        assert start_id is not None, 'SoftAttentionDecoderRNN needs the <start> token id'
+        features = self._spatial_features(images, external_features, image_ids)
+        batch_size = features.size(0)
+        if states is None:
+            states = self.init_hidden_state(features)
+        start = torch.full((batch_size, 1), start_id, dtype=torch.long,
+                           device=features.device)
+        return (self.embed(start[:, 0]), states,
+                (features, self.attention.project(features)), start)
+
+    def decode_step(self, inputs, states, context):
+        h, c = states
+        features, att_img = context
+        att_context, alpha = self.attention(features, h, att_img)
+        att_context = self.sigmoid(self.f_beta(h)) * att_context
+        h, c = self.lstm_step(torch.cat([inputs, att_context], dim=1), (h, c))
+        return self.dropout(h), (h, c), alpha
+
+    def select_states(self, states, index):
+        return select_rows(states, index)
+
+    def sample(self, features, images, external_features, states=None, max_seq_length=20,
+               beam_size=1, start_id=None, end_id=None, image_ids=None):
+        """Generate captions for given image features using beam search, greedy
+        search by default, see beam_search()."""
+        return beam_search(self, features, images, external_features, max_seq_length,
+                           beam_size, start_id, end_id, states, image_ids)
 
 
 class SoftAttentionEncoderDecoder(nn.Module):
@@ -582,8 +1280,12 @@ class SoftAttentionEncoderDecoder(nn.Module):
         super(SoftAttentionEncoderDecoder, self).__init__()
         print('Using device: {}'.format(device.type))
         print('Initializing SoftAttentionEncoderDecoder model...')
-        self.encoder = EncoderCNN(params, ef_dims[0]).to(device)
-        self.decoder = SoftAttentionDecoderRNN(params, vocab_size, ef_dims[1]).to(device)
+        # The spatial features may come from the same trunk as the encoder
+        # features, e.g. resnet152 and resnet152-conv, computed in one pass
+        extractors = SharedExtractors()
+        self.encoder = EncoderCNN(params, ef_dims[0], extractors).to(device)
+        self.decoder = SoftAttentionDecoderRNN(params, vocab_size, ef_dims[1],
+                                                  extractors).to(device)
 
         self.opt_params = (list(self.decoder.parameters()) +
                            list(self.encoder.linear.parameters()) +
@@ -597,21 +1299,33 @@ class SoftAttentionEncoderDecoder(nn.Module):
         return self.opt_params
 
     def forward(self, images, init_features, captions, lengths, persist_features,
-                teacher_p=1.0, teacher_forcing='always'):
-        features = self.encoder(images, init_features)
+                teacher_p=1.0, teacher_forcing='always', image_ids=None, hiddens_only=False):
+        features = self.encoder(images, init_features, image_ids)
         outputs, alphas = self.decoder(features, captions, lengths, images, persist_features,
-                                       teacher_p, teacher_forcing)
+                                       teacher_p, teacher_forcing, image_ids,
+                                       hiddens_only=hiddens_only)
         return outputs, alphas
 
     def sample(self, image_tensor, init_features, persist_features, states=None,
-               max_seq_length=20):
-        pass
+               max_seq_length=20, beam_size=1, start_id=None, end_id=None, image_ids=None):
+        features = self.encoder(image_tensor, init_features, image_ids)
+        return self.decoder.sample(features, image_tensor, persist_features, states,
+                                   max_seq_length, beam_size, start_id, end_id, image_ids)
 
 
 class SpatialAttentionDecoderRNN(nn.Module):
-    def __init__(self, p, vocab_size, ext_features_dim=0):
-        """Set the hyper-parameters and build the layers."""
+    def __init__(self, p, vocab_size, ext_features_dim=0, shared_extractors=None):
+        """Set the hyper-parameters and build the layers.  The spatial features
+        are external, or computed by one internal persist feature such as
+        resnet152-conv, shared_extractors being passed to FeatureExtractor.list()."""
         super(SpatialAttentionDecoderRNN, self).__init__()
+
+        self.extractors, _ = FeatureExtractor.list(p.persist_features.internal,
+                                                   shared_extractors)
+        if len(self.extractors) > 0:
+            assert len(self.extractors) == 1 and not ext_features_dim, \
+                'attention needs exactly one set of spatial features'
+            ext_features_dim = self.extractors[0].output_dim
         self.embed = nn.Embedding(vocab_size, p.embed_size)
 
         print('SpatialAttentionDecoderRNN: total feature dim: {}'.
@@ -621,8 +1335,8 @@ class SpatialAttentionDecoderRNN(nn.Module):
             "wrong number of input feature dimensions %d" % len(ext_features_dim)
 
         self.vocab_size = vocab_size
-        self.feature_size = ext_features_dim[0]
-        self.num_attention_locs = ext_features_dim[1] * ext_features_dim[2]
+        self.feature_size = int(ext_features_dim[0])
+        self.num_attention_locs = int(ext_features_dim[1] * ext_features_dim[2])
 
         self.hidden_size = p.hidden_size
         # Next 2 functions transform mean feature vector into c_0 and h_0
@@ -634,7 +1348,13 @@ class SpatialAttentionDecoderRNN(nn.Module):
         self.lstm_step = nn.LSTMCell(p.embed_size, p.hidden_size)
         self.attention = SpatialAttention(self.feature_size, self.num_attention_locs,
                                           p.hidden_size)
-        self.linear = nn.Linear(p.hidden_size + self.feature_size, vocab_size)
+        self.linear = output_layer(p, p.hidden_size + self.feature_size, vocab_size)
+
+    def _spatial_features(self, images, external_features, image_ids=None):
+        """The spatial features as (batch_size, num_attention_locs, feature_size)"""
+        if len(self.extractors) > 0:
+            external_features = self.extractors[0](images, image_ids).reshape(images.size(0), -1)
+        return external_features.view(external_features.size(0), -1, self.feature_size)
 
     def init_hidden_state(self, features):
         """Initialize the initial hidden and cell state of the LSTM"""
@@ -645,21 +1365,24 @@ class SpatialAttentionDecoderRNN(nn.Module):
         return h, c
 
     def forward(self, encoder_features, captions, lengths, images, external_features=None,
-                teacher_p=1.0, teacher_forcing='always'):
-        """Decode image feature vectors and generates captions."""
+                teacher_p=1.0, teacher_forcing='always', image_ids=None, hiddens_only=False):
+        """Decode image feature vectors and generates captions.  With
+        hiddens_only=True the packed inputs of the output layer are returned
+        instead of the word scores, see hiddens_loss()."""
         embeddings = self.embed(captions)
         embeddings = torch.cat([encoder_features.unsqueeze(1), embeddings], 1)
         seq_length = embeddings.size()[1]
         batch_size = embeddings.size()[0]
 
-        features = external_features.view(batch_size, -1, self.feature_size)
+        features = self._spatial_features(images, external_features, image_ids)
 
         # h, c = self.init_hidden_state(features)
 
         h = torch.zeros(batch_size, self.hidden_size).to(device)
         c = torch.zeros(batch_size, self.hidden_size).to(device)
 
-        outputs = torch.zeros(batch_size, seq_length, self.vocab_size).to(device)
+        output_size = self.linear.in_features if hiddens_only else self.vocab_size
+        outputs = torch.zeros(batch_size, seq_length, output_size).to(device)
         # Insert the <start> token into outputs tensors at the first location of each sequence:
         index = captions[:, 0].unsqueeze(1)
         # Create one-hot encoding of the <start> token:
@@ -667,13 +1390,18 @@ class SpatialAttentionDecoderRNN(nn.Module):
 
         alphas = torch.zeros(batch_size, seq_length, self.num_attention_locs).to(device)
 
+        att_img = self.attention.project(features)
+
         for t in range(seq_length - 1):
             batch_size_t = sum([l > t for l in lengths])
             h, c = self.lstm_step(embeddings[:batch_size_t, t],
                                   (h[:batch_size_t], c[:batch_size_t]))
-            att_context, alpha = self.attention(features[:batch_size_t], h[:batch_size_t])
+            att_context, alpha = self.attention(features[:batch_size_t], h[:batch_size_t],
+                                                att_img[:batch_size_t])
 
-            outputs_t = self.linear(torch.cat([self.dropout(h), att_context], dim=1))
+            outputs_t = torch.cat([self.dropout(h), att_context], dim=1)
+            if not hiddens_only:
+                outputs_t = self.linear(outputs_t)
             outputs[:batch_size_t, t] = outputs_t
 
             alphas[:batch_size_t, t] = alpha
@@ -682,34 +1410,39 @@ class SpatialAttentionDecoderRNN(nn.Module):
 
         return outputs, alphas
 
-    def sample(self, features, images, external_features, states=None, max_seq_length=20):
-        """Generate captions for given image features using greedy search."""
-        sampled_ids = []
-        batch_size = len(images)
-        alphas = torch.zeros(batch_size, max_seq_length, self.num_attention_locs).to(device)
-
-        features = external_features.view(batch_size, -1, self.feature_size)
-
-        h, c = self.init_hidden_state(features)
-
-        # inputs: (batch_size, 1, embed_size + len(external features))
-        inputs = features.unsqueeze(1)
-
-        for t in range(max_seq_length):
-            h, c = self.lstm_step(inputs, (h, c))
-            att_context, alpha = self.attention(features, h)
-            alphas[:, t] = alpha
-            outputs = self.linear(torch.cat([h, att_context], dim=1))
-            _, predicted = outputs.max(1)
-            sampled_ids.append(predicted)
-
-            # inputs: (batch_size, 1, embed_size + len(external_features))
-            embeddings = self.embed(predicted)
-            inputs = embeddings.unsqueeze(1)
-
-        # sampled_ids: (batch_size, max_seq_length)
-        sampled_ids = torch.stack(sampled_ids, 1)
-        return sampled_ids, alphas
+    def hiddens_loss(self, hiddens, targets, chunk_size):
+        """Cross-entropy loss of the hidden states returned by forward() with
+        hiddens_only=True, see chunked_cross_entropy()"""
+        return chunked_cross_entropy(self.linear, hiddens, targets, chunk_size) / targets.size(0)
+
+    def init_decoding(self, features, images, external_features, states=None,
+                      start_id=None, image_ids=None):
+        """Initial inputs, states and per-image context for beam_search().  Like
+        in training, the encoder output is the first input and the initial
+        states are zero."""
+        att_features = self._spatial_features(images, external_features, image_ids)
+        batch_size = att_features.size(0)
+        if states is None:
+            h = features.new_zeros(batch_size, self.hidden_size)
+            states = (h, torch.zeros_like(h))
+        return (features, states,
+                (att_features, self.attention.project(att_features)), None)
+
+    def decode_step(self, inputs, states, context):
+        att_features, att_img = context
+        h, c = self.lstm_step(inputs, states)
+        att_context, alpha = self.attention(att_features, h, att_img)
+        return torch.cat([h, att_context], dim=1), (h, c), alpha
+
+    def select_states(self, states, index):
+        return select_rows(states, index)
+
+    def sample(self, features, images, external_features, states=None, max_seq_length=20,
+               beam_size=1, start_id=None, end_id=None, image_ids=None):
+        """Generate captions for given image features using beam search, greedy
+        search by default, see beam_search()."""
+        return beam_search(self, features, images, external_features, max_seq_length,
+                           beam_size, start_id, end_id, states, image_ids)
 
 
 class SpatialAttentionEncoderDecoder(nn.Module):
@@ -717,8 +1450,12 @@ class SpatialAttentionEncoderDecoder(nn.Module):
         super(SpatialAttentionEncoderDecoder, self).__init__()
         print('Using device: {}'.format(device.type))
         print('Initializing SpatialAttentionEncoderDecoder model...')
-        self.encoder = EncoderCNN(params, ef_dims[0]).to(device)
-        self.decoder = SpatialAttentionDecoderRNN(params, vocab_size, ef_dims[1]).to(device)
+        # The spatial features may come from the same trunk as the encoder
+        # features, e.g. resnet152 and resnet152-conv, computed in one pass
+        extractors = SharedExtractors()
+        self.encoder = EncoderCNN(params, ef_dims[0], extractors).to(device)
+        self.decoder = SpatialAttentionDecoderRNN(params, vocab_size, ef_dims[1],
+                                                     extractors).to(device)
 
         self.opt_params = (list(self.decoder.parameters()) +
                            list(self.encoder.linear.parameters()) +
@@ -732,18 +1469,21 @@ class SpatialAttentionEncoderDecoder(nn.Module):
         return self.opt_params
 
     def forward(self, images, init_features, captions, lengths, persist_features,
-                teacher_p=1.0, teacher_forcing='always'):
-        features = self.encoder(images, init_features)
+                teacher_p=1.0, teacher_forcing='always', image_ids=None, hiddens_only=False):
+        features = self.encoder(images, init_features, image_ids)
         outputs, alphas = self.decoder(features, captions, lengths, images, persist_features,
-                                       teacher_p, teacher_forcing)
+                                       teacher_p, teacher_forcing, image_ids,
+                                       hiddens_only=hiddens_only)
         return outputs, alphas
 
     def sample(self, image_tensor, init_features, persist_features, states=None,
-               max_seq_length=20):
-        features = self.encoder(image_tensor, init_features)
-        sampled_ids = self.decoder.sample(features, image_tensor, 
+               max_seq_length=20, beam_size=1, start_id=None, end_id=None, image_ids=None):
+        features = self.encoder(image_tensor, init_features, image_ids)
+        sampled_ids = self.decoder.sample(features, image_tensor,
                                           external_features=persist_features,
-                                          states=states, max_seq_length=max_seq_length)
+                                          states=states, max_seq_length=max_seq_length,
+                                          beam_size=beam_size, start_id=start_id,
+                                          end_id=end_id, image_ids=image_ids)
 
         return sampled_ids
 
@@ -754,8 +1494,11 @@ class EncoderDecoder(nn.Module):
         super(EncoderDecoder, self).__init__()
         print('Using device: {}'.format(device.type))
         print('Initializing EncoderDecoder model...')
-        self.encoder = EncoderCNN(params, ef_dims[0]).to(device)
-        self.decoder = DecoderRNN(params, vocab_size, ef_dims[1]).to(device)
+        # Backbones used for both features and persist_features are loaded
+        # once and run once per batch
+        extractors = SharedExtractors()
+        self.encoder = EncoderCNN(params, ef_dims[0], extractors).to(device)
+        self.decoder = DecoderRNN(params, vocab_size, ef_dims[1], extractors).to(device)
 
         self.opt_params = (list(self.decoder.parameters()) +
                            list(self.encoder.linear.parameters()) +
@@ -769,16 +1512,280 @@ class EncoderDecoder(nn.Module):
         return self.opt_params
 
     def forward(self, images, init_features, captions, lengths, persist_features,
-                teacher_p=1.0, teacher_forcing='always'):
-        features = self.encoder(images, init_features)
+                teacher_p=1.0, teacher_forcing='always', image_ids=None, hiddens_only=False):
+        features = self.encoder(images, init_features, image_ids)
         outputs = self.decoder(features, captions, lengths, images, persist_features,
-                               teacher_p, teacher_forcing)
+                               teacher_p, teacher_forcing, image_ids, hiddens_only)
         return outputs
 
     def sample(self, image_tensor, init_features, persist_features, states=None,
-               max_seq_length=20):
-        feature = self.encoder(image_tensor, init_features)
+               max_seq_length=20, beam_size=1, start_id=None, end_id=None, image_ids=None):
+        """Generate captions using beam search, or greedy search if beam_size is
+        1.  Decoding stops when all captions have produced end_id."""
+        feature = self.encoder(image_tensor, init_features, image_ids)
         sampled_ids = self.decoder.sample(feature, image_tensor, persist_features, states,
-                                          max_seq_length=max_seq_length)
+                                          max_seq_length=max_seq_length,
+                                          beam_size=beam_size, start_id=start_id,
+                                          end_id=end_id, image_ids=image_ids)
 
         return sampled_ids
+
+
+def quantize_dynamic(model, inplace=False):
+    """Converts the linear layer of the encoder of model, and the nn.Linear,
+    nn.LSTM and nn.LSTMCell layers of its decoder to int8 layers with dynamic
+    quantization, for faster inference on CPU.  The CNNs of the internal
+    features are left as they are.  The LSTM of a DecoderRNN with persist
+    features is first split into nn.Linear layers, see UnfusedLSTM."""
+    if not inplace:
+        model = copy.deepcopy(model)
+    if isinstance(model.decoder, DecoderRNN):
+        model.decoder.unfuse_lstm()
+    layers = set()
+    for name, module in model.named_modules():
+        if not isinstance(module, (nn.Linear, nn.LSTM, nn.LSTMCell)):
+            continue
+        if name == 'encoder.linear' or (name.startswith('decoder.') and
+                                        '.extractors.' not in name):
+            layers.add(name)
+    return torch.ao.quantization.quantize_dynamic(model, layers, dtype=torch.qint8,
+                                                  inplace=True)
+
+
+class ScriptableTrunk(nn.Module):
+    """Runs the modules of a CNN trunk once and returns the outputs of the
+    modules at indices, flattened where flatten is True, as a list.  Used by
+    ScriptableEncoderDecoder in place of Backbone.forward_taps(), which cannot
+    be compiled by TorchScript."""
+
+    indices: List[int]
+    flatten: List[bool]
+
+    def __init__(self, modules, indices, flatten):
+        super(ScriptableTrunk, self).__init__()
+        self.layers = nn.ModuleList(modules[:max(indices) + 1])
+        self.indices = indices
+        self.flatten = flatten
+
+    def forward(self, images: torch.Tensor) -> List[torch.Tensor]:
+        found: Dict[int, torch.Tensor] = {}
+        x = images
+        i = 0
+        for layer in self.layers:
+            x = layer(x)
+            if i in self.indices:
+                found[i] = x
+            i += 1
+
+        outputs: List[torch.Tensor] = []
+        for index, flatten in zip(self.indices, self.flatten):
+            x = found[index]
+            if flatten:
+                x = x.reshape(x.size(0), -1)
+            outputs.append(x)
+        return outputs
+
+
+class ScriptableAdaptiveSoftmax(nn.Module):
+    """The log probabilities of all words given by a trained AdaptiveSoftmax,
+    computed like nn.AdaptiveLogSoftmaxWithLoss.log_prob(), which cannot be
+    compiled by TorchScript"""
+
+    def __init__(self, layer):
+        super(ScriptableAdaptiveSoftmax, self).__init__()
+        self.head = layer.asm.head
+        self.tail = layer.asm.tail
+        self.shortlist_size = layer.asm.shortlist_size
+        self.register_buffer('ranks', layer.ranks)
+
+    def forward(self, hiddens: torch.Tensor) -> torch.Tensor:
+        head_log_probs = F.log_softmax(self.head(hiddens), 1)
+        log_probs = [head_log_probs[:, :self.shortlist_size]]
+        i = self.shortlist_size
+        for cluster in self.tail:
+            log_probs.append(F.log_softmax(cluster(hiddens), 1) +
+                             head_log_probs[:, i].unsqueeze(1))
+            i += 1
+        return torch.cat(log_probs, 1).index_select(1, self.ranks)
+
+
+def scriptable_output_layer(layer):
+    if isinstance(layer, AdaptiveSoftmax):
+        return ScriptableAdaptiveSoftmax(layer)
+    return layer
+
+
+class ScriptableDecoderRNN(nn.Module):
+    """Greedy decoding steps of a trained DecoderRNN, sharing its layers.  The
+    states of all LSTM layers are kept as (num_layers, batch_size, hidden_size)
+    tensors, as for nn.LSTM."""
+
+    def __init__(self, decoder):
+        super(ScriptableDecoderRNN, self).__init__()
+        self.embed = decoder.embed
+        self.linear = scriptable_output_layer(decoder.linear)
+        self.lstm = decoder.lstm
+        self.num_layers = decoder.num_layers
+        self.hidden_size = decoder.lstm.hidden_size
+        self.embed_size = decoder.embed_size
+        self.persist_size = decoder.persist_size
+        # With persist features the layers are run one by one as in
+        # DecoderRNN._step(), by cells sharing the weights of decoder.lstm
+        self.cells = nn.ModuleList()
+        if decoder.persist_size:
+            for layer in range(decoder.num_layers):
+                cell = nn.LSTMCell(1, self.hidden_size)
+                for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'):
+                    setattr(cell, name, getattr(decoder.lstm, '{}_l{}'.format(name, layer)))
+                self.cells.append(cell)
+
+    def init_decoding(self, features: torch.Tensor, persist: List[torch.Tensor]
+                      ) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        h = features.new_zeros(self.num_layers, features.size(0), self.hidden_size)
+        context: List[torch.Tensor] = []
+        if self.persist_size > 0:
+            # Same as DecoderRNN._persist_gates()
+            context.append(F.linear(torch.cat(persist, 1),
+                                    self.lstm.weight_ih_l0[:, self.embed_size:]))
+        return h, torch.zeros_like(h), context
+
+    def decode_step(self, inputs: torch.Tensor, h: torch.Tensor, c: torch.Tensor,
+                    context: List[torch.Tensor]
+                    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns the word scores and the new states, see DecoderRNN._step()"""
+        if self.persist_size == 0:
+            hiddens, (h, c) = self.lstm(inputs.unsqueeze(1), (h, c))
+            return self.linear(hiddens.squeeze(1)), h, c
+
+        new_h: List[torch.Tensor] = []
+        new_c: List[torch.Tensor] = []
+        x = inputs
+        layer = 0
+        for cell in self.cells:
+            if layer == 0:
+                gates_x = F.linear(x, cell.weight_ih[:, :self.embed_size],
+                                   cell.bias_ih) + context[0]
+            else:
+                gates_x = F.linear(x, cell.weight_ih, cell.bias_ih)
+            gates = gates_x + F.linear(h[layer], cell.weight_hh, cell.bias_hh)
+            i, f, g, o = gates.chunk(4, 1)
+            c_layer = torch.sigmoid(f) * c[layer] + torch.sigmoid(i) * torch.tanh(g)
+            x = torch.sigmoid(o) * torch.tanh(c_layer)
+            new_h.append(x)
+            new_c.append(c_layer)
+            layer += 1
+        return self.linear(x), torch.stack(new_h), torch.stack(new_c)
+
+
+class ScriptableSpatialAttentionDecoderRNN(nn.Module):
+    """Greedy decoding steps of a trained SpatialAttentionDecoderRNN, sharing
+    its layers"""
+
+    def __init__(self, decoder):
+        super(ScriptableSpatialAttentionDecoderRNN, self).__init__()
+        self.embed = decoder.embed
+        self.linear = scriptable_output_layer(decoder.linear)
+        self.lstm_step = decoder.lstm_step
+        self.attention = decoder.attention
+        self.feature_size = decoder.feature_size
+        self.hidden_size = decoder.hidden_size
+
+    def init_decoding(self, features: torch.Tensor, persist: List[torch.Tensor]
+                      ) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        # Same layout as SpatialAttentionDecoderRNN._spatial_features()
+        att_features = persist[0].reshape(features.size(0), -1, self.feature_size)
+        h = features.new_zeros(features.size(0), self.hidden_size)
+        return h, torch.zeros_like(h), [att_features, self.attention.project(att_features)]
+
+    def decode_step(self, inputs: torch.Tensor, h: torch.Tensor, c: torch.Tensor,
+                    context: List[torch.Tensor]
+                    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        h, c = self.lstm_step(inputs, (h, c))
+        att_context, _ = self.attention(context[0], h, context[1])
+        return self.linear(torch.cat([h, att_context], dim=1)), h, c
+
+
+class ScriptableEncoderDecoder(nn.Module):
+    """Greedy captioning of a trained EncoderDecoder or
+    SpatialAttentionEncoderDecoder as a single module that can be compiled
+    with torch.jit.script(), see export_model.py.  It shares the layers of the
+    model, and computes the internal features of each CNN trunk in one pass.
+    forward() gives the same captions as model.sample() with beam_size=1:
+    the word ids (batch_size, length) padded with end_id, decoding stopping
+    when all captions have ended.  A negative end_id decodes max_seq_length
+    words."""
+
+    encoder_features: List[int]
+    decoder_features: List[int]
+
+    def __init__(self, model):
+        super(ScriptableEncoderDecoder, self).__init__()
+        encoder, decoder = model.encoder, model.decoder
+        if isinstance(decoder, DecoderRNN):
+            self.decoder = ScriptableDecoderRNN(decoder)
+        elif isinstance(decoder, SpatialAttentionDecoderRNN):
+            self.decoder = ScriptableSpatialAttentionDecoderRNN(decoder)
+        else:
+            raise ValueError('Cannot script a model with {}'.format(type(decoder).__name__))
+
+        # Group the internal features by the trunk computing them.  The trunk
+        # outputs are concatenated into one list, indexed by encoder_features
+        # and decoder_features.
+        trunks = OrderedDict()
+        for extractor in list(encoder.extractors) + list(decoder.extractors):
+            key = id(extractor.extractor)
+            if key not in trunks:
+                trunks[key] = (extractor.extractor, [])
+            if extractor not in trunks[key][1]:
+                trunks[key][1].append(extractor)
+
+        self.trunks = nn.ModuleList()
+        positions = {}
+        for trunk, extractors in trunks.values():
+            if extractors[0].tap is None:
+                modules, indices = [trunk], [0] * len(extractors)
+            else:
+                modules = list(trunk)
+                indices = [trunk.tap_indices[e.tap] for e in extractors]
+            for e in extractors:
+                positions[e] = len(positions)
+            self.trunks.append(ScriptableTrunk(modules, indices,
+                                               [e.flatten for e in extractors]))
+        self.encoder_features = [positions[e] for e in encoder.extractors]
+        self.decoder_features = [positions[e] for e in decoder.extractors]
+
+        # Dropout is left out, as the module is only used for inference
+        self.encoder_linear = encoder.linear
+        self.encoder_bn = encoder.bn
+
+    def forward(self, images: torch.Tensor, init_features: Optional[torch.Tensor],
+                persist_features: Optional[torch.Tensor], max_seq_length: int = 20,
+                end_id: int = -1) -> torch.Tensor:
+        internal: List[torch.Tensor] = []
+        for trunk in self.trunks:
+            internal += trunk(images)
+
+        encoder_inputs = [internal[i] for i in self.encoder_features]
+        if init_features is not None:
+            encoder_inputs.append(init_features)
+        features = self.encoder_bn(self.encoder_linear(torch.cat(encoder_inputs, 1)))
+
+        persist = [internal[i] for i in self.decoder_features]
+        if persist_features is not None:
+            persist.append(persist_features)
+
+        h, c, context = self.decoder.init_decoding(features, persist)
+        inputs = features
+        done = torch.zeros(features.size(0), dtype=torch.bool, device=features.device)
+        sampled: List[torch.Tensor] = []
+        for t in range(max_seq_length):
+            scores, h, c = self.decoder.decode_step(inputs, h, c, context)
+            words = scores.argmax(1)
+            if end_id >= 0:
+                words = words.masked_fill(done, end_id)
+                done = done | (words == end_id)
+            sampled.append(words)
+            if bool(done.all()):
+                break
+            inputs = self.decoder.embed(words)
+        return torch.stack(sampled, 1)
@@ -12,6 +12,7 @@ class picsom_bin_data:
   def __init__(self, path) :
     #print('<'+path+'>')
     self._path = path
+    self._mmap = None
     
     if path=='' :
       self._fp       = open('/dev/null')
@@ -40,6 +41,19 @@ class picsom_bin_data:
     self._fp.close()
     pass
 
+  def __getstate__(self) :
+    # Neither the file handle nor the mapping are pickled, a DataLoader
+    # worker started with "spawn" reopens them itself.  Forked workers
+    # inherit the parent's mapping and share its page cache.
+    state = self.__dict__.copy()
+    del state['_fp']
+    state['_mmap'] = None
+    return state
+
+  def __setstate__(self, state) :
+    self.__dict__.update(state)
+    self._fp = open(self._path if self._path!='' else '/dev/null', 'rb')
+
   def path(self) :
     return self._path
 
@@ -80,18 +94,36 @@ class picsom_bin_data:
   
   def get_float_list(self, iL) :
     if iL == -1 :
-          iL = xrange(self._nobjects)
-          vec = np.fromfile(self._fp, dtype = np.float32, count=self._nobjects*self._vdim )
-          vec = vec.reshape(self._nobjects,self._vdim)
-          print(vec.shape)
-    else:
-        
-      vec = [[]]*len(iL)
-      for idx, i in enumerate(iL):
-        if (i<0 or i>=self._nobjects) :
-          raise Exception('Index %i exceeds size of "%s"' % (i, self._path))
-        self._fp.seek(self._hsize+i*self._rlength)
-        vec[idx] = list(unpack('%if' % self._vdim, self._fp.read(self._rlength)))
+      return self.memmap()
+    return self.get_float_rows(iL)
+
+  def memmap(self) :
+    """Returns the whole file past the header as a (nobjects, vdim) float32
+    array.  The mapping is created on first use and opened copy-on-write so
+    that torch.from_numpy() accepts its views without complaining, nothing
+    is ever written back to the file."""
+    if self._mmap is None :
+      if self._format!=1 or self._rlength!=4*self._vdim :
+        raise Exception('Cannot memory-map non-float data in "%s"' % self._path)
+      self._mmap = np.memmap(self._path, dtype=np.float32, mode='c',
+                             offset=self._hsize, shape=(self._nobjects, self._vdim))
+    return self._mmap
+
+  def get_float_view(self, i) :
+    """Zero-copy counterpart of get_float(), returns a (vdim,) view."""
+    if (i<0 or i>=self._nobjects) :
+      raise Exception('Index %i exceeds size of "%s"' % (i, self._path))
+    return self.memmap()[i]
+
+  def get_float_rows(self, iL) :
+    """Returns a (len(iL), vdim) array of the given objects.  The rows are
+    read in file order so that the page cache sees sequential access."""
+    iL = np.asarray(iL, dtype=np.int64)
+    if len(iL) and (iL.min()<0 or iL.max()>=self._nobjects) :
+      raise Exception('Index exceeds size of "%s"' % self._path)
+    order = np.argsort(iL, kind='stable')
+    vec = np.empty((len(iL), self._vdim), dtype=np.float32)
+    vec[order] = self.memmap()[iL[order]]
     return vec
 
   def str(self) :
@@ -3,10 +3,10 @@
 import argparse
 import os
 import cv2
-import shutil
 import pymp
 import multiprocessing
 import glob
+import zipfile
 
 from feature_extractor import image_types
 
@@ -79,9 +79,13 @@ def resize_images(image_dir, output_dir, create_zip, size):
 
     if create_zip:
         print("Creating a zip file: {}".format(output_dir + '.zip'))
-        # Note that shutil.make_archive has issues with Python versions prior 3.5
-        shutil.make_archive(output_dir, 'zip', os.path.dirname(output_dir),
-                            os.path.basename(output_dir))
+        # The images are stored without compression, which would gain next to
+        # nothing for JPEGs, so that training can read them straight from
+        # the archive
+        with zipfile.ZipFile(output_dir + '.zip', 'w', zipfile.ZIP_STORED) as zf:
+            for filename in sorted(os.listdir(output_dir)):
+                zf.write(os.path.join(output_dir, filename),
+                         os.path.join(os.path.basename(output_dir), filename))
 
 
 def main(args):
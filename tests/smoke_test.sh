@@ -101,6 +101,17 @@ python3 $INFER_PY --model $MODEL --dataset coco:val2014 --num_workers 4 \
 append_command_to_log
 # Expected result: reasonable looking results in results/__test_coco_full_ep11.json
 
+EXPORT_PY=$(dirname $INFER_PY)/export_model.py
+python3 $EXPORT_PY --model $MODEL --output models/__test/coco_full/ep11.pt \
+                   --dataset coco:val2014 --check_batches 2
+append_command_to_log
+# Expected result: "Parity check: 0 of 256 captions differ from the eager model."
+
+python3 $INFER_PY --model models/__test/coco_full/ep11.pt --dataset coco:val2014 \
+                  --num_workers 4 --output_format json --output_file coco_full-ep11-scripted.json
+append_command_to_log
+# Expected result: same captions as in results/__test/coco_full-ep11.json
+
 RESULTS=results/__test/coco_full-ep11.json
 GROUND_TRUTH=/m/cs/scratch/imagedb/picsom/databases/COCO/download/annotations/captions_val2014.json
 python2 $EVAL_COCO_PY $RESULTS --ground_truth $GROUND_TRUTH
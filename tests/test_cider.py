@@ -0,0 +1,210 @@
+"""Checks that all the ways of computing CIDEr give exactly the scores of the
+original implementation, which builds the tf-idf vector of each sentence as a
+dict of n-grams."""
+
+import random
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from eval.cider import Cider
+from eval.cider_scorer import (CiderReferences, DocumentFrequency, ShardedCiderScorer,
+                               cook_refs, cook_test)
+
+
+def loop_document_frequency(refs):
+    """Number of images with each n-gram in their references"""
+    document_frequency = defaultdict(float)
+    for image_refs in refs:
+        for ngram in set(ngram for ref in cook_refs(image_refs) for ngram in ref):
+            document_frequency[ngram] += 1
+    return document_frequency
+
+
+def loop_cider(test, refs, document_frequency=None, ref_len=None, n=4):
+    """CIDEr scores of the hypotheses test, one per image, and the lists of
+    references refs, with the document frequencies of refs unless others are
+    given"""
+    if document_frequency is None:
+        document_frequency = loop_document_frequency(refs)
+        ref_len = np.log(float(len(refs)))
+
+    def counts2vec(cnts):
+        vec = [defaultdict(float) for _ in range(n)]
+        length = 0
+        norm = [0.0 for _ in range(n)]
+        for (ngram, term_freq) in cnts.items():
+            # give word count 1 if it doesn't appear in reference corpus
+            df = np.log(max(1.0, document_frequency.get(ngram, 0.0)))
+            k = len(ngram) - 1
+            vec[k][ngram] = float(term_freq) * (ref_len - df)
+            norm[k] += pow(vec[k][ngram], 2)
+            if k == 1:
+                length += term_freq
+        norm = [np.sqrt(x) for x in norm]
+        return vec, norm, length
+
+    def sim(vec_hyp, vec_ref, norm_hyp, norm_ref):
+        val = np.array([0.0 for _ in range(n)])
+        for k in range(n):
+            for (ngram, count) in vec_hyp[k].items():
+                val[k] += vec_hyp[k][ngram] * vec_ref[k][ngram]
+            if (norm_hyp[k] != 0) and (norm_ref[k] != 0):
+                val[k] /= (norm_hyp[k] * norm_ref[k])
+        return val
+
+    scores = []
+    for hypo, image_refs in zip(test, refs):
+        vec, norm, _ = counts2vec(cook_test(hypo))
+        score = np.array([0.0 for _ in range(n)])
+        for ref in cook_refs(image_refs):
+            vec_ref, norm_ref, _ = counts2vec(ref)
+            score += sim(vec, vec_ref, norm, norm_ref)
+        scores.append(np.mean(score) / len(image_refs) * 10.0)
+    return np.array(scores)
+
+
+def random_sentence(rng, words):
+    return ' '.join(rng.choice(words[:rng.randint(3, len(words))])
+                    for _ in range(rng.randint(1, 12)))
+
+
+def random_dataset(seed, num_images, vocab_size=40):
+    rng = random.Random(seed)
+    words = ['w{}'.format(i) for i in range(vocab_size)]
+    gts = {'img{}'.format(i): [random_sentence(rng, words) for _ in range(rng.randint(1, 5))]
+           for i in range(num_images)}
+    res = {image_id: [random_sentence(rng, words)] for image_id in gts}
+    return gts, res
+
+
+@pytest.fixture
+def dataset():
+    return random_dataset(0, 60)
+
+
+@pytest.fixture
+def df_table(tmp_path):
+    """A DocumentFrequency table of another set of references saved under
+    tmp_path, and the equivalent dict with its ref_len"""
+    df_gts, _ = random_dataset(1, 80)
+    refs = list(df_gts.values())
+    path = str(tmp_path / 'test-df')
+    DocumentFrequency.build(CiderReferences.build(refs)).save(path)
+    return path, loop_document_frequency(refs), np.log(float(len(refs)))
+
+
+def lists(gts, res):
+    return [res[image_id][0] for image_id in gts], list(gts.values())
+
+
+def test_corpus(dataset):
+    gts, res = dataset
+    score, scores = Cider().compute_score(gts, res)
+    expected = loop_cider(*lists(gts, res))
+    assert list(scores) == list(expected)
+    assert score == np.mean(expected)
+
+
+def test_document_frequency(dataset, df_table):
+    gts, res = dataset
+    path, document_frequency, ref_len = df_table
+    _, scores = Cider(df=path).compute_score(gts, res)
+    assert list(scores) == list(loop_cider(*lists(gts, res), document_frequency, ref_len))
+
+
+def test_references(dataset, df_table):
+    gts, res = dataset
+    path, document_frequency, ref_len = df_table
+    test, refs = lists(gts, res)
+
+    cider = Cider()
+    _, scores = cider.compute_score(cider.references(gts), res)
+    assert list(scores) == list(loop_cider(test, refs))
+
+    cider = Cider(df=path)
+    _, scores = cider.compute_score(cider.references(gts), res)
+    assert list(scores) == list(loop_cider(test, refs, document_frequency, ref_len))
+
+    # A subset of the images, in another order, with the document
+    # frequencies of that subset in the "corpus" mode
+    subset = list(gts)[::-3]
+    cider = Cider()
+    _, scores = cider.compute_score(cider.references(gts),
+                                    {image_id: res[image_id] for image_id in subset})
+    assert list(scores) == list(loop_cider([res[i][0] for i in subset],
+                                           [gts[i] for i in subset]))
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 60])
+def test_accumulator(dataset, df_table, batch_size):
+    gts, res = dataset
+    path, document_frequency, ref_len = df_table
+    test, refs = lists(gts, res)
+
+    for cider, expected in ((Cider(), loop_cider(test, refs)),
+                            (Cider(df=path), loop_cider(test, refs, document_frequency,
+                                                        ref_len))):
+        accumulator = cider.accumulator()
+        for i in range(0, len(test), batch_size):
+            accumulator.add(test[i:i + batch_size], refs[i:i + batch_size],
+                            list(gts)[i:i + batch_size])
+        _, scores = accumulator.finish()
+        assert list(scores) == list(expected)
+        assert accumulator.image_ids == list(gts)
+
+
+def test_sharded(dataset, df_table):
+    gts, res = dataset
+    path, document_frequency, ref_len = df_table
+    test, refs = lists(gts, res)
+    sharded = ShardedCiderScorer(num_workers=3)
+
+    assert list(sharded.compute_cider(test, refs)) == list(loop_cider(test, refs))
+    table = DocumentFrequency.load(path)
+    assert (list(sharded.compute_cider(test, refs, path, document_frequency=table)) ==
+            list(loop_cider(test, refs, document_frequency, ref_len)))
+
+    images = list(range(len(test)))[::-2]
+    scores = sharded.compute_cider_references(CiderReferences.build(refs),
+                                              [test[i] for i in images], images)
+    assert list(scores) == list(loop_cider([test[i] for i in images],
+                                           [refs[i] for i in images]))
+
+
+def test_sharded_compute_score(dataset, monkeypatch):
+    gts, res = dataset
+    monkeypatch.setattr(Cider, 'parallel_threshold', 1)
+    cider = Cider(num_workers=2)
+    expected = list(loop_cider(*lists(gts, res)))
+    assert list(cider.compute_score(gts, res)[1]) == expected
+    assert list(cider.compute_score(cider.references(gts), res)[1]) == expected
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 500])
+def test_accumulator_repeated_ids(dataset, df_table, batch_size):
+    # Datasets such as MSR-VTT have a row per reference caption, in which the
+    # image ids repeat in any order, see infer.py
+    gts, _ = dataset
+    path, _, _ = df_table
+    rng = random.Random(2)
+    words = ['w{}'.format(i) for i in range(40)]
+    rows = [(image_id, random_sentence(rng, words), [ref])
+            for image_id, refs in gts.items() for ref in refs]
+    rng.shuffle(rows)
+
+    # gts and res built row by row, as infer.py does without the accumulator
+    row_gts, row_res = {}, {}
+    for image_id, caption, refs in rows:
+        row_gts.setdefault(image_id, []).extend(refs)
+        row_res[image_id] = [caption]
+
+    for cider in (Cider(), Cider(df=path)):
+        accumulator = cider.accumulator()
+        for i in range(0, len(rows), batch_size):
+            image_ids, captions, refs = zip(*rows[i:i + batch_size])
+            accumulator.add(captions, refs, image_ids)
+        _, scores = accumulator.finish()
+        assert accumulator.image_ids == list(row_gts)
+        assert list(scores) == list(cider.compute_score(row_gts, row_res)[1])
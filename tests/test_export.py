@@ -0,0 +1,55 @@
+"""Checks that the models compiled by ScriptableEncoderDecoder, as in
+export_model.py, give the same captions as their sample() method."""
+
+import pytest
+import torch
+
+from model import (EncoderDecoder, SpatialAttentionEncoderDecoder, ModelParams,
+                   ScriptableEncoderDecoder)
+
+VOCAB_SIZE = 30
+START_ID = 1
+END_ID = 2
+BATCH_SIZE = 6
+
+
+def check_parity(model_class, params, ef_dims, persist_size):
+    torch.manual_seed(1)
+    model = model_class(ModelParams(params), torch.device('cpu'), VOCAB_SIZE, None,
+                        ef_dims).eval()
+    scripted = torch.jit.script(ScriptableEncoderDecoder(model).eval())
+
+    # The images are not used, all features being external
+    images = torch.zeros(BATCH_SIZE, 3, 8, 8)
+    init_features = torch.randn(BATCH_SIZE, ef_dims[0])
+    persist_features = torch.randn(BATCH_SIZE, persist_size) if persist_size else None
+
+    for end_id in (END_ID, -1):
+        with torch.no_grad():
+            expected = model.sample(images, init_features, persist_features,
+                                    max_seq_length=12, start_id=START_ID,
+                                    end_id=end_id if end_id >= 0 else None)
+            if isinstance(expected, tuple):
+                expected = expected[0]
+            sampled = scripted(images, init_features, persist_features, 12, end_id)
+        assert sampled.tolist() == expected.tolist()
+
+
+@pytest.mark.parametrize('num_layers', [1, 2])
+def test_encoder_decoder(num_layers):
+    params = {'features': 'init.lmdb', 'embed_size': 16, 'hidden_size': 24,
+              'num_layers': num_layers}
+    check_parity(EncoderDecoder, params, [10, 0], 0)
+
+
+@pytest.mark.parametrize('num_layers', [1, 2])
+def test_encoder_decoder_persist_features(num_layers):
+    params = {'features': 'init.lmdb', 'persist_features': 'persist.lmdb',
+              'embed_size': 16, 'hidden_size': 24, 'num_layers': num_layers}
+    check_parity(EncoderDecoder, params, [10, 7], 7)
+
+
+def test_spatial_attention_encoder_decoder():
+    params = {'features': 'init.lmdb', 'persist_features': 'spatial.lmdb',
+              'attention': 'spatial', 'embed_size': 16, 'hidden_size': 24}
+    check_parity(SpatialAttentionEncoderDecoder, params, [10, (8, 3, 3)], 8 * 3 * 3)
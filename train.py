@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import torch
 import torch.nn as nn
 import numpy as np
@@ -16,8 +17,9 @@ from torchvision import transforms
 
 # (Needed to handle Vocabulary pickle)
 from vocabulary import Vocabulary, get_vocab
-from data_loader import get_loader, DatasetParams
+from data_loader import get_loader, DatasetParams, shard_batch_transform, caption_word_counts
 from model import ModelParams, EncoderDecoder, SpatialAttentionEncoderDecoder, SoftAttentionEncoderDecoder
+from model import FeatureCache, set_feature_cache, ChunkedCrossEntropyLoss
 from infer import caption_ids_to_words
 
 torch.manual_seed(42)
@@ -81,6 +83,7 @@ def save_model(args, params, encoder, decoder, optimizer, epoch, vocab):
         'features': params.features,
         'persist_features': params.persist_features,
         'attention': params.attention,
+        'adaptive_softmax': params.adaptive_softmax,
         'vocab': vocab
     }
 
@@ -188,18 +191,88 @@ def clip_gradients(optimizer, grad_clip):
                 param.grad.data.clamp_(-grad_clip, grad_clip)
 
 
+def get_word_counts(vocab, dataset):
+    """Word counts for ordering the words of a new adaptive softmax layer, as
+    stored in the vocabulary by build_vocab, or counted from the training
+    captions for vocabularies without them"""
+    counts = getattr(vocab, 'metadata', {}).get('word_counts')
+    if counts is None or len(counts) != len(vocab):
+        print('Counting words in the training captions for the adaptive softmax...')
+        counts = caption_word_counts(dataset, len(vocab))
+    return counts
+
+
+def use_image_shards(dataset_params, crop_size):
+    """Returns True if all datasets read their images from image shards, in
+    which case the batches need shard_batch_transform()"""
+    shards = [bool(dp.config_dict.get('image_shard')) for dp in dataset_params]
+    if not any(shards):
+        return False
+    if not all(shards) or any(dp.dataset_class not in ('CocoDataset', 'VisualGenomeIM2PDataset')
+                              for dp in dataset_params):
+        print('ERROR: image_shard must be configured for all datasets, and is only '
+              'supported by CocoDataset and VisualGenomeIM2PDataset.')
+        sys.exit(1)
+    for dp in dataset_params:
+        dp.config_dict['shard_crop_size'] = crop_size
+    return True
+
+
+def cider_references_path(args, vocab, valid_loader, dataset_params):
+    """Path of the saved CIDEr references of the validation set in
+    args.cache_dir, keyed by the dataset, its size, the path, size and
+    modification time of its caption files and the vocabulary, None if
+    caching is disabled"""
+    if not args.cache_dir:
+        return None
+    from eval.cider_scorer import CiderReferences
+    h = hashlib.sha1('{} {} {} {}\n'.format(CiderReferences.version, args.validate,
+                                            args.no_tokenize,
+                                            len(valid_loader.dataset)).encode('utf-8'))
+    for dp in dataset_params:
+        caption_path = dp.caption_path
+        if caption_path is not None and os.path.exists(caption_path):
+            st = os.stat(caption_path)
+            caption_path = '{} {} {}'.format(os.path.abspath(caption_path), st.st_size,
+                                             st.st_mtime_ns)
+        h.update('{} {} {}\n'.format(dp.name, dp.subset, caption_path).encode('utf-8'))
+    h.update('\n'.join(vocab.get_list()).encode('utf-8'))
+    return os.path.join(args.cache_dir, 'cider-refs-{}-{}.npz'.format(args.validate,
+                                                                     h.hexdigest()[:16]))
+
+
 def do_validate(model, valid_loader, criterion, scorers, vocab, teacher_p, args, params,
-                stats, epoch):
+                stats, epoch, references=None, dataset_params=()):
+    """Validates the model, references holds the CIDEr references of the
+    validation set, which are built at the first validation and reused in
+    later calls.  dataset_params of the validation set key the saved
+    references, see cider_references_path()."""
     begin = datetime.now()
     model.eval()
 
+    if references is None:
+        references = {}
+    references_path = None
+    if 'CIDEr' in scorers and 'CIDEr' not in references:
+        references_path = cider_references_path(args, vocab, valid_loader,
+                                                dataset_params)
+        if references_path is not None and os.path.exists(references_path):
+            from eval.cider_scorer import CiderReferences
+            cider_references = CiderReferences.load(references_path)
+            if cider_references is not None:
+                references['CIDEr'] = cider_references
+    # The reference captions are only needed by scorers without references
+    collect_gts = any(score_name not in references for score_name in scorers)
+
     gts = {}
     res = {}
+    all_batches = True
 
     total_loss = 0
     num_batches = 0
+    hiddens_only = isinstance(criterion, ChunkedCrossEntropyLoss)
     for i, (images, captions, lengths, image_ids, features) in enumerate(valid_loader):
-        if len(scorers) > 0:
+        if collect_gts:
             for j in range(captions.shape[0]):
                 jid = image_ids[j]
                 if jid not in gts:
@@ -208,6 +281,8 @@ def do_validate(model, valid_loader, criterion, scorers, vocab, teacher_p, args,
 
         # Set mini-batch dataset
         images = images.to(device)
+        if args.validation_shards:
+            images = shard_batch_transform(images)
         captions = captions.to(device)
         targets = pack_padded_sequence(captions, lengths,
                                        batch_first=True)[0]
@@ -219,22 +294,30 @@ def do_validate(model, valid_loader, criterion, scorers, vocab, teacher_p, args,
         with torch.no_grad():
             if args.attention is None:
                 outputs = model(images, init_features, captions, lengths,
-                                persist_features, teacher_p, args.teacher_forcing)
+                                persist_features, teacher_p, args.teacher_forcing,
+                                image_ids, hiddens_only=hiddens_only)
             else:
                 outputs, alphas = model(images, init_features, captions,
                                         lengths, persist_features, teacher_p,
-                                        args.teacher_forcing)
+                                        args.teacher_forcing, image_ids,
+                                        hiddens_only=hiddens_only)
 
             if len(scorers) > 0:
                 # Generate a caption from the image
                 if params.attention is None:
                     sampled_ids_batch = model.sample(images, init_features,
                                                      persist_features,
-                                                     max_seq_length=20)
+                                                     max_seq_length=20,
+                                                     start_id=vocab('<start>'),
+                                                     end_id=vocab('<end>'),
+                                                     image_ids=image_ids)
                 else:
                     sampled_ids_batch, _ = model.sample(images, init_features,
                                                         persist_features,
-                                                        max_seq_length=20)
+                                                        max_seq_length=20,
+                                                        start_id=vocab('<start>'),
+                                                        end_id=vocab('<end>'),
+                                                        image_ids=image_ids)
 
         loss = criterion(outputs, targets)
 
@@ -251,14 +334,25 @@ def do_validate(model, valid_loader, criterion, scorers, vocab, teacher_p, args,
 
         # Used for testing:
         if i + 1 == args.num_batches:
+            all_batches = i + 1 == len(valid_loader)
             break
 
     model.train()
 
     end = datetime.now()
 
+    # References from only a part of the validation set are not kept
+    if collect_gts and all_batches and 'CIDEr' in scorers and 'CIDEr' not in references:
+        references['CIDEr'] = scorers['CIDEr'].references(gts)
+        if references_path is not None:
+            os.makedirs(args.cache_dir, exist_ok=True)
+            tmp = '{}.{}.tmp.npz'.format(references_path, os.getpid())
+            references['CIDEr'].save(tmp)
+            os.replace(tmp, references_path)
+            print('Saved CIDEr references to {}'.format(references_path))
+
     for score_name, scorer in scorers.items():
-        score = scorer.compute_score(gts, res)[0]
+        score = scorer.compute_score(references.get(score_name, gts), res)[0]
         print('Validation', score_name, score)
         stats['validation_' + score_name.lower()] = score
 
@@ -284,13 +378,22 @@ def main(args):
         os.makedirs(args.model_path)
 
     # Image preprocessing, normalization for the pretrained resnet
-    transform = transforms.Compose([
-        # transforms.Resize((256, 256)),
-        transforms.RandomCrop(args.crop_size),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize((0.485, 0.456, 0.406),
-                             (0.229, 0.224, 0.225))])
+    if args.feature_cache:
+        # Cached CNN features are only valid if each image is always
+        # transformed the same way:
+        transform = transforms.Compose([
+            transforms.CenterCrop(args.crop_size),
+            transforms.ToTensor(),
+            transforms.Normalize((0.485, 0.456, 0.406),
+                                 (0.229, 0.224, 0.225))])
+    else:
+        transform = transforms.Compose([
+            # transforms.Resize((256, 256)),
+            transforms.RandomCrop(args.crop_size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize((0.485, 0.456, 0.406),
+                                 (0.229, 0.224, 0.225))])
 
     scorers = {}
     if args.validation_scoring is not None:
@@ -298,7 +401,7 @@ def main(args):
             s = s.lower().strip()
             if s == 'cider':
                 from eval.cider import Cider
-                scorers['CIDEr'] = Cider()
+                scorers['CIDEr'] = Cider(df=args.cider_df, num_workers=args.cider_workers)
 
     state = None
 
@@ -325,12 +428,14 @@ def main(args):
         for i in dataset_params:
             i.config_dict['no_tokenize'] = args.no_tokenize
             i.config_dict['show_tokens'] = args.show_tokens
+            i.config_dict['cache_dir'] = args.cache_dir
 
     if args.validate is not None:
         validation_dataset_params = dataset_configs.get_params(args.validate)
         for i in validation_dataset_params:
             i.config_dict['no_tokenize'] = args.no_tokenize
             i.config_dict['show_tokens'] = args.show_tokens
+            i.config_dict['cache_dir'] = args.cache_dir
 
     params = ModelParams.fromargs(args)
     start_epoch = 0
@@ -354,6 +459,24 @@ def main(args):
                                                      start_epoch))
     print(params)
 
+    # Images read from image shards are cropped in the data loader, and
+    # flipped and normalized a batch at a time on the device.  Models with
+    # only external features don't load any images.
+    use_images = params.has_internal_features()
+    train_shards = use_images and not args.validate_only and \
+        use_image_shards(dataset_params, args.crop_size)
+    args.validation_shards = use_images and args.validate is not None and \
+        use_image_shards(validation_dataset_params, args.crop_size)
+
+    if args.feature_cache:
+        if train_shards or args.validation_shards:
+            print('ERROR: --feature_cache cannot be used with image shards, which are '
+                  'cropped randomly.')
+            sys.exit(1)
+        if not args.validate_only and len(dataset_params) > 1:
+            print('WARNING: the feature cache is keyed by image id, make sure the ids of '
+                  'the combined datasets do not overlap!')
+
     # Load the vocabulary. For pre-trained models attempt to obtain
     # saved vocabulary from the model itself:
     if args.load_model and params.vocab is not None:
@@ -380,6 +503,17 @@ def main(args):
 
     ext_feature_sets = [params.features.external, params.persist_features.external]
 
+    # The datasets skip loading the images whose CNN features are all cached
+    feature_cache = None
+    if args.feature_cache and params.has_internal_features():
+        feature_cache = FeatureCache(args.feature_cache, FeatureCache.signature_of(transform),
+                                     names=set(params.features.internal +
+                                               params.persist_features.internal),
+                                     image_shape=(3, args.crop_size, args.crop_size))
+        for dp in ([] if args.validate_only else dataset_params) + \
+                ([] if args.validate is None else validation_dataset_params):
+            dp.config_dict['feature_cache'] = feature_cache
+
     # Build data loader
     if not args.validate_only:
         print('Loading dataset: {} with {} workers'.format(args.dataset, args.num_workers))
@@ -387,15 +521,21 @@ def main(args):
                                           shuffle=True, num_workers=args.num_workers,
                                           ext_feature_sets=ext_feature_sets,
                                           skip_images=not params.has_internal_features(),
-                                          verbose=args.verbose)
+                                          verbose=args.verbose,
+                                          bucket_size=args.bucket_size,
+                                          max_tokens=args.max_tokens,
+                                          shared_features=args.shared_features)
 
+    # CIDEr references of the validation set, kept for all epochs
+    validation_references = {}
     if args.validate is not None:
         valid_loader, ef_dims = get_loader(validation_dataset_params, vocab, transform,
                                            args.batch_size, shuffle=True,
                                            num_workers=args.num_workers,
                                            ext_feature_sets=ext_feature_sets,
                                            skip_images=not params.has_internal_features(),
-                                           verbose=args.verbose)
+                                           verbose=args.verbose,
+                                           shared_features=args.shared_features)
 
     # Build the models
     if args.attention is None:
@@ -408,12 +548,23 @@ def main(args):
         print("Error: Invalid attention model specified")
         sys.exit(1)
 
+    if params.adaptive_softmax and not state:
+        params.word_counts = get_word_counts(vocab, data_loader.dataset)
+
     model = _Model(params, device, len(vocab), state, ef_dims)
 
+    if feature_cache is not None:
+        set_feature_cache(model, feature_cache)
+
     opt_params = model.get_opt_params()
 
     # Loss and optimizer
-    criterion = nn.CrossEntropyLoss()
+    if args.loss_chunk_size or params.adaptive_softmax:
+        # The models return hidden states, word scores are computed in the loss
+        criterion = ChunkedCrossEntropyLoss(model.decoder, args.loss_chunk_size)
+    else:
+        criterion = nn.CrossEntropyLoss()
+    hiddens_only = isinstance(criterion, ChunkedCrossEntropyLoss)
 
     default_lr = 0.001
     if args.optimizer == 'adam':
@@ -469,7 +620,8 @@ def main(args):
 
         epoch = start_epoch-1
         val_loss = do_validate(model, valid_loader, criterion, scorers, vocab, teacher_p, args,
-                               params, stats, epoch)
+                               params, stats, epoch, validation_references,
+                               validation_dataset_params)
         all_stats[epoch+1] = stats
         save_stats(args, params, all_stats, postfix=stats_postfix)
     else:
@@ -480,7 +632,7 @@ def main(args):
             num_batches = 0
             vocab_counts = { 'cnt':0, 'max':0, 'min':9999,
                              'sum':0, 'unk_cnt':0, 'unk_sum':0 }
-            for i, (images, captions, lengths, _, features) in enumerate(data_loader):
+            for i, (images, captions, lengths, image_ids, features) in enumerate(data_loader):
                 #print(captions.shape)
                 #print(captions)
                 if epoch==0:
@@ -500,6 +652,8 @@ def main(args):
 
                 # Set mini-batch dataset
                 images = images.to(device)
+                if train_shards:
+                    images = shard_batch_transform(images)
                 captions = captions.to(device)
                 targets = pack_padded_sequence(captions, lengths,
                                                batch_first=True)[0]
@@ -522,10 +676,12 @@ def main(args):
 
                 if args.attention is None:
                     outputs = model(images, init_features, captions, lengths, persist_features,
-                                    teacher_p, args.teacher_forcing)
+                                    teacher_p, args.teacher_forcing, image_ids,
+                                    hiddens_only=hiddens_only)
                 else:
                     outputs, alphas = model(images, init_features, captions, lengths,
-                                            persist_features, teacher_p, args.teacher_forcing)
+                                            persist_features, teacher_p, args.teacher_forcing,
+                                            image_ids, hiddens_only=hiddens_only)
 
                 loss = criterion(outputs, targets)
 
@@ -582,7 +738,8 @@ def main(args):
 
             if args.validate is not None and (epoch + 1) % args.validation_step == 0:
                 val_loss = do_validate(model, valid_loader, criterion, scorers, vocab,
-                                       teacher_p, args, params, stats, epoch)
+                                       teacher_p, args, params, stats, epoch,
+                                       validation_references, validation_dataset_params)
 
                 if args.lr_scheduler:
                     scheduler.step(val_loss)
@@ -607,6 +764,9 @@ if __name__ == '__main__':
                         help='base name for model snapshot filenames')
     parser.add_argument('--model_path', type=str, default='models/',
                         help='path for saving trained models')
+    parser.add_argument('--feature_cache', type=str,
+                        help='LMDB file for caching the outputs of the pretrained CNNs '
+                        'between epochs, implies deterministic center crops of the images')
     parser.add_argument('--crop_size', type=int, default=224,
                         help='size for randomly cropping images')
     parser.add_argument('--tmp_dir_prefix', type=str,
@@ -638,6 +798,9 @@ if __name__ == '__main__':
                         help='Cached vocabulary files folder')
     parser.add_argument('--no_tokenize', action='store_true')
     parser.add_argument('--show_tokens', action='store_true')
+    parser.add_argument('--cache_dir', type=str, default='cache',
+                        help='directory where tokenized captions are cached, '
+                        'set to empty string to tokenize on the fly')
     parser.add_argument('--vocab_threshold', type=int, default=4,
                         help='minimum word count threshold')
     parser.add_argument('--show_vocab_stats', action="store_true",
@@ -660,6 +823,10 @@ if __name__ == '__main__':
     parser.add_argument('--regularize_attn', action='store_true',
                         help='when training attention models, toggle one attention '
                              'reguralizer for the loss')
+    parser.add_argument('--adaptive_softmax', type=str,
+                        help='use an adaptive softmax output layer with these comma '
+                        'separated cutoffs of the words sorted by frequency, e.g. '
+                        '2000,10000')
     parser.add_argument('--embed_size', type=int, default=256,
                         help='dimension of word embedding vectors')
     parser.add_argument('--hidden_size', type=int, default=512,
@@ -677,7 +844,20 @@ if __name__ == '__main__':
     parser.add_argument('--num_epochs', type=int, default=5)
     parser.add_argument('--num_batches', type=int, default=0)
     parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--bucket_size', type=int, default=0,
+                        help='group captions of similar length into the same batch, '
+                        'sorting pools of this many batches at a time, 0 disables')
+    parser.add_argument('--max_tokens', type=int,
+                        help='with length bucketing, vary the batch size so that each '
+                        'padded batch has at most this many tokens')
+    parser.add_argument('--loss_chunk_size', type=int, default=0,
+                        help='compute the word scores and the loss this many tokens '
+                        'at a time to save memory with large vocabularies, 0 computes '
+                        'all at once')
     parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--shared_features', action='store_true',
+                        help='load .npy external features into shared memory instead '
+                        'of memory-mapping them')
     parser.add_argument('--learning_rate', type=float)
     parser.add_argument('--grad_clip', type=float,
                         help='Value at which to clip weight gradients. Disabled by default')
@@ -686,6 +866,13 @@ if __name__ == '__main__':
     parser.add_argument('--validation_step', type=int, default=1,
                         help='After how many epochs to perform validation, default=1')
     parser.add_argument('--validation_scoring', type=str)
+    parser.add_argument('--cider_df', type=str, default='corpus',
+                        help='document frequencies for CIDEr: "corpus" for those of '
+                        'the validation set, or the path of a table built with '
+                        'build_cider_df.py')
+    parser.add_argument('--cider_workers', type=int,
+                        help='number of processes for scoring CIDEr on at least 20000 '
+                        'images, by default up to 8, 1 for scoring in one process')
     parser.add_argument('--validate_only', action='store_true',
                         help='Just perform validation with given model, no training')
     parser.add_argument('--optimizer', type=str, default="rmsprop")
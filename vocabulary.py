@@ -152,6 +152,19 @@ def get_vocab_from_list(l, add_specials):
     return vocab
 
 
+def word_counts(vocab, counter, num_captions):
+    """Returns the number of occurrences of each word of vocab in the order of
+    the vocabulary indices, as needed by the adaptive softmax output layer.
+    Every caption has one <start> and one <end> token, and <unk> stands for
+    all the words below the threshold."""
+    counts = [counter[word] for word in vocab.get_list()]
+    counts[vocab('<unk>')] = sum(counter.values()) - sum(counts)
+    for token in ('<start>', '<end>'):
+        if token in vocab.word2idx:
+            counts[vocab(token)] = num_captions
+    return counts
+
+
 def build_vocab(vocab_output_path, dataset_params, ext_args):
     """Generate vocabulary pickle file
     :param vocab_output_path target path where to save the file
@@ -177,6 +190,7 @@ def build_vocab(vocab_output_path, dataset_params, ext_args):
 
     # Start counting words...
     counter = Counter()
+    num_captions = 0
     show_progress = sys.stderr.isatty()
     print("Building vocabulary...")
     for _, captions, _, _, _ in tqdm(data_loader, disable=not show_progress):
@@ -190,6 +204,7 @@ def build_vocab(vocab_output_path, dataset_params, ext_args):
                 diff_same = "DIFF" if caption != joined else "SAME"
                 print(diff_same, caption, '=>', joined)
             counter.update(words)
+            num_captions += 1
 
     if ext_args.show_vocab_stats:
         for k in counter.keys():
@@ -214,7 +229,8 @@ def build_vocab(vocab_output_path, dataset_params, ext_args):
         'file_path': os.path.abspath(vocab_output_path),
         'dataset': ext_args.dataset,
         'vocab_threshold': ext_args.vocab_threshold,
-        'no_tokenize': ext_args.no_tokenize
+        'no_tokenize': ext_args.no_tokenize,
+        'word_counts': word_counts(vocab, counter, num_captions)
     }
 
     vocab.update_metadata(metadata)